@@ -2,6 +2,8 @@ import torch
 import torch.utils.data as data
 import torchvision.transforms as transforms
 import os
+import functools
+import threading
 import nltk
 import numpy as np
 import pandas as pd
@@ -11,6 +13,9 @@ from utils.vocab import deserialize_vocab
 from PIL import Image
 import open_clip
 from tqdm import tqdm
+from utils.image_decode import build_decoder
+from utils.segment_store import PACKED_DIR, PackedSegments, packed_path
+from utils.text_length import trim_text_tokens
 
 # MODEL_NAME = "ViT-L-14"
 MODEL_NAME = "ViT-B-16"
@@ -78,6 +83,14 @@ class PrecompDataset(data.Dataset):
                 ]
             )
 
+        # Decode images no larger than needed by the first Resize of the transforms
+        self.image_size = (278, 278) if data_split == "train" else (224, 224)
+        self.decode = build_decoder(
+            args,
+            [self.img_path + str(name)[2:-1] for name in self.images[:8]],
+            size=self.image_size,
+        )
+
     def __getitem__(self, index):
         """
         Get an item from the dataset.
@@ -122,9 +135,7 @@ class PrecompDataset(data.Dataset):
         caption = []
         caption.extend([vocab(token) for token in tokens_UNK])
         caption = torch.LongTensor(caption)
-        image = Image.open(self.img_path + str(self.images[img_id])[2:-1]).convert(
-            "RGB"
-        )
+        image = self.decode(self.img_path + str(self.images[img_id])[2:-1], self.image_size)
         image = self.transform(image)  # torch.Size([3, 256, 256])
         img_name = str(self.images[img_id])[2:-1].split(".")[0]
         seg_path = os.path.join(
@@ -135,9 +146,9 @@ class PrecompDataset(data.Dataset):
         for i in range(num_seg):
             seg_list.append(
                 self.transform_segment(
-                    Image.open(
-                        os.path.join(seg_path, img_name + f"_{i}" + ".jpg")
-                    ).convert("RGB")
+                    self.decode(
+                        os.path.join(seg_path, img_name + f"_{i}" + ".jpg"), (224, 224)
+                    )
                 )
             )
 
@@ -209,6 +220,13 @@ class PrecompDataset_mine(data.Dataset):
         self.images = df["image_name"].values.tolist()
         self.length = len(self.captions)
         self.num_seg = args.num_seg
+        # "jpeg": one masked JPEG per segment in image_segments/<img>/,
+        # "packed": RLE masks and boxes in image_segments_packed/<img>.npz, rendered from the parent image
+        self.segment_format = getattr(args, "segment_format", "jpeg")
+        # Segment directory under the country, e.g. the output of another proposal backend
+        self.segment_dir = getattr(args, "segment_dir", None) or (
+            PACKED_DIR if self.segment_format == "packed" else "image_segments"
+        )
 
         # Define image transformations based on the data split
         if data_split == "train":
@@ -238,6 +256,14 @@ class PrecompDataset_mine(data.Dataset):
             )
             self.transform_segment = self.transform
 
+        # Decode images no larger than needed by the first Resize of the transforms
+        self.image_size = (278, 278) if data_split == "train" else (224, 224)
+        self.decode = build_decoder(
+            args,
+            [os.path.join(self.img_path, name) for name in self.images[:8]],
+            size=self.image_size,
+        )
+
     def __getitem__(self, index):
         # Handle image redundancy
         img_id = index
@@ -247,37 +273,40 @@ class PrecompDataset_mine(data.Dataset):
         cap_tokens = self.clip_tokenizer(caption)  # [1, 77]
 
         # Load the image
-        image = Image.open(os.path.join(self.img_path, self.images[img_id])).convert(
-            "RGB"
-        )
+        parent = self.decode(os.path.join(self.img_path, self.images[img_id]), self.image_size)
         # Apply transformations to the image, including resizing, random rotation, random cropping, and normalization
-        image = self.transform(image)
+        image = self.transform(parent)
 
-        # Construct the path for image segments
         img_name = self.images[img_id].split(".")[0]
-        seg_path = os.path.join(self.img_path[:-6] + "image_segments/", img_name)
-
-        # Get the current number of image segments
-        current_num_seg = min(len(os.listdir(seg_path)) - 1, self.num_seg)
-
-        seg_list = []
-        # Iterate over each image segment, load and apply transformations
-        img_list = os.listdir(os.path.join(seg_path))
-        for i in range(current_num_seg):
-            seg_list.append(
-                self.transform_segment(
-                    Image.open(os.path.join(seg_path + "/" + img_list[i])).convert(
-                        "RGB"
+        if self.segment_format == "packed":
+            # Render the masked bounding box crops from the already decoded parent image
+            packed = PackedSegments(packed_path(self.img_path, img_name, self.segment_dir))
+            seg_list = [
+                self.transform_segment(segment)
+                for segment in packed.render(parent, self.num_seg)
+            ]
+        else:
+            # Construct the path for image segments
+            seg_path = os.path.join(self.img_path[:-6] + self.segment_dir + "/", img_name)
+
+            # Get the current number of image segments
+            current_num_seg = min(len(os.listdir(seg_path)) - 1, self.num_seg)
+
+            seg_list = []
+            # Iterate over each image segment, load and apply transformations
+            img_list = os.listdir(os.path.join(seg_path))
+            for i in range(current_num_seg):
+                seg_list.append(
+                    self.transform_segment(
+                        self.decode(os.path.join(seg_path + "/" + img_list[i]), (224, 224))
                     )
                 )
-            )
-        # If the current number of image segments is less than the specified number, fill with zero tensors
-        if current_num_seg < self.num_seg:
-            for i in range(current_num_seg, self.num_seg):
-                seg_list.append(torch.zeros(3, 224, 224))
-
-        # Stack the processed image segment tensors
-        segment_img = torch.stack(seg_list, dim=0)
+        # Only the real segments are returned, missing ones are not padded here;
+        # collate_fn_mine packs them and records the per-sample segment counts
+        if seg_list:
+            segment_img = torch.stack(seg_list, dim=0)
+        else:
+            segment_img = torch.zeros(0, 3, 224, 224)
 
         # Return the image, description, index, image ID, caption token sequence, and image segment tensor
         return image, caption, index, img_id, cap_tokens, segment_img
@@ -373,6 +402,14 @@ class PrecompDataset_without_sam_mine(data.Dataset):
             )
             self.transform_segment = self.transform
 
+        # Decode images no larger than needed by the first Resize of the transforms
+        self.image_size = (278, 278) if data_split == "train" else (224, 224)
+        self.decode = build_decoder(
+            args,
+            [os.path.join(self.img_path, name) for name in self.images[:8]],
+            size=self.image_size,
+        )
+
     def __getitem__(self, index):
         # Handle image redundancy
         img_id = index
@@ -382,9 +419,7 @@ class PrecompDataset_without_sam_mine(data.Dataset):
         cap_tokens = self.clip_tokenizer(caption)  # [1, 77]
 
         # Load the image
-        image = Image.open(os.path.join(self.img_path, self.images[img_id])).convert(
-            "RGB"
-        )
+        image = self.decode(os.path.join(self.img_path, self.images[img_id]), self.image_size)
         # Apply transformations to the image, including resizing, random rotation, random cropping, and normalization
         image = self.transform(image)
 
@@ -450,13 +485,21 @@ class PrecompDataset_mine_finetune(data.Dataset):
             ])
             self.transform_segment = self.transform
 
+        # Decode images no larger than needed by the first Resize of the transforms
+        self.image_size = (278, 278) if data_split == "train" else (224, 224)
+        self.decode = build_decoder(
+            args,
+            [os.path.join(self.img_path, name) for name in self.images[:8]],
+            size=self.image_size,
+        )
+
     def __getitem__(self, index):
         img_id = index  # Image ID
         caption = self.captions[index]  # Caption for the given index
         cap_tokens = self.clip_tokenizer(caption)   # Tokenize the caption
 
         # Load and transform the image
-        image = Image.open(os.path.join(self.img_path, self.images[img_id])).convert("RGB")
+        image = self.decode(os.path.join(self.img_path, self.images[img_id]), self.image_size)
         image = self.transform(image)  # torch.Size([3, 256, 256])
 
         return image, caption, index, img_id, cap_tokens
@@ -509,12 +552,20 @@ class PrecompDataset_mine_zeroshot(data.Dataset):
             ])
             self.transform_segment = self.transform
 
+        # Decode images no larger than needed by the first Resize of the transforms
+        self.image_size = (278, 278) if data_split == "train" else (224, 224)
+        self.decode = build_decoder(
+            args,
+            [os.path.join(self.img_path, name) for name in self.images[:8]],
+            size=self.image_size,
+        )
+
     def __getitem__(self, index):
         img_id = index
         caption = self.captions[index]
         cap_tokens = self.clip_tokenizer(caption)
 
-        image = Image.open(os.path.join(self.img_path, self.images[img_id])).convert("RGB")
+        image = self.decode(os.path.join(self.img_path, self.images[img_id]), self.image_size)
         image = self.transform(image)  # torch.Size([3, 256, 256])
 
         return (image, caption, index, img_id, cap_tokens, os.path.join(self.img_path, self.images[img_id]))
@@ -560,35 +611,56 @@ def collate_fn(data):
     return images, targets, lengths, ids, tokens_clip, segment_img
 
 
-def collate_fn_mine(data):
+def collate_fn_mine(data, text_bucket=0):
+    """
+    Collate function for PrecompDataset_mine with ragged segment batching.
+
+    Args:
+        data (list): List of tuples (image, caption, index, img_id, cap_tokens, segment_img),
+            where segment_img holds only the real segments of the sample, [n_i, 3, 224, 224].
+        text_bucket (int, optional): Trim the caption tokens to the longest caption of the
+            batch, rounded up to a multiple of this. 0 keeps the full 77 token context.
+
+    Returns:
+        torch.Tensor: Stacked images tensor.
+        tuple: Indices.
+        torch.Tensor: Concatenated caption tokens tensor.
+        torch.Tensor: Packed segments of the whole batch, [sum(n_i), 3, 224, 224].
+        torch.Tensor: Number of segments of each sample, [batch_size].
+    """
     # Unpack the data tuples
     images, captions, ids, img_ids, cap_tokens, segment_img = zip(*data)
 
     # Merge images (convert tuple of 3D tensor to 4D tensor)
     images = torch.stack(images, 0)
-    segment_img = torch.stack(segment_img, 0)
-    cap_tokens = torch.cat(cap_tokens, dim=0)
+    cap_tokens = trim_text_tokens(torch.cat(cap_tokens, dim=0), text_bucket)
+
+    # Pack the real segments sample after sample, padding is never materialized
+    seg_counts = torch.LongTensor([seg.size(0) for seg in segment_img])
+    segment_img = torch.cat(segment_img, dim=0)
 
-    return images, ids, cap_tokens, segment_img
+    return images, ids, cap_tokens, segment_img, seg_counts
 
 
-def collate_fn_without_sam_mine(data):
+def collate_fn_without_sam_mine(data, text_bucket=0):
     # Unpack the data tuples
     images, captions, ids, img_ids, cap_tokens = zip(*data)
 
     # Merge images (convert tuple of 3D tensor to 4D tensor)
     images = torch.stack(images, 0)
-    cap_tokens = torch.cat(cap_tokens, dim=0)
+    cap_tokens = trim_text_tokens(torch.cat(cap_tokens, dim=0), text_bucket)
 
     return images, ids, cap_tokens
 
 
-def collate_fn_mine_finetune(data):
+def collate_fn_mine_finetune(data, text_bucket=0):
     """
     Custom collate function for fine-tuning your specific dataset structure.
 
     Args:
         data (list): List of tuples (image, caption, ids, img_ids, cap_tokens).
+        text_bucket (int, optional): Trim the caption tokens to the longest caption of the
+            batch, rounded up to a multiple of this. 0 keeps the full 77 token context.
 
     Returns:
         torch.Tensor: Stacked images tensor.
@@ -600,7 +672,7 @@ def collate_fn_mine_finetune(data):
 
     # Merge images (convert tuple of 3D tensor to 4D tensor)
     images = torch.stack(images, 0)
-    cap_tokens = torch.cat(cap_tokens, dim=0)
+    cap_tokens = trim_text_tokens(torch.cat(cap_tokens, dim=0), text_bucket)
 
     # Return the necessary components
     return images, cap_tokens
@@ -619,6 +691,16 @@ def collate_fn_mine_zeroshot(data):
     return images, cap_tokens, img_path, caption
 
 
+def train_collate(collate, args):
+    """
+    Collate function of a training loader, trimming the caption tokens when
+    `args.text_bucket` is set. Evaluation loaders keep the full context since
+    their batches are concatenated; the length bucketing happens when sharding.
+    """
+    text_bucket = getattr(args, "text_bucket", 0)
+    return functools.partial(collate, text_bucket=text_bucket) if text_bucket else collate
+
+
 def get_precomp_loader(
     args, data_split, vocab, batch_size=100, shuffle=False, num_workers=0
 ):
@@ -681,7 +763,7 @@ def get_precomp_loader_mine(
             dataset=dset,
             batch_size=batch_size,
             pin_memory=True,
-            collate_fn=collate_fn_mine,
+            collate_fn=train_collate(collate_fn_mine, args),
             num_workers=num_workers,
             sampler=sampler,
             drop_last=True,
@@ -692,7 +774,7 @@ def get_precomp_loader_mine(
             batch_size=batch_size,
             shuffle=shuffle,
             pin_memory=True,
-            collate_fn=collate_fn_mine,
+            collate_fn=train_collate(collate_fn_mine, args) if data_split == "train" else collate_fn_mine,
             num_workers=num_workers,
             drop_last=True,
         )
@@ -719,7 +801,7 @@ def get_precomp_loader_without_sam_mine(
             dataset=dset,
             batch_size=batch_size,
             pin_memory=True,
-            collate_fn=collate_fn_without_sam_mine,
+            collate_fn=train_collate(collate_fn_without_sam_mine, args),
             num_workers=num_workers,
             sampler=sampler,
             drop_last=True,
@@ -730,7 +812,7 @@ def get_precomp_loader_without_sam_mine(
             batch_size=batch_size,
             shuffle=shuffle,
             pin_memory=True,
-            collate_fn=collate_fn_without_sam_mine,
+            collate_fn=train_collate(collate_fn_without_sam_mine, args) if data_split == "train" else collate_fn_without_sam_mine,
             num_workers=num_workers,
             drop_last=True,
         )
@@ -886,6 +968,259 @@ def get_loaders_finetune_backup(args):
     )
 
 
+class PairedDomainLoader(object):
+    """
+    Iterate over (source_batch, target_batch, target_cycle) tuples from two DataLoaders.
+
+    Unlike `itertools.cycle`, which stores every yielded batch to replay it, an
+    exhausted loader is simply restarted. Each pass is therefore a freshly
+    shuffled and augmented epoch of its domain, and memory stays constant.
+    `target_cycle` is the index of the current pass over the target domain and
+    drives the curriculum schedule. It travels with the batch so it stays
+    correct when the pairs are prefetched ahead of the training loop.
+    """
+
+    def __init__(self, source_loader, target_loader, num_batches=None):
+        """
+        Initialize the PairedDomainLoader.
+
+        Args:
+            source_loader (torch.utils.data.DataLoader): Source domain loader.
+            target_loader (torch.utils.data.DataLoader): Target domain loader.
+            num_batches (int, optional): Number of pairs per iteration.
+                Defaults to one pass over the source loader.
+        """
+        self.source_loader = source_loader
+        self.target_loader = target_loader
+        self.num_batches = num_batches if num_batches is not None else len(source_loader)
+        self.source_cycle = 0
+        self.target_cycle = 0
+
+    def __len__(self):
+        return self.num_batches
+
+    @staticmethod
+    def _restart(loader, cycle):
+        # Reshuffle distributed samplers too, they only do so when told the epoch
+        sampler = getattr(loader, "sampler", None)
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(cycle)
+        return iter(loader)
+
+    def __iter__(self):
+        self.source_cycle = 0
+        self.target_cycle = 0
+        source_iter = self._restart(self.source_loader, self.source_cycle)
+        target_iter = self._restart(self.target_loader, self.target_cycle)
+
+        for _ in range(self.num_batches):
+            try:
+                source_batch = next(source_iter)
+            except StopIteration:
+                self.source_cycle += 1
+                source_iter = self._restart(self.source_loader, self.source_cycle)
+                source_batch = next(source_iter)
+            try:
+                target_batch = next(target_iter)
+            except StopIteration:
+                self.target_cycle += 1
+                target_iter = self._restart(self.target_loader, self.target_cycle)
+                target_batch = next(target_iter)
+
+            yield source_batch, target_batch, self.target_cycle
+
+
+class SimilarityCurriculumSampler(object):
+    """
+    Yield (source_indices, target_indices, target_cycle, target_weights) per
+    step, where the source indices are already filtered to the `ratio` most
+    target-similar samples of a random candidate batch.
+
+    This is the selection the fine-tuning models do after encoding the full
+    source batch (rank the candidates by their mean text cosine similarity to
+    the target batch and keep the top `ratio`), done on cached text embeddings
+    instead, so the discarded source samples are never loaded nor encoded.
+    `target_weights` is the adversarial weighting of the models before
+    scaling (W2: the sum of the top `ratio` similarities of every target
+    sample over the whole candidate batch), which the kept rows alone cannot
+    give back.
+
+    `plan` draws the candidate and target batches of an epoch up front. The
+    sampler only reads the cache: the training loop calls `refresh` between
+    steps, every `refresh_steps` steps, to re-encode through `refresh_fn` the
+    captions of the window after the next one (the sampler may run ahead in
+    a prefetch thread, which must not run the model while the main thread
+    updates it). Only the first refresh of a run encodes all captions. The
+    selection therefore uses text embeddings at most two windows old, as long
+    as the loader queues fewer than `refresh_steps` batches ahead.
+    """
+
+    def __init__(
+        self,
+        num_source,
+        num_target,
+        batch_size_source,
+        batch_size_target,
+        refresh_fn,
+        ratio_fn,
+        num_batches=None,
+        refresh_steps=50,
+    ):
+        """
+        Initialize the SimilarityCurriculumSampler.
+
+        Args:
+            num_source (int): Number of source samples.
+            num_target (int): Number of target samples.
+            batch_size_source (int): Candidate source batch size before selection.
+            batch_size_target (int): Target batch size.
+            refresh_fn (callable): Maps (source_indices, target_indices) to their
+                text embeddings ([len(source_indices), D], [len(target_indices), D]).
+                Only called by `refresh`.
+            ratio_fn (callable): Maps the target cycle to the kept fraction of source candidates,
+                the `source_ratio` schedule of the model.
+            num_batches (int, optional): Number of steps per iteration.
+                Defaults to one pass over the source candidates.
+            refresh_steps (int, optional): Steps per refreshed window. Defaults to 50.
+        """
+        self.num_source = num_source
+        self.num_target = num_target
+        self.batch_size_source = batch_size_source
+        self.batch_size_target = batch_size_target
+        self.refresh_fn = refresh_fn
+        self.ratio_fn = ratio_fn
+        self.num_batches = num_batches if num_batches is not None else num_source // batch_size_source
+        self.refresh_steps = max(1, refresh_steps)
+        # (source_text_emb, target_text_emb), updated in place by `refresh` under the lock
+        self.cache = None
+        self.lock = threading.Lock()
+        # (candidates, target_indices) of every step of the epoch, drawn by `plan`
+        self.schedule = None
+        self._source_batches = self._batches(num_source, batch_size_source)
+        self._target_batches = self._batches(num_target, batch_size_target)
+
+    def __len__(self):
+        return self.num_batches
+
+    def plan(self):
+        """Draw the candidate and target batches of the next epoch."""
+        self.schedule = [
+            (next(self._source_batches), next(self._target_batches)) for _ in range(self.num_batches)
+        ]
+
+    def refresh(self, start=0, stop=None):
+        """
+        Re-encode with the live model the captions of steps [start, stop) of the
+        planned epoch (all captions the first time); call it from the training
+        loop, between steps.
+        """
+        if self.cache is None:
+            source_emb, target_emb = self.refresh_fn(torch.arange(self.num_source), torch.arange(self.num_target))
+            self.cache = (source_emb.float().cpu(), target_emb.float().cpu())
+            return
+        window = self.schedule[start:stop]
+        if not window:
+            return
+        source_indices = torch.cat([candidates for candidates, _ in window]).unique()
+        target_indices = torch.cat([targets for _, targets in window]).unique()
+        source_emb, target_emb = self.refresh_fn(source_indices, target_indices)
+        with self.lock:
+            self.cache[0][source_indices] = source_emb.float().cpu()
+            self.cache[1][target_indices] = target_emb.float().cpu()
+
+    @staticmethod
+    def _batches(num_samples, batch_size):
+        # Endless shuffled passes with drop_last, like a restarted shuffling DataLoader
+        while True:
+            perm = torch.randperm(num_samples)
+            for start in range(0, num_samples - batch_size + 1, batch_size):
+                yield perm[start:start + batch_size]
+
+    def __iter__(self):
+        if self.cache is None or self.schedule is None:
+            raise RuntimeError("SimilarityCurriculumSampler.plan() and refresh() must be called before iterating")
+        schedule = self.schedule
+        target_len = self.num_target // self.batch_size_target
+
+        for step, (candidates, target_indices) in enumerate(schedule):
+            target_cycle = step // target_len
+            with self.lock:
+                # Same ranking as the models: mean cosine similarity to the target texts
+                W1 = self.cache[1][target_indices] @ self.cache[0][candidates].t()
+            W1_mean = W1.mean(dim=0)
+            selected_batchsize = max(1, int(len(candidates) * self.ratio_fn(target_cycle)))
+            _, sorted_W1_mean_index = torch.sort(W1_mean, descending=True)
+            source_indices = candidates[sorted_W1_mean_index[:selected_batchsize]]
+            # W2 of the models: top similarities of every target row over all the candidates
+            target_weights = W1.topk(selected_batchsize, dim=1)[0].sum(dim=1)
+
+            yield source_indices.tolist(), target_indices.tolist(), target_cycle, target_weights
+
+
+class PairedBatchDataset(data.Dataset):
+    """
+    Fetch and collate a whole (source_batch, target_batch) pair per item, indexed
+    by the (source_indices, target_indices, target_cycle, target_weights) tuples of
+    a batch sampler such as SimilarityCurriculumSampler. Used with `batch_size=None`,
+    so each DataLoader worker builds complete pairs.
+    """
+
+    def __init__(self, source_dataset, target_dataset, collate_fn):
+        self.source_dataset = source_dataset
+        self.target_dataset = target_dataset
+        self.collate_fn = collate_fn
+
+    def __len__(self):
+        return len(self.source_dataset)
+
+    def __getitem__(self, item):
+        source_indices, target_indices, target_cycle, target_weights = item
+        source_batch = self.collate_fn([self.source_dataset[i] for i in source_indices])
+        target_batch = self.collate_fn([self.target_dataset[i] for i in target_indices])
+        return source_batch, target_batch, target_cycle, target_weights
+
+
+def get_curriculum_loader(args, source_dataset, target_dataset, refresh_fn, ratio_fn, num_batches=None):
+    """
+    Build a loader of (source_batch, target_batch, target_cycle, target_weights)
+    tuples whose source batches are pre-selected by SimilarityCurriculumSampler.
+    It replaces PairedDomainLoader in the fine-tuning loops, which pass the
+    target weights (W2) on to the model.
+
+    Args:
+        args: Parsed arguments (`batch_size_source`, `batch_size_target`,
+            `sampler_refresh_steps`, `workers`).
+        source_dataset (PrecompDataset_mine_finetune): Source domain training set.
+        target_dataset (PrecompDataset_mine_finetune): Target domain training set.
+        refresh_fn (callable): Maps (source_indices, target_indices) to fresh text embeddings.
+        ratio_fn (callable): Maps the target cycle to the kept fraction of source
+            candidates, the `source_ratio` of the fine-tuning model.
+        num_batches (int, optional): Number of steps per epoch.
+
+    Returns:
+        torch.utils.data.DataLoader: The paired loader.
+    """
+    sampler = SimilarityCurriculumSampler(
+        len(source_dataset),
+        len(target_dataset),
+        args.batch_size_source,
+        args.batch_size_target,
+        refresh_fn=refresh_fn,
+        ratio_fn=ratio_fn,
+        num_batches=num_batches,
+        refresh_steps=args.sampler_refresh_steps,
+    )
+    # The sampler is iterated where the loader is (the prefetch thread with --prefetch) and
+    # only reads its cache; the training loop refreshes it between steps (engine._refresh_curriculum_sampler)
+    return torch.utils.data.DataLoader(
+        dataset=PairedBatchDataset(source_dataset, target_dataset, train_collate(collate_fn_mine_finetune, args)),
+        sampler=sampler,
+        batch_size=None,
+        pin_memory=True,
+        num_workers=args.workers,
+    )
+
+
 def get_loaders_finetune(args):
     source_train_dataset = PrecompDataset_mine_finetune(
         args,
@@ -899,12 +1234,30 @@ def get_loaders_finetune(args):
         country=args.country_target,
         source=False,
     )
+    val_dataset_target = PrecompDataset_mine_finetune(
+        args,
+        data_split="val",
+        country=args.country_target,
+        source=False,
+    )
+    return get_loaders_finetune_from_datasets(args, source_train_dataset, target_train_dataset, val_dataset_target)
+
+
+def get_loaders_finetune_from_datasets(args, source_train_dataset, target_train_dataset, val_dataset_target):
+    """
+    Build the fine-tuning loaders of get_loaders_finetune around given datasets,
+    such as the stored image features of utils.feature_store.
+
+    Returns:
+        tuple: (source_train_loader, target_train_loader, source_train_dataset,
+            target_train_dataset, val_loader_target, val_dataset_target).
+    """
     source_train_loader = torch.utils.data.DataLoader(
         dataset=source_train_dataset,
         batch_size=args.batch_size_source,
         shuffle=True,
         pin_memory=True,
-        collate_fn=collate_fn_mine_finetune,
+        collate_fn=train_collate(collate_fn_mine_finetune, args),
         num_workers=args.workers,
         drop_last=True,
     )
@@ -913,18 +1266,18 @@ def get_loaders_finetune(args):
         batch_size=args.batch_size_target,
         shuffle=True,
         pin_memory=True,
-        collate_fn=collate_fn_mine_finetune,
+        collate_fn=train_collate(collate_fn_mine_finetune, args),
         num_workers=args.workers,
         drop_last=True,
     )
-    val_loader_target, val_dataset_target = get_precomp_loader_mine_finetune(
-        args,
-        "val",
-        args.country_target,
-        args.batch_size_val_target,
-        False,
-        args.workers,
-        source=False,
+    val_loader_target = torch.utils.data.DataLoader(
+        dataset=val_dataset_target,
+        batch_size=args.batch_size_val_target,
+        shuffle=False,
+        pin_memory=True,
+        collate_fn=collate_fn_mine_finetune,
+        num_workers=args.workers,
+        drop_last=True,
     )
 
     return (
@@ -4,19 +4,24 @@ import numpy as np
 import itertools
 from torch.autograd import Variable
 import utils.utils as utils
+from utils import prefetch
+from utils import metrics
+from utils.precision import build_precision
+from utils.profiler import StepProfiler
+from utils.grad_cache import GradCache
+from utils.cross_rank import CrossRank
+import data
 import os
 import shutil
 
 # import tensorboard_logger as tb_logger
-import wandb
 
 # import logging
 from loguru import logger
-from torch.nn.utils.clip_grad import clip_grad_norm
 from tqdm import tqdm
 
 
-def train(args, train_loader, model, optimizer, epoch):
+def train(args, train_loader, model, optimizer, epoch, precision=None, memory_bank=None):
     """
     Train function to train the model using the provided training data.
 
@@ -26,6 +31,10 @@ def train(args, train_loader, model, optimizer, epoch):
         model (torch.nn.Module): Model to be trained.
         optimizer (torch.optim.Optimizer): Optimizer for updating model parameters.
         epoch (int): Current epoch number.
+        precision (utils.precision.Precision, optional): Autocast and loss scaling.
+            Built from args when not given.
+        memory_bank (utils.memory_bank.MemoryBank, optional): Queue of the embeddings of the
+            previous steps, used as extra negatives. Kept across epochs by the caller.
 
     Returns:
         None
@@ -36,9 +45,9 @@ def train(args, train_loader, model, optimizer, epoch):
     margin = args.margin  # Margin value for contrastive loss
     print_freq = args.print_freq  # Frequency of printing training progress
 
-    # If distributed training, initialize mean loss tracking on the GPU
-    if args.distributed:
-        mean_loss = torch.zeros(1).to(args.gpuid)
+    # Autocast and loss scaling, normally shared across epochs by the caller
+    if precision is None:
+        precision = build_precision(args)
 
     # Set the model to training mode
     model.train()
@@ -49,6 +58,14 @@ def train(args, train_loader, model, optimizer, epoch):
     
     # Initialize a log collector to collect and log training metrics
     train_logger = utils.LogCollector()
+    # Loss components stay on the device until they are flushed every print_freq steps
+    step_metrics = metrics.StepMetrics(args, train_logger)
+    step_profiler = StepProfiler(args, epoch, name="train")
+    # Gradient cache: the loss sees the whole batch, the encoders only --grad_cache_chunk samples at a time
+    grad_cache = GradCache(model, args.grad_cache_chunk, precision, args) if getattr(args, "grad_cache_chunk", 0) else None
+    # Losses over the embeddings instead of the in-batch scores, with negatives from all ranks and the memory bank
+    cross_rank = CrossRank(args)
+    use_embeddings = cross_rank.enabled or memory_bank is not None
 
     # Record the start time for measuring data loading time
     end = time.time()
@@ -56,10 +73,13 @@ def train(args, train_loader, model, optimizer, epoch):
     # Get model parameters for gradient clipping
     params = list(model.parameters())
 
+    # Keep batches collated and copied to the device ahead of compute, if enabled
+    train_iter = prefetch.build_prefetcher(args, train_loader)
+
     # Iterate over the training data in batches
-    for i, train_data in enumerate(train_loader):
-        # Unpack the training data into visual input, text input, and segment images
-        input_visual, ids, input_text, segment_imgs = train_data
+    for i, train_data in enumerate(step_profiler.iterate(train_iter)):
+        # Unpack the training data into visual input, text input, packed segment images and segment counts
+        input_visual, ids, input_text, segment_imgs, seg_counts = train_data
 
         # Convert margin to a floating-point value
         margin = float(margin)
@@ -71,35 +91,60 @@ def train(args, train_loader, model, optimizer, epoch):
         model.logger = train_logger
         
         # Move input tensors to GPU if CUDA is available
-        if torch.cuda.is_available():
-            input_visual = input_visual.cuda(args.gpuid)
-            input_text = input_text.cuda(args.gpuid)
-            segment_imgs = segment_imgs.cuda(args.gpuid)
+        with step_profiler.phase("h2d"):
+            if torch.cuda.is_available():
+                input_visual = input_visual.cuda(args.gpuid, non_blocking=True)
+                input_text = input_text.cuda(args.gpuid, non_blocking=True)
+                segment_imgs = segment_imgs.cuda(args.gpuid, non_blocking=True)
+                seg_counts = seg_counts.cuda(args.gpuid, non_blocking=True)
 
-        # Synchronize CUDA streams to ensure accurate timing
-        torch.cuda.synchronize(device=args.gpuid)
+        # Wait for the device only when exact timings are requested (--sync_timing)
+        metrics.synchronize(args)
 
         # Calculate the loss based on whether intra-level loss is used or not
         if not args.il_measure:
             # Calculate scores for image-to-text and segment-to-text matching
-            scores_img2text, scores_seg2text = model(input_visual, input_text, segment_imgs)
+            with step_profiler.phase("forward"):
+                if grad_cache is not None:
+                    # Embed the whole batch chunk by chunk without graphs, the encoders are backpropagated later
+                    emb = grad_cache.embed(image=input_visual, text=input_text, segments=(segment_imgs, seg_counts))
+                    scores_img2text = grad_cache.module.similarity(emb["image"], emb["text"])
+                    scores_seg2text = grad_cache.module.similarity(emb["segments"], emb["text"])
+                elif use_embeddings:
+                    scores_img2text, scores_seg2text, emb = model(
+                        input_visual, input_text, segment_imgs, seg_counts, return_embeddings=True
+                    )
+                else:
+                    scores_img2text, scores_seg2text = model(input_visual, input_text, segment_imgs, seg_counts)
             # Calculate contrastive loss for image-to-text and segment-to-text scores
-            loss_img2text = utils.calcul_contraloss(
-                args,
-                scores_img2text,
-                input_visual.size(0),
-                margin,
-                max_violation=max_violation,
-            )
-            loss_seg2text = utils.calcul_contraloss(
-                args,
-                scores_seg2text,
-                input_visual.size(0),
-                margin,
-                max_violation=max_violation,
-            )
-            # Total loss is the sum of both losses
-            loss = loss_img2text + loss_seg2text
+            with step_profiler.phase("loss"):
+                if use_embeddings:
+                    # Negatives from the batches of all ranks and from the embeddings queued by the previous steps
+                    loss_img2text = cross_rank.contraloss(
+                        emb["image"], emb["text"], margin, max_violation=max_violation, memory_bank=memory_bank, query="image"
+                    )
+                    loss_seg2text = cross_rank.contraloss(
+                        emb["segments"], emb["text"], margin, max_violation=max_violation, memory_bank=memory_bank, query="segments"
+                    )
+                    if memory_bank is not None:
+                        memory_bank.enqueue(**emb)
+                else:
+                    loss_img2text = utils.calcul_contraloss(
+                        args,
+                        scores_img2text,
+                        input_visual.size(0),
+                        margin,
+                        max_violation=max_violation,
+                    )
+                    loss_seg2text = utils.calcul_contraloss(
+                        args,
+                        scores_seg2text,
+                        input_visual.size(0),
+                        margin,
+                        max_violation=max_violation,
+                    )
+                # Total loss is the sum of both losses
+                loss = loss_img2text + loss_seg2text
         else:
             # Calculate scores for inter- and intra-level matching
             scores, scores_intra_img, scores_intra_cap = model(input_visual, input_text, lengths)
@@ -117,76 +162,58 @@ def train(args, train_loader, model, optimizer, epoch):
                 + intra_loss
             )
 
-        # Apply gradient clipping if specified
-        if grad_clip > 0:
-            clip_grad_norm(params, grad_clip)
-
-        # Log the loss values to Weights & Biases for monitoring
-        wandb.log(
-            {
-                "loss": loss.cpu().data.numpy(),
-                "loss_img2text": loss_img2text.cpu().data.numpy(),
-                "loss_seg2text": loss_seg2text.cpu().data.numpy(),
-            }
-        )
-
         # Clear gradients from the previous step
         optimizer.zero_grad()
-        # Backpropagate to compute gradients
-        loss.backward()
+        # Backpropagate to compute (scaled, with fp16) gradients, through the embedding cache if enabled
+        with step_profiler.phase("backward"):
+            if grad_cache is not None:
+                grad_cache.backward(loss)
+            else:
+                precision.backward(loss)
         
-        # Reduce loss across processes if in distributed training mode
-        if args.distributed:
-            loss = utils.reduce_value(args, loss, average=True)
-            # Update the mean loss value
-            mean_loss = (mean_loss * i + loss.detach()) / (i + 1)
-            train_logger.update("Loss", round(mean_loss.item(), 3))
-        else:
-            # Log individual loss components to the logger
-            train_logger.update("Loss", loss.cpu().data.numpy())
-            train_logger.update("Loss_img2text", loss_img2text.cpu().data.numpy())
-            train_logger.update("Loss_seg2text", loss_seg2text.cpu().data.numpy())
-
-        # Synchronize CUDA streams before optimizer step
-        torch.cuda.synchronize(device=args.gpuid)
-        # Update model parameters
-        optimizer.step()
-        # Synchronize CUDA streams again after step
-        torch.cuda.synchronize(device=args.gpuid)
+        # Accumulate the loss components on the device (reduced across processes when flushed)
+        step_metrics.update(loss=loss, loss_img2text=loss_img2text, loss_seg2text=loss_seg2text)
+
+        # Unscale and clip the gradients, then update model parameters
+        with step_profiler.phase("grad_clip"):
+            precision.clip(optimizer, params, grad_clip)
+        with step_profiler.phase("optimizer"):
+            precision.step(optimizer)
+        metrics.synchronize(args)
 
         # Update batch time to include the time taken for the current iteration
         batch_time.update(time.time() - end)
         end = time.time()
 
-        # Print training progress at the specified frequency, only on the main process (rank 0)
-        if i % print_freq == 0 and args.rank == 0:
-            logger.info(
-                "Epoch [{0}][{1}/{2}]\t"
-                "Time {batch_time.val:.3f}\t"
-                "{elog}\t".format(
-                    epoch,
-                    i,
-                    len(train_loader),
-                    batch_time=batch_time,
-                    elog=str(train_logger),
+        # Flush the metrics to the loggers at the specified frequency, on every process
+        with step_profiler.phase("logging"):
+            if i % print_freq == 0:
+                step_metrics.flush(epoch=epoch, batch_time=batch_time.val, data_time=data_time.val)
+
+            # Print training progress at the specified frequency, only on the main process (rank 0)
+            if i % print_freq == 0 and args.rank == 0:
+                logger.info(
+                    "Epoch [{0}][{1}/{2}]\t"
+                    "Time {batch_time.val:.3f}\t"
+                    "Data {data_time.val:.3f}\t"
+                    "{elog}\t".format(
+                        epoch,
+                        i,
+                        len(train_loader),
+                        batch_time=batch_time,
+                        data_time=data_time,
+                        elog=str(train_logger),
+                    )
                 )
-            )
-            # Print GPU usage for monitoring purposes
-            utils.get_GPU_usage()
-
-        # Log epoch and batch time to Weights & Biases
-        wandb.log(
-            {
-                "epoch": epoch,
-                "batch_time": batch_time.val,
-            }
-        )
+        step_profiler.step()
 
-        # Log training metrics to Weights & Biases using the logger
-        train_logger.wandb_log()
+    # Log the steps since the last flush
+    step_metrics.flush(epoch=epoch)
+    # Per-phase timings of the epoch, with --profile
+    step_profiler.summary()
 
 
-def train_without_sam(args, train_loader, model, optimizer, epoch):
+def train_without_sam(args, train_loader, model, optimizer, epoch, precision=None, memory_bank=None):
     """
     Train function to train the model using the provided training data.
 
@@ -196,6 +223,8 @@ def train_without_sam(args, train_loader, model, optimizer, epoch):
         model (torch.nn.Module): Model to be trained.
         optimizer (torch.optim.Optimizer): Optimizer for training.
         epoch (int): Current epoch number.
+        precision (utils.precision.Precision, optional): Autocast and loss scaling.
+        memory_bank (utils.memory_bank.MemoryBank, optional): Extra negatives from the previous steps.
 
     Returns:
         None
@@ -205,9 +234,8 @@ def train_without_sam(args, train_loader, model, optimizer, epoch):
     max_violation = args.max_violation
     margin = args.margin
     print_freq = args.print_freq
-    if args.distributed:
-        mean_loss = torch.zeros(1).to(args.gpuid)
-
+    if precision is None:
+        precision = build_precision(args)
     # Set model to train mode
     model.train()
 
@@ -215,8 +243,14 @@ def train_without_sam(args, train_loader, model, optimizer, epoch):
     batch_time = utils.AverageMeter()
     data_time = utils.AverageMeter()
 
-    # Initialize log collector
+    # Initialize log collector, losses are accumulated on the device in between flushes
     train_logger = utils.LogCollector()
+    step_metrics = metrics.StepMetrics(args, train_logger)
+    step_profiler = StepProfiler(args, epoch, name="train_without_sam")
+    grad_cache = GradCache(model, args.grad_cache_chunk, precision, args) if getattr(args, "grad_cache_chunk", 0) else None
+    # Losses over the embeddings instead of the in-batch scores, with negatives from all ranks and the memory bank
+    cross_rank = CrossRank(args)
+    use_embeddings = cross_rank.enabled or memory_bank is not None
 
     # Initialize timer
     end = time.time()
@@ -224,8 +258,11 @@ def train_without_sam(args, train_loader, model, optimizer, epoch):
     # Get model parameters
     params = list(model.parameters())
 
+    # Keep batches collated and copied to the device ahead of compute, if enabled
+    train_iter = prefetch.build_prefetcher(args, train_loader)
+
     # Iterate over batches in the training data
-    for i, train_data in enumerate(train_loader):
+    for i, train_data in enumerate(step_profiler.iterate(train_iter)):
         # Unpack training data
         input_visual, ids, input_text = train_data
 
@@ -235,23 +272,38 @@ def train_without_sam(args, train_loader, model, optimizer, epoch):
         model.logger = train_logger
 
         # Move tensors to GPU if available
-        if torch.cuda.is_available():
-            input_visual = input_visual.cuda(args.gpuid)
-            input_text = input_text.cuda(args.gpuid)
+        with step_profiler.phase("h2d"):
+            if torch.cuda.is_available():
+                input_visual = input_visual.cuda(args.gpuid, non_blocking=True)
+                input_text = input_text.cuda(args.gpuid, non_blocking=True)
 
-        # Synchronize CUDA streams
-        torch.cuda.synchronize(device=args.gpuid)
+        metrics.synchronize(args)
 
         if not args.il_measure:
-            scores_img2text = model(input_visual, input_text)
-            loss_img2text = utils.calcul_contraloss(
-                args,
-                scores_img2text,
-                input_visual.size(0),
-                margin,
-                max_violation=max_violation,
-            )
-            loss = loss_img2text
+            with step_profiler.phase("forward"):
+                if grad_cache is not None:
+                    emb = grad_cache.embed(image=input_visual, text=input_text)
+                    scores_img2text = grad_cache.module.similarity(emb["image"], emb["text"])
+                elif use_embeddings:
+                    scores_img2text, emb = model(input_visual, input_text, return_embeddings=True)
+                else:
+                    scores_img2text = model(input_visual, input_text)
+            with step_profiler.phase("loss"):
+                if use_embeddings:
+                    loss_img2text = cross_rank.contraloss(
+                        emb["image"], emb["text"], margin, max_violation=max_violation, memory_bank=memory_bank
+                    )
+                    if memory_bank is not None:
+                        memory_bank.enqueue(**emb)
+                else:
+                    loss_img2text = utils.calcul_contraloss(
+                        args,
+                        scores_img2text,
+                        input_visual.size(0),
+                        margin,
+                        max_violation=max_violation,
+                    )
+                loss = loss_img2text
         else:
             scores, scores_intra_img, scores_intra_cap = model(
                 input_visual, input_text, lengths
@@ -270,90 +322,109 @@ def train_without_sam(args, train_loader, model, optimizer, epoch):
                 + intra_loss
             )
 
-        if grad_clip > 0:
-            clip_grad_norm(params, grad_clip)
-
-        # Log loss values
-        wandb.log(
-            {
-                "loss": loss.cpu().data.numpy(),
-                "loss_img2text": loss_img2text.cpu().data.numpy(),
-            }
-        )
-
         optimizer.zero_grad()
-        loss.backward()
-        if args.distributed:
-            loss = utils.reduce_value(args, loss, average=True)
-            mean_loss = (mean_loss * i + loss.detach()) / (i + 1)  # update mean losses
-            train_logger.update("Loss", round(mean_loss.item(), 3))
-        else:
-            train_logger.update("Loss", loss.cpu().data.numpy())
-            train_logger.update("Loss_img2text", loss_img2text.cpu().data.numpy())
-
-        torch.cuda.synchronize(device=args.gpuid)
-        optimizer.step()
-        torch.cuda.synchronize(device=args.gpuid)
+        with step_profiler.phase("backward"):
+            if grad_cache is not None:
+                grad_cache.backward(loss)
+            else:
+                precision.backward(loss)
+        step_metrics.update(loss=loss, loss_img2text=loss_img2text)
+
+        with step_profiler.phase("grad_clip"):
+            precision.clip(optimizer, params, grad_clip)
+        with step_profiler.phase("optimizer"):
+            precision.step(optimizer)
+        metrics.synchronize(args)
 
         # Update average meters
         batch_time.update(time.time() - end)
         end = time.time()
 
-        # Print training progress
-        if i % print_freq == 0 and args.rank == 0:
-            logger.info(
-                "Epoch [{0}][{1}/{2}]\t"
-                "Time {batch_time.val:.3f}\t"
-                "{elog}\t".format(
-                    epoch,
-                    i,
-                    len(train_loader),
-                    batch_time=batch_time,
-                    elog=str(train_logger),
+        # Flush the metrics and print training progress
+        with step_profiler.phase("logging"):
+            if i % print_freq == 0:
+                step_metrics.flush(epoch=epoch, batch_time=batch_time.val, data_time=data_time.val)
+            if i % print_freq == 0 and args.rank == 0:
+                logger.info(
+                    "Epoch [{0}][{1}/{2}]\t"
+                    "Time {batch_time.val:.3f}\t"
+                    "Data {data_time.val:.3f}\t"
+                    "{elog}\t".format(
+                        epoch,
+                        i,
+                        len(train_loader),
+                        batch_time=batch_time,
+                        data_time=data_time,
+                        elog=str(train_logger),
+                    )
                 )
-            )
-            utils.get_GPU_usage()
+        step_profiler.step()
 
-        wandb.log(
-            {
-                "epoch": epoch,
-                "batch_time": batch_time.val,
-            }
-        )
+    # Log the steps since the last flush
+    step_metrics.flush(epoch=epoch)
+    # Per-phase timings of the epoch, with --profile
+    step_profiler.summary()
+
+
+def _refresh_curriculum_sampler(paired_loader, source_preselected):
+    """
+    The similarity curriculum sampler of `paired_loader`, with the epoch planned
+    and the captions of its first two windows refreshed. The sampler only reads
+    its cache, as it may be iterated by the prefetch thread: the training loop
+    refreshes the window after the next one with the live model, between steps,
+    every `refresh_steps` steps (`_refresh_next_window`).
+    """
+    sampler = getattr(paired_loader, "sampler", None) if source_preselected else None
+    if not isinstance(sampler, data.SimilarityCurriculumSampler):
+        return None
+    sampler.plan()
+    sampler.refresh(0, 2 * sampler.refresh_steps)
+    return sampler
 
-        # Log loss values to W&B
-        train_logger.wandb_log()
 
+def _refresh_next_window(sampler, num_steps, step_profiler):
+    """After `num_steps` steps, refresh the window after the next one every `refresh_steps` steps."""
+    if sampler is None or num_steps % sampler.refresh_steps:
+        return
+    with step_profiler.phase("sampler_refresh"):
+        sampler.refresh(num_steps + sampler.refresh_steps, num_steps + 2 * sampler.refresh_steps)
 
-def train_finetune(args, train_loader_source, train_loader_target, model, optimizer, epoch):
+
+def train_finetune(args, train_loader_source, train_loader_target, model, optimizer, epoch, paired_loader=None, precision=None):
     # Extract values from arguments
     grad_clip = args.grad_clip
     max_violation = args.max_violation
     margin = args.margin
     print_freq = args.print_freq
-
-    if args.distributed:
-        mean_loss = torch.zeros(1).to(args.gpuid)
+    if precision is None:
+        precision = build_precision(args)
 
     # Switch to train mode
     model.train()
     batch_time = utils.AverageMeter()
     data_time = utils.AverageMeter()
     train_logger = utils.LogCollector()
+    step_metrics = metrics.StepMetrics(args, train_logger)
+    step_profiler = StepProfiler(args, epoch, name="train_finetune")
 
     end = time.time()
     params = list(model.parameters())
 
-    # Create an iterator for the target loader
-    target_loader_cycle = itertools.cycle(train_loader_target)
-    num_cycle_of_target = -1
-
-    for i, source_data in enumerate(train_loader_source):
+    # Pair one pass over the source domain with restarted passes over the target domain,
+    # prefetched to the device together if enabled. A given `paired_loader` (similarity
+    # curriculum sampler) yields source batches that are already filtered.
+    source_preselected = paired_loader is not None
+    if paired_loader is None:
+        paired_loader = data.PairedDomainLoader(train_loader_source, train_loader_target)
+    sampler = _refresh_curriculum_sampler(paired_loader, source_preselected)
+    paired_iter = prefetch.build_prefetcher(args, paired_loader)
+
+    for i, paired_batch in enumerate(step_profiler.iterate(paired_iter)):
+        # The curriculum sampler also yields the adversarial weights of the target samples
+        source_data, target_data, num_cycle_of_target = paired_batch[:3]
+        target_weights = paired_batch[3] if len(paired_batch) > 3 else None
         images_source, cap_tokens_source = source_data
-        images_target, cap_tokens_target = next(target_loader_cycle)
-
-        if i % len(train_loader_target) == 0:
-            num_cycle_of_target += 1
+        images_target, cap_tokens_target = target_data
 
         batch_size = images_source.size(0)
         margin = float(margin)
@@ -367,118 +438,116 @@ def train_finetune(args, train_loader_source, train_loader_target, model, optimi
         input_text_source = cap_tokens_source
         input_text_target = cap_tokens_target
 
-        if torch.cuda.is_available():
-            input_visuals_source = input_visuals_source.cuda(args.gpuid)
-            input_visuals_target = input_visuals_target.cuda(args.gpuid)
-            input_text_source = input_text_source.cuda(args.gpuid)
-            input_text_target = input_text_target.cuda(args.gpuid)
+        with step_profiler.phase("h2d"):
+            if torch.cuda.is_available():
+                input_visuals_source = input_visuals_source.cuda(args.gpuid, non_blocking=True)
+                input_visuals_target = input_visuals_target.cuda(args.gpuid, non_blocking=True)
+                input_text_source = input_text_source.cuda(args.gpuid, non_blocking=True)
+                input_text_target = input_text_target.cuda(args.gpuid, non_blocking=True)
+                if target_weights is not None:
+                    target_weights = target_weights.cuda(args.gpuid, non_blocking=True)
 
-        torch.cuda.synchronize(device=args.gpuid)
+        metrics.synchronize(args)
 
         # Calculate clip_loss, adv_loss, and filter_ratio
-        clip_loss, adv_loss, filter_ratio = model(
-            input_visuals_source,
-            input_visuals_target,
-            input_text_source,
-            input_text_target,
-            num_cycle_of_target=num_cycle_of_target,
-        )
-        loss = clip_loss + adv_loss
-
-        # Clip gradients if grad_clip is positive
-        if grad_clip > 0:
-            clip_grad_norm(params, grad_clip)
-
-        # Log the loss to Weights and Biases
-        wandb.log(
-            {
-                "loss": loss.cpu().data.numpy(),
-                "loss_clip": clip_loss.cpu().data.numpy(),
-                "loss_adv": adv_loss.cpu().data.numpy(),
-            }
-        )
+        with step_profiler.phase("forward"):
+            clip_loss, adv_loss, filter_ratio = model(
+                input_visuals_source,
+                input_visuals_target,
+                input_text_source,
+                input_text_target,
+                num_cycle_of_target=num_cycle_of_target,
+                source_preselected=source_preselected,
+                target_weights=target_weights,
+            )
+            loss = clip_loss + adv_loss
 
         # Zero the parameter gradients
         optimizer.zero_grad()
-        loss.backward()
+        with step_profiler.phase("backward"):
+            precision.backward(loss)
 
-        if args.distributed:
-            loss = utils.reduce_value(args, loss, average=True)
-            mean_loss = (mean_loss * i + loss.detach()) / (i + 1)  # update mean losses
-            train_logger.update("Loss", round(mean_loss.item(), 3))
-        else:
-            if args.il_measure:
-                train_logger.update("Loss_avg", loss.cpu().data.numpy())
+        step_metrics.update(loss=loss, loss_clip=clip_loss, loss_adv=adv_loss)
 
-        torch.cuda.synchronize(device=args.gpuid)
-        optimizer.step()
-        torch.cuda.synchronize(device=args.gpuid)
+        with step_profiler.phase("grad_clip"):
+            precision.clip(optimizer, params, grad_clip)
+        with step_profiler.phase("optimizer"):
+            precision.step(optimizer)
+        metrics.synchronize(args)
+        _refresh_next_window(sampler, i + 1, step_profiler)
 
         # Measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if i % print_freq == 0 and args.rank == 0:
-            logger.info(
-                "Epoch [{0}][{1}/{2}(source)][{1}/{3}(target)]\t"
-                "Time {batch_time.val:.3f}\t"
-                "{elog}\t".format(
-                    epoch,
-                    i,
-                    len(train_loader_source),
-                    len(train_loader_target),
-                    batch_time=batch_time,
-                    elog=str(train_logger),
+        with step_profiler.phase("logging"):
+            if i % print_freq == 0:
+                step_metrics.flush(epoch=epoch, batch_time=batch_time.val, data_time=data_time.val)
+            if i % print_freq == 0 and args.rank == 0:
+                logger.info(
+                    "Epoch [{0}][{1}/{2}(source)][{1}/{3}(target)]\t"
+                    "Time {batch_time.val:.3f}\t"
+                    "Data {data_time.val:.3f}\t"
+                    "{elog}\t".format(
+                        epoch,
+                        i,
+                        len(train_loader_source),
+                        len(train_loader_target),
+                        batch_time=batch_time,
+                        data_time=data_time,
+                        elog=str(train_logger),
+                    )
                 )
-            )
-            logger.info(f"{num_cycle_of_target}_th cycle of target data")
-            logger.info(f"filter_ratio: {filter_ratio}")
-            utils.get_GPU_usage()
-
-        # Log the batch time to Weights and Biases
-        wandb.log(
-            {
-                "batch_time": batch_time.val,
-            }
-        )
-        train_logger.wandb_log()
+                logger.info(f"{num_cycle_of_target}_th cycle of target data")
+                logger.info(f"filter_ratio: {filter_ratio}")
+        step_profiler.step()
+
+    # Log the steps since the last flush
+    step_metrics.flush(epoch=epoch)
+    # Per-phase timings of the epoch, with --profile
+    step_profiler.summary()
 
 
 def train_finetune_curriculum(
-    args, train_loader_source, train_loader_target, model, optimizer, epoch
+    args, train_loader_source, train_loader_target, model, optimizer, epoch, paired_loader=None, precision=None
 ):
     grad_clip = args.grad_clip
     max_violation = args.max_violation
     margin = args.margin
     print_freq = args.print_freq
-    if args.distributed:
-        mean_loss = torch.zeros(1).to(args.gpuid)
-
+    if precision is None:
+        precision = build_precision(args)
     # switch to train mode
     model.train()
     batch_time = utils.AverageMeter()
     data_time = utils.AverageMeter()
     train_logger = utils.LogCollector()
+    step_metrics = metrics.StepMetrics(args, train_logger)
+    step_profiler = StepProfiler(args, epoch, name="train_finetune_curriculum")
 
     end = time.time()
     params = list(model.parameters())
 
-    # 创建 B_loader 的循环迭代器
-    target_loader_cycle = itertools.cycle(train_loader_target)
-    source_loader_cycle = itertools.cycle(train_loader_source)
-
-    num_cycle_of_target = 0
-    i = 0
-    while num_cycle_of_target <= 4:
-        images_source, cap_tokens_source = next(source_loader_cycle)
-        images_target, cap_tokens_target = next(target_loader_cycle)
-        
-        if i % len(train_loader_target) == 0 and i != 0:
-            num_cycle_of_target += 1  # 每个 epoch 递增
-        if num_cycle_of_target > 4:
-            break
+    # Five passes over the target domain (curriculum cycles 0-4), with both domains
+    # restarted and reshuffled whenever exhausted, prefetched together if enabled.
+    # A given `paired_loader` (similarity curriculum sampler) yields source batches
+    # that are already filtered.
+    source_preselected = paired_loader is not None
+    if paired_loader is None:
+        paired_loader = data.PairedDomainLoader(
+            train_loader_source,
+            train_loader_target,
+            num_batches=5 * len(train_loader_target),
+        )
+    sampler = _refresh_curriculum_sampler(paired_loader, source_preselected)
+    paired_iter = prefetch.build_prefetcher(args, paired_loader)
 
-        i += 1
+    for i, paired_batch in enumerate(step_profiler.iterate(paired_iter), start=1):
+        # The curriculum sampler also yields the adversarial weights of the target samples
+        source_data, target_data, num_cycle_of_target = paired_batch[:3]
+        target_weights = paired_batch[3] if len(paired_batch) > 3 else None
+        images_source, cap_tokens_source = source_data
+        images_target, cap_tokens_target = target_data
 
         batch_size = images_source.size(0)
         margin = float(margin)
@@ -491,72 +560,71 @@ def train_finetune_curriculum(
         input_text_source = cap_tokens_source
         input_text_target = cap_tokens_target
 
-        if torch.cuda.is_available():
-            input_visuals_source = input_visuals_source.cuda(args.gpuid)
-            input_visuals_target = input_visuals_target.cuda(args.gpuid)
-            input_text_source = input_text_source.cuda(args.gpuid)
-            input_text_target = input_text_target.cuda(args.gpuid)
-
-        torch.cuda.synchronize(device=args.gpuid)
-
-        # 动态调整 filter_ratio 以反映课程学习
-        filter_ratio = min(0.2 + 0.2 * num_cycle_of_target, 1.0)
-
-        clip_loss, adv_loss, filter_ratio = model(
-            input_visuals_source,
-            input_visuals_target,
-            input_text_source,
-            input_text_target,
-            num_cycle_of_target=num_cycle_of_target,  # 传入课程学习阶段
-        )
-        loss = clip_loss + adv_loss
-
-        if grad_clip > 0:
-            clip_grad_norm(params, grad_clip)
+        with step_profiler.phase("h2d"):
+            if torch.cuda.is_available():
+                input_visuals_source = input_visuals_source.cuda(args.gpuid, non_blocking=True)
+                input_visuals_target = input_visuals_target.cuda(args.gpuid, non_blocking=True)
+                input_text_source = input_text_source.cuda(args.gpuid, non_blocking=True)
+                input_text_target = input_text_target.cuda(args.gpuid, non_blocking=True)
+                if target_weights is not None:
+                    target_weights = target_weights.cuda(args.gpuid, non_blocking=True)
+
+        metrics.synchronize(args)
+
+        with step_profiler.phase("forward"):
+            clip_loss, adv_loss, filter_ratio = model(
+                input_visuals_source,
+                input_visuals_target,
+                input_text_source,
+                input_text_target,
+                num_cycle_of_target=num_cycle_of_target,  # 传入课程学习阶段
+                source_preselected=source_preselected,
+                target_weights=target_weights,
+            )
+            loss = clip_loss + adv_loss
 
-        wandb.log({"loss": loss.cpu().data.numpy()})
         optimizer.zero_grad()
-        loss.backward()
-        if args.distributed:
-            loss = utils.reduce_value(args, loss, average=True)
-            mean_loss = (mean_loss * i + loss.detach()) / (i + 1)  # update mean losses
-
-            train_logger.update("Loss", round(mean_loss.item(), 3))
-        else:
-            train_logger.update("Loss_avg", loss.cpu().data.numpy())
+        with step_profiler.phase("backward"):
+            precision.backward(loss)
+        step_metrics.update(loss=loss, loss_clip=clip_loss, loss_adv=adv_loss)
 
-        torch.cuda.synchronize(device=args.gpuid)
-        optimizer.step()
-        torch.cuda.synchronize(device=args.gpuid)
+        with step_profiler.phase("grad_clip"):
+            precision.clip(optimizer, params, grad_clip)
+        with step_profiler.phase("optimizer"):
+            precision.step(optimizer)
+        metrics.synchronize(args)
+        _refresh_next_window(sampler, i, step_profiler)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if i % print_freq == 0 and args.rank == 0:
-            logger.info(
-                "Epoch [{0}][{1}/{2}(source)][{1}/{3}(target)]\t"
-                "Time {batch_time.val:.3f}\t"
-                "{elog}\t".format(
-                    epoch,
-                    i,
-                    len(train_loader_source),
-                    len(train_loader_target),
-                    batch_time=batch_time,
-                    elog=str(train_logger),
+        with step_profiler.phase("logging"):
+            if i % print_freq == 0:
+                step_metrics.flush(epoch=epoch, batch_time=batch_time.val, data_time=data_time.val)
+            if i % print_freq == 0 and args.rank == 0:
+                logger.info(
+                    "Epoch [{0}][{1}/{2}(source)][{1}/{3}(target)]\t"
+                    "Time {batch_time.val:.3f}\t"
+                    "Data {data_time.val:.3f}\t"
+                    "{elog}\t".format(
+                        epoch,
+                        i,
+                        len(train_loader_source),
+                        len(train_loader_target),
+                        batch_time=batch_time,
+                        data_time=data_time,
+                        elog=str(train_logger),
+                    )
                 )
-            )
-            logger.info(f"{num_cycle_of_target}_th cycle of target data")
-            logger.info(f"filter_ratio: {filter_ratio}")
-            utils.get_GPU_usage()
-
-        wandb.log(
-            {
-                "epoch": epoch,
-                "batch_time": batch_time.val,
-            }
-        )
-        train_logger.wandb_log()
+                logger.info(f"{num_cycle_of_target}_th cycle of target data")
+                logger.info(f"filter_ratio: {filter_ratio}")
+        step_profiler.step()
+
+    # Log the steps since the last flush
+    step_metrics.flush(epoch=epoch)
+    # Per-phase timings of the epoch, with --profile
+    step_profiler.summary()
 
 
 def validate(args, val_loader, model):
@@ -575,21 +643,24 @@ def validate(args, val_loader, model):
     input_visual = []  # For image data
     input_text = []  # For text data
     input_seg = []  # For segmentation data
+    input_seg_counts = []  # For the number of segments per image
 
     # Iterate through the validation data loader to get data
     for idx, val_data in enumerate(itertools.islice(val_loader, 3)):
-        images, ids, cap_tokens, segment_img = val_data  # Unpack data
+        images, ids, cap_tokens, segment_img, seg_counts = val_data  # Unpack data
         input_visual.append(images)  # Store image data
         input_text.append(cap_tokens)  # Store text data
         input_seg.append(segment_img)  # Store segmentation data
+        input_seg_counts.append(seg_counts)  # Store segment counts
 
     # Convert data to tensor and concatenate
     input_visual = torch.cat(input_visual, dim=0)
     input_text = torch.cat(input_text, dim=0)
     input_seg = torch.cat(input_seg, dim=0)
+    input_seg_counts = torch.cat(input_seg_counts, dim=0)
 
     # Perform inference using the model
-    d = utils.shard_dis_mine(args, input_visual, input_text, input_seg, model)
+    d = utils.shard_dis_mine(args, input_visual, input_text, input_seg, model, input_seg_counts)
     end = time.time()  # Record end time
 
     print(
@@ -616,7 +687,7 @@ def validate(args, val_loader, model):
     print("")
 
     # Log evaluation results
-    wandb.log(
+    metrics.log(
         {
             "val/r1i": r1i,
             "val/r5i": r5i,
@@ -689,7 +760,7 @@ def validate_without_sam(args, val_loader, model):
     print("")
 
     # Log evaluation results
-    wandb.log(
+    metrics.log(
         {
             "val/r1i": r1i,
             "val/r5i": r5i,
@@ -752,7 +823,7 @@ def validate_finetune(args, val_loader, model):
     )
 
     logger.info("--------------------- end val on training ---------------------")
-    wandb.log(
+    metrics.log(
         {
             "val/r1i": r1i,
             "val/r5i": r5i,
@@ -784,22 +855,25 @@ def validate_test(args, test_loader, model):
     input_visual = []  # For storing image data
     input_text = []  # For storing text data
     input_seg = []  # For storing segmentation data
+    input_seg_counts = []  # For storing the number of segments per image
 
     # Iterate through the test data loader to get data
     # for idx, val_data in enumerate(tqdm(itertools.islice(test_loader, 3))):
     for idx, val_data in enumerate(tqdm(test_loader)):
-        images, ids, cap_tokens, segment_img = val_data  # Unpack data
+        images, ids, cap_tokens, segment_img, seg_counts = val_data  # Unpack data
         input_visual.append(images)  # Store image data
         input_text.append(cap_tokens)  # Store text data
         input_seg.append(segment_img)  # Store segmentation data
+        input_seg_counts.append(seg_counts)  # Store segment counts
 
     # Convert data to tensor and concatenate
     input_visual = torch.cat(input_visual, dim=0)
     input_text = torch.cat(input_text, dim=0)
     input_seg = torch.cat(input_seg, dim=0)
+    input_seg_counts = torch.cat(input_seg_counts, dim=0)
 
     # Perform inference using the model
-    d = utils.shard_dis_mine(args, input_visual, input_text, input_seg, model)
+    d = utils.shard_dis_mine(args, input_visual, input_text, input_seg, model, input_seg_counts)
     end = time.time()  # Record end time
 
     print(
@@ -826,7 +900,7 @@ def validate_test(args, test_loader, model):
     print("")
 
     # Log evaluation results
-    wandb.log(
+    metrics.log(
         {
             "test/r1i": r1i,
             "test/r5i": r5i,
@@ -845,6 +919,80 @@ def validate_test(args, test_loader, model):
     return currscore, all_score
 
 
+# (resolution, drop background patches) of the segment throughput modes, the first one is the reference
+SEGMENT_BENCH_MODES = [(224, False), (160, False), (112, False), (224, True), (160, True), (112, True)]
+
+
+def benchmark_segment_modes(args, test_loader, model, modes=SEGMENT_BENCH_MODES):
+    """
+    Accuracy versus throughput of the segment branch in its throughput modes
+    (reduced resolution and/or dropped background patches).
+
+    For every mode the test segments are encoded with `encode_segments`, timed,
+    and scored by segment-to-text retrieval and by the cosine similarity of the
+    per-image segment embeddings to those of the reference mode.
+
+    Returns:
+        list: One dict of results per mode.
+    """
+    encoder = model.module if hasattr(model, "module") else model
+    encoder.eval()
+
+    input_text, input_seg, input_seg_counts = [], [], []
+    for val_data in tqdm(test_loader):
+        images, ids, cap_tokens, segment_img, seg_counts = val_data
+        input_text.append(cap_tokens)
+        input_seg.append(segment_img)
+        input_seg_counts.append(seg_counts)
+    input_text = torch.cat(input_text, dim=0)
+    input_seg = torch.cat(input_seg, dim=0)
+    input_seg_counts = torch.cat(input_seg_counts, dim=0)
+
+    # Offsets of each image's first segment in the packed segment tensor
+    seg_offsets = torch.cat([input_seg_counts.new_zeros(1), input_seg_counts.cumsum(0)])
+
+    previous = (encoder.segment_resolution, encoder.segment_drop_background)
+    results, reference = [], None
+    with torch.no_grad():
+        text_emb = encoder.encode_text(input_text.cuda(args.gpuid), chunk_size=args.shard_size)
+        for resolution, drop_background in modes:
+            encoder.segment_resolution = resolution
+            encoder.segment_drop_background = drop_background
+
+            seg_emb = []
+            torch.cuda.synchronize()
+            start = time.time()
+            for img_start in range(0, len(input_seg_counts), args.shard_size):
+                img_end = min(img_start + args.shard_size, len(input_seg_counts))
+                segs = input_seg[seg_offsets[img_start]:seg_offsets[img_end]].cuda(args.gpuid, non_blocking=True)
+                counts = input_seg_counts[img_start:img_end]
+                seg_emb.append(encoder.encode_segments(segs, seg_counts=counts, chunk_size=args.shard_size))
+            seg_emb = torch.cat(seg_emb, dim=0)
+            torch.cuda.synchronize()
+            elapsed = time.time() - start
+
+            if reference is None:
+                reference = seg_emb
+            d = encoder.similarity(seg_emb, text_emb).cpu().numpy()
+            (r1i, r5i, r10i, _, _), _ = utils.acc_i2t_mine(d)
+            (r1t, r5t, r10t, _, _), _ = utils.acc_i2t_mine(d.T)
+            result = {
+                "resolution": resolution,
+                "drop_background": drop_background,
+                "segments_per_s": len(input_seg) / elapsed,
+                "mR": (r1i + r5i + r10i + r1t + r5t + r10t) / 6.0,
+                "cos_to_reference": (seg_emb * reference).sum(dim=-1).mean().item(),
+            }
+            results.append(result)
+            print(
+                "segments res {resolution} drop_background {drop_background}: "
+                "{segments_per_s:.1f} segments/s, seg2text mR {mR:.4f}, "
+                "cosine to reference {cos_to_reference:.4f}".format(**result)
+            )
+    encoder.segment_resolution, encoder.segment_drop_background = previous
+    return results
+
+
 def validate_test_without_sam(args, test_loader, model):
     print("")
     print("--------------------- Start testing on training set ---------------------")
@@ -897,7 +1045,7 @@ def validate_test_without_sam(args, test_loader, model):
     print("")
 
     # Log evaluation results
-    wandb.log(
+    metrics.log(
         {
             "test/r1i": r1i,
             "test/r5i": r5i,
@@ -1033,7 +1181,7 @@ def test_mine(args, test_loader, model):
     print("--------------------- end test on training ---------------------")
     print("")
 
-    wandb.log(
+    metrics.log(
         {
             "test/r1i": r1i,
             "test/r5i": r5i,
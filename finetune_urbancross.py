@@ -2,12 +2,16 @@ import os,random,copy
 import shutil
 import torch
 import argparse
-import wandb
 from loguru import logger
 import torch.distributed as dist
 import utils.utils as utils
 import data
 import engine
+from utils import metrics
+from utils.memory_bank import build_memory_bank, set_memory_bank
+from utils.feature_store import build_feature_loaders
+from utils.adapters import checkpoint_weights, load_weights, set_lora
+from utils.precision import build_precision, set_precision
 from utils.vocab import deserialize_vocab
 from layers import urbancross as models
 
@@ -30,11 +34,14 @@ def parser_options():
     parser.add_argument('--eval_step', default=1, type=int, help="the epochs of eval")
     parser.add_argument('--test_step', default=0, type=int, help="the epochs of test")
     parser.add_argument('--batch_size', default=100, type=int, help="Batch train size")
+    parser.add_argument('--memory_bank_size', default=0, type=int, help="Embeddings of previous batches kept as extra negatives of the contrastive loss (0 disables)")
+    parser.add_argument('--memory_bank_max_age', default=0, type=int, help="Only use memory bank entries of the last this many steps (0 keeps all)")
     parser.add_argument('--batch_size_source', default=100, type=int, help="Batch train size")
     parser.add_argument('--batch_size_target', default=100, type=int, help="Batch train size")
     parser.add_argument('--batch_size_val_source', default=100, type=int, help="Batch val size")
     parser.add_argument('--batch_size_val_target', default=100, type=int, help="Batch val size")
     parser.add_argument('--shard_size', default=256, type=int, help="Batch shard size")
+    parser.add_argument('--text_bucket', default=0, type=int, help="Trim caption tokens to the longest caption, rounded up to a multiple of this (0: full 77 token context)")
     parser.add_argument('--workers', default=3, type=int, help="the worker num of dataloader")
     parser.add_argument('-kf', '--k_fold_nums', default=1, type=int, help="the total num of k_flod")
     parser.add_argument('--k_fold_current_num', default=0, type=int, help="current num of k_fold")
@@ -56,15 +63,24 @@ def parser_options():
     # GPU setting
     parser.add_argument('-g', '--gpuid', default=2, type=int, help="which gpu to use")
     parser.add_argument('--distributed', default=False, action='store_true', help='Whether to use parallel computing')
+    parser.add_argument('--cross_rank_negatives', default=False, action='store_true', help="Gather the embeddings of all ranks as negatives of the contrastive losses")
+    parser.add_argument('--local_loss', default=False, action='store_true', help="With --cross_rank_negatives, only compute the loss rows of the local samples")
+    parser.add_argument('--gather_with_grad', default=False, action='store_true', help="With --cross_rank_negatives, backpropagate through the gathered embeddings")
     parser.add_argument('--init_method', default='tcp://localhost:18888', help="init-method")
     parser.add_argument('--rank', default=0, type=int, help='rank of current process')
     parser.add_argument('--world_size', default=2, type=int, help="world size")
     parser.add_argument('--use_mix_precision', default=False, action='store_true', help="whether to use mix precision")
+    parser.add_argument('--precision', default=None, type=str, choices=['fp32', 'fp16', 'bf16'], help="Autocast precision, fp16 adds a GradScaler (default: fp16 on CUDA, fp32 on CPU; --use_mix_precision forces fp16)")
 
     # No set setting
     parser.add_argument('--logger_name', default='logs/', type=str, help="the path of logs")
     parser.add_argument('-p', '--ckpt_save_path', default='checkpoint_fix_data/', type=str, help="the path of checkpoint save")
     parser.add_argument('--print_freq', default=10, type=int, help="Print result frequency")
+    parser.add_argument('--sync_timing', default=False, action='store_true', help="Synchronize the device around each step for exact batch times (stalls the pipeline)")
+    parser.add_argument('--profile', default=False, action='store_true', help="Time the phases of each training step and log a per-epoch summary")
+    parser.add_argument('--profile_dir', default='./profile/', type=str, help="Where the phase summaries and Chrome traces are written")
+    parser.add_argument('--profile_trace_steps', default=0, type=int, help="With --profile, record this many steps per epoch with torch.profiler (0 disables)")
+    parser.add_argument('--profile_trace_wait', default=5, type=int, help="Steps skipped before the torch.profiler window")
     parser.add_argument('--lr', default=2e-4, type=float, help="learning rate")
     parser.add_argument('--lr_update_epoch', default=20, type=int, help="the update epoch of learning rate")
     parser.add_argument('--lr_decay_param', default=0.7, type=float, help="the decay_param of learning rate")
@@ -79,11 +95,34 @@ def parser_options():
     parser.add_argument("--close_wandb", action='store_true',)
     parser.add_argument("--wandb_id", type=str, default=None,)
     parser.add_argument("--wandb_logging_dir", type=str, default='./outputs',)
+    parser.add_argument("--metrics_sinks", type=str, default='jsonl', help="Comma-separated metrics sinks: jsonl, wandb, stdout")
+    parser.add_argument("--resource_interval", type=float, default=10.0, help="Seconds between CPU/memory/GPU samples (0 disables)")
     parser.add_argument("--country", type=str,)
     parser.add_argument("--country_source", type=str, default='Finland',)
     parser.add_argument("--country_target", type=str, default='Finland',)
     parser.add_argument("--load_path", type=str,)
 
+    # Image decoding settings
+    parser.add_argument("--decode_backend", type=str, default='auto', help="Image decode backend (auto|pil|pil_draft|cv2_reduced|torchvision)")
+    parser.add_argument("--decode_tolerance", type=float, default=2.0, help="Max mean abs pixel difference to PIL accepted by auto backend selection")
+
+    # Data prefetching settings
+    parser.add_argument("--prefetch", type=int, default=2, help="Number of batches prefetched to the device in a background thread (0 disables)")
+
+    # Frozen image tower settings
+    parser.add_argument("--frozen_image_tower", action='store_true', help="Freeze the vision tower (but its projection) and train on image features precomputed once")
+    parser.add_argument("--feature_store_dir", type=str, default='./feature_store/', help="Where the memory-mapped image features are stored")
+    parser.add_argument("--feature_views", type=int, default=1, help="Augmented views stored per training image, one is sampled per step")
+
+    # LoRA settings
+    parser.add_argument("--lora_rank", type=int, default=0, help="Fine-tune LoRA adapters of this rank with the base weights frozen, saving adapter-only checkpoints (0: full fine-tuning)")
+    parser.add_argument("--lora_alpha", type=float, default=16.0, help="LoRA scaling numerator (the update is scaled by alpha / rank)")
+    parser.add_argument("--lora_targets", type=str, default='attn,mlp', help="Comma-separated projections given adapters (attn, mlp)")
+
+    # Similarity curriculum sampler settings
+    parser.add_argument("--curriculum_sampler", action='store_true', help="Pre-select target-similar source samples from cached text embeddings before loading them")
+    parser.add_argument("--sampler_refresh_steps", type=int, default=50, help="Steps per window of the sampler's text embedding cache; each window re-encodes the captions of the window after the next")
+
     args = parser.parse_args()
 
     # Generate dataset path
@@ -102,25 +141,8 @@ def parser_options():
 
 
 def main(args):
-    # Set WANDB_DIR environment variable
-    os.environ["WANDB_DIR"] = args.wandb_logging_dir
-    
-    # Generate WANDB_ID if not provided
-    if not args.wandb_id:
-        args.wandb_id = wandb.util.generate_id()
-    
-    # Login to W&B
-    wandb.login(key='d7ec29907ca115fe6d605741c40d09cf563aa0db')
-    logger.info(f"W&B ID: {args.wandb_id}")
-    
-    # Initialize Weights and Biases run
-    wandb.init(
-        project="UrbanCross",
-        config=args,
-        name=args.experiment_name,
-        id=args.wandb_id,
-        mode='dryrun',
-    )
+    # Metrics go to a local JSONL file by default, W&B and stdout are optional (--metrics_sinks)
+    metrics.init_sinks(args)
 
     # Set random seed for reproducibility
     utils.setup_seed(args.seed)
@@ -137,8 +159,22 @@ def main(args):
 
     # Load pretrained model weights
     model = models.factory_with_finetune(args, cuda=True, data_parallel=args.distributed)
-    pretrained_weight = torch.load(args.load_path, map_location='cuda:{}'.format(args.gpuid))
-    model.load_state_dict(pretrained_weight['model'], strict=False)
+    # Autocast (and loss scaling) of the model forward passes
+    precision = build_precision(args)
+    set_precision(model, precision)
+    # Extra negatives of the CLIP loss queued across steps, unless --memory_bank_size is 0
+    set_memory_bank(model, build_memory_bank(args))
+    # Adapter-only checkpoints are loaded on top of their base checkpoint and merged
+    load_weights(model, args.load_path, map_location='cuda:{}'.format(args.gpuid))
+
+    # Frozen image tower: train on pooled image features computed once, instead of
+    # decoding, augmenting and encoding every image at every step
+    if args.frozen_image_tower:
+        train_loader_source, train_loader_target, train_dataset_source, train_dataset_target, val_loader_target, val_dataset_target = build_feature_loaders(
+            args, model, train_dataset_source, train_dataset_target, val_dataset_target
+        )
+    # LoRA adapters in the CLIP towers with the base weights frozen (--lora_rank, 0 is full fine-tuning)
+    set_lora(model, args)
 
     # Print and save model info
     if args.rank == 0:        
@@ -151,6 +187,23 @@ def main(args):
         logger.info(model)
 
     optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=args.lr)
+
+    # Pre-select target-similar source samples from cached text embeddings, so the
+    # discarded ones are never loaded nor encoded
+    paired_loader = None
+    if args.curriculum_sampler:
+        source_tokens = train_dataset_source.clip_tokenizer(train_dataset_source.captions)
+        target_tokens = train_dataset_target.clip_tokenizer(train_dataset_target.captions)
+        paired_loader = data.get_curriculum_loader(
+            args,
+            train_dataset_source,
+            train_dataset_target,
+            refresh_fn=lambda source_indices, target_indices: (
+                utils.encode_text_cache(args, model, source_tokens[source_indices]),
+                utils.encode_text_cache(args, model, target_tokens[target_indices]),
+            ),
+            ratio_fn=models.UrbanCross_finetune.source_ratio,
+        )
     
     # Evaluate on validation set before fine-tuning
     if args.rank == 0:
@@ -169,7 +222,7 @@ def main(args):
         utils.adjust_learning_rate(args, optimizer, epoch)
 
         # train for one epoch
-        engine.train_finetune(args, train_loader_source, train_loader_target, model, optimizer, epoch)
+        engine.train_finetune(args, train_loader_source, train_loader_target, model, optimizer, epoch, paired_loader=paired_loader, precision=precision)
 
         # Evaluate on validation set
         if (epoch + 1) % args.eval_step == 0:
@@ -190,7 +243,7 @@ def main(args):
                 logger.info("=================================================================")
  
                 utils.save_checkpoint(
-                    {'epoch': epoch + 1, 'model': model.state_dict(), 'best_rsum': best_rsum, 'args': args},
+                    {'epoch': epoch + 1, **checkpoint_weights(model, args), 'best_rsum': best_rsum, 'args': args, 'precision': precision.state_dict()},
                     epoch,
                     filename=f'ckpt_{args.model_name}_{epoch}_{best_rsum:.4f}.pth',
                     prefix=args.ckpt_save_path,
@@ -15,12 +15,198 @@ import sys
 
 sys.path.append("..")
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from utils.cross_rank import CrossRank
 
 # MODEL_NAME and PRETRAINED weights configuration
 MODEL_NAME = "ViT-B-16" # "ViT-L-14"
 PRETRAINED = "laion2B-s34B-b88K" # "laion2B-s32B-b82K"
 
-class UrbanCross(nn.Module):
+# How segments are encoded: "copy" (separate vision tower, the original setup),
+# "shared" (the main vision tower) or "lora" (the main tower plus LoRA adapters
+# that are only active for segments)
+SEGMENT_TOWER_MODES = ("copy", "shared", "lora")
+
+# Normalization of the segment transform in data.py, used to recognize the
+# white background that surrounds every masked segment
+SEGMENT_MEAN = (0.485, 0.456, 0.406)
+SEGMENT_STD = (0.229, 0.224, 0.225)
+
+
+class EncoderMixin(object):
+    """
+    Embedding-level interface shared by all UrbanCross variants.
+
+    Unlike `forward`, which always runs both towers and returns a similarity
+    matrix, each tower can be run on its own, optionally in chunks, and the
+    embeddings are returned L2-normalized in the requested dtype. Gradients
+    follow the caller's context, wrap calls in `torch.no_grad()` for caching.
+    """
+
+    @property
+    def segment_visual(self):
+        """Model whose vision tower encodes segments; the main tower when there is no segment tower."""
+        clip_img_seg = getattr(self, "clip_img_seg", None)
+        return clip_img_seg if clip_img_seg is not None else self.clip_model
+
+    def encode_segment_images(self, segment_imgs):
+        """Raw (unnormalized) embeddings of a batch of segments from the segment tower."""
+        if getattr(self, "segment_tower", None) == "lora":
+            with open_clip.lora_enabled(self.clip_model.visual):
+                return self._encode_segment_visual(self.clip_model.visual, segment_imgs)
+        return self._encode_segment_visual(self.segment_visual.visual, segment_imgs)
+
+    def _encode_segment_visual(self, visual, segment_imgs):
+        """
+        Run a vision tower on segments, in the throughput mode set by
+        `segment_resolution` (encode at a lower resolution, with interpolated
+        position embeddings) and `segment_drop_background` (skip the patches
+        that are entirely white background).
+        """
+        resolution = getattr(self, "segment_resolution", None)
+        if resolution and resolution != segment_imgs.shape[-1]:
+            segment_imgs = torch.nn.functional.interpolate(
+                segment_imgs, size=(resolution, resolution), mode="bilinear", align_corners=False, antialias=True
+            )
+        keep_patches = None
+        if getattr(self, "segment_drop_background", False):
+            keep_patches = foreground_patches(segment_imgs, visual.conv1.kernel_size)
+        return visual(segment_imgs, keep_patches=keep_patches)
+
+    def autocast(self):
+        """
+        Autocast context of the forward passes, set by utils.precision.set_precision;
+        CUDA fp16 autocast by default.
+        """
+        precision = getattr(self, "precision", None)
+        if precision is None:
+            return torch.cuda.amp.autocast()
+        return precision.autocast()
+
+    def _encode_chunked(self, encode_fn, x, chunk_size=None):
+        chunks = x.split(chunk_size) if chunk_size else [x]
+        with self.autocast():
+            return torch.cat([encode_fn(chunk) for chunk in chunks], dim=0)
+
+    @staticmethod
+    def _output(emb, normalize, dtype):
+        emb = emb.float()
+        if normalize:
+            emb = l2norm(emb, dim=-1)
+        return emb.to(dtype)
+
+    def encode_image(self, img, normalize=True, chunk_size=None, dtype=torch.float32):
+        """
+        Encode images with the main vision tower.
+
+        Args:
+            img (torch.Tensor): Images [N, 3, 224, 224].
+            normalize (bool, optional): L2-normalize the embeddings. Defaults to True.
+            chunk_size (int, optional): Encode at most this many images per call.
+            dtype (torch.dtype, optional): Output dtype (float32 or float16). Defaults to float32.
+
+        Returns:
+            torch.Tensor: Image embeddings [N, D].
+        """
+        emb = self._encode_chunked(self.clip_model.encode_image, img, chunk_size)
+        return self._output(emb, normalize, dtype)
+
+    def encode_text(self, text, normalize=True, chunk_size=None, dtype=torch.float32):
+        """
+        Encode tokenized captions with the text tower.
+
+        Args:
+            text (torch.Tensor): Caption tokens [N, L].
+            normalize (bool, optional): L2-normalize the embeddings. Defaults to True.
+            chunk_size (int, optional): Encode at most this many captions per call.
+            dtype (torch.dtype, optional): Output dtype (float32 or float16). Defaults to float32.
+
+        Returns:
+            torch.Tensor: Text embeddings [N, D].
+        """
+        emb = self._encode_chunked(self.clip_model.encode_text, text, chunk_size)
+        return self._output(emb, normalize, dtype)
+
+    def project_image_features(self, features, normalize=True):
+        """
+        Project pooled features of the vision tower, computed once with the
+        tower frozen (utils.feature_store), into the embedding space. Only the
+        projection of the tower runs, and is trained, on them.
+
+        Args:
+            features (torch.Tensor): Pooled features [N, pool_dim].
+            normalize (bool, optional): L2-normalize the embeddings. Defaults to True.
+
+        Returns:
+            torch.Tensor: Image embeddings [N, D], as `clip_model.encode_image` returns them.
+        """
+        proj = self.clip_model.visual.proj
+        emb = features.to(proj.dtype) @ proj if proj is not None else features
+        return torch.nn.functional.normalize(emb, dim=-1) if normalize else emb
+
+    def clip_image_features(self, img):
+        """Normalized image embeddings of images [N, 3, H, W] or of stored pooled features [N, pool_dim]."""
+        if img.dim() == 2:
+            return self.project_image_features(img)
+        return self.clip_model.encode_image(img, normalize=True)
+
+    def clip_forward(self, img, text):
+        """`clip_model(img, text)`, where `img` may also be stored pooled features that skip the vision tower."""
+        if img.dim() == 2:
+            return {
+                "image_features": self.project_image_features(img),
+                "text_features": self.clip_model.encode_text(text, normalize=True),
+            }
+        return self.clip_model(img, text)
+
+    def encode_segments(self, segment_imgs, seg_mask=None, seg_counts=None, normalize=True, chunk_size=None, dtype=torch.float32):
+        """
+        Encode the segments of each sample and average them, ignoring padding.
+
+        Args:
+            segment_imgs (torch.Tensor): Padded segments [bs, num_seg, 3, 224, 224],
+                or packed segments [sum(seg_counts), 3, 224, 224].
+            seg_mask (torch.Tensor, optional): For padded segments, True for real segments [bs, num_seg].
+                Defaults to all segments being real.
+            seg_counts (torch.Tensor, optional): For packed segments, number of segments of each sample.
+            normalize (bool, optional): L2-normalize the embeddings. Defaults to True.
+            chunk_size (int, optional): Encode at most this many segments per call.
+            dtype (torch.dtype, optional): Output dtype (float32 or float16). Defaults to float32.
+
+        Returns:
+            torch.Tensor: Mean segment embedding of each sample [bs, D]; zero for samples without segments.
+        """
+        if segment_imgs.dim() == 5:
+            if seg_mask is None:
+                seg_mask = torch.ones(segment_imgs.shape[:2], dtype=torch.bool, device=segment_imgs.device)
+            seg_mask = seg_mask.to(segment_imgs.device, torch.bool)
+            seg_counts = seg_mask.sum(dim=1)
+            segment_imgs = segment_imgs[seg_mask]
+        elif seg_counts is None:
+            raise ValueError("seg_counts is required for packed segments")
+
+        if segment_imgs.size(0) > 0:
+            seg_emb = self._encode_chunked(self.encode_segment_images, segment_imgs, chunk_size)
+        else:
+            seg_emb = torch.zeros(0, self.clip_model.visual.output_dim, device=segment_imgs.device)
+        emb = segment_mean(seg_emb.float(), seg_counts)
+        return self._output(emb, normalize, dtype)
+
+    @staticmethod
+    def similarity(emb_a, emb_b):
+        """
+        Cosine similarity between all pairs of two sets of embeddings.
+
+        Args:
+            emb_a (torch.Tensor): Embeddings [N, D].
+            emb_b (torch.Tensor): Embeddings [M, D].
+
+        Returns:
+            torch.Tensor: Similarities [N, M] in float32.
+        """
+        return cosine_sim(emb_a.float(), emb_b.float())
+
+
+class UrbanCross(EncoderMixin, nn.Module):
     def __init__(self, args):
         """
         Initialize the UrbanCross model.
@@ -35,49 +221,72 @@ class UrbanCross(nn.Module):
             pretrained=PRETRAINED,  # Pre-trained weights
             output_dict=True,  # Return output as a dictionary
         )
-        # Create a copy of the OpenCLIP model for segmented images
-        self.clip_img_seg = copy.deepcopy(self.clip_model)
-        # Remove the transformer layer from the copied model for image segmentation
-        del self.clip_img_seg.transformer
-
-    def forward(self, img, text, segment_imgs):
+        self.segment_tower = getattr(args, "segment_tower", "copy")
+        if self.segment_tower == "copy":
+            # Create a copy of the OpenCLIP model for segmented images
+            self.clip_img_seg = copy.deepcopy(self.clip_model)
+            # Remove the transformer layer from the copied model for image segmentation
+            del self.clip_img_seg.transformer
+        elif self.segment_tower == "lora":
+            # Share the vision tower; the adapters are switched on only for segments
+            open_clip.add_lora(self.clip_model.visual, rank=getattr(args, "segment_lora_rank", 8))
+            open_clip.set_lora_enabled(self.clip_model.visual, False)
+        elif self.segment_tower != "shared":
+            raise ValueError(
+                f"Unknown segment tower mode '{self.segment_tower}', expected one of {SEGMENT_TOWER_MODES}"
+            )
+        # Segment throughput mode, see EncoderMixin._encode_segment_visual
+        self.segment_resolution = getattr(args, "segment_resolution", 224)
+        self.segment_drop_background = getattr(args, "segment_drop_background", False)
+
+    def forward(self, img, text, segment_imgs, seg_counts=None, return_embeddings=False):
         """
         Forward pass of the UrbanCross model.
 
         Args:
             img (torch.Tensor): Input image tensor.
             text (torch.Tensor): Input text tensor.
-            segment_imgs (torch.Tensor): Input segmented images tensor.
+            segment_imgs (torch.Tensor): Packed segments [sum(seg_counts), 3, 224, 224],
+                or padded segments [bs, num_seg, 3, 224, 224] when seg_counts is None.
+            seg_counts (torch.Tensor, optional): Number of real segments of each sample.
+            return_embeddings (bool, optional): Also return the embeddings, e.g. for a memory bank.
 
         Returns:
             torch.Tensor: Similarity scores between image and text.
             torch.Tensor: Similarity scores between segmented images and text.
+            dict: With return_embeddings, "image", "segments" and "text" embeddings.
         """
-        with torch.cuda.amp.autocast():
+        with self.autocast():
             # Get features for the input image and text
             clip_model_out = self.clip_model(img, text)
             img_emb = clip_model_out["image_features"]
             text_emb = clip_model_out["text_features"]
 
-            # Flatten the segment_imgs tensor for batch processing
-            bs, num_seg, _, _, _ = segment_imgs.shape
-            segment_imgs_reshaped = segment_imgs.view(bs * num_seg, 3, 224, 224)
-            
-            # Encode segmented images to get their embeddings
-            img_seg_emb = self.clip_img_seg.encode_image(segment_imgs_reshaped)
-            img_seg_emb = img_seg_emb.view(bs, num_seg, -1)
-            # Calculate the feature mean of each batch
-            img_seg_emb = img_seg_emb.mean(dim=1)
+            if seg_counts is None:
+                # Padded layout: flatten the segment_imgs tensor for batch processing
+                bs, num_seg, _, _, _ = segment_imgs.shape
+                segment_imgs = segment_imgs.view(bs * num_seg, 3, 224, 224)
+                seg_counts = torch.full((bs,), num_seg, dtype=torch.long, device=segment_imgs.device)
+
+            # Encode only the real segments to get their embeddings
+            if segment_imgs.size(0) > 0:
+                img_seg_emb = self.encode_segment_images(segment_imgs)
+            else:
+                img_seg_emb = img_emb.new_zeros(0, img_emb.size(-1))
+            # Calculate the feature mean over the real segments of each sample
+            img_seg_emb = segment_mean(img_seg_emb, seg_counts)
 
             # Calculate cosine similarity between image and text embeddings
             sim_img2text = cosine_sim(img_emb, text_emb)
             # Calculate cosine similarity between segmented images and text embeddings
             sim_seg2text = cosine_sim(img_seg_emb, text_emb)
 
+        if return_embeddings:
+            return sim_img2text, sim_seg2text, {"image": img_emb, "segments": img_seg_emb, "text": text_emb}
         return sim_img2text, sim_seg2text
     
 
-class UrbanCross_without_sam(nn.Module):
+class UrbanCross_without_sam(EncoderMixin, nn.Module):
     def __init__(self, args):
         """
         Initialize the UrbanCross model without the segment-anything model (SAM).
@@ -93,18 +302,20 @@ class UrbanCross_without_sam(nn.Module):
             output_dict=True,
         )
 
-    def forward(self, img, text):
+    def forward(self, img, text, return_embeddings=False):
         """
         Forward pass of the UrbanCross model.
 
         Args:
             img (torch.Tensor): Input image tensor.
             text (torch.Tensor): Input text tensor.
+            return_embeddings (bool, optional): Also return the embeddings, e.g. for a memory bank.
 
         Returns:
             torch.Tensor: Similarity scores between image and text.
+            dict: With return_embeddings, "image" and "text" embeddings.
         """
-        with torch.cuda.amp.autocast():
+        with self.autocast():
             # Get features for the input image and text
             clip_model_out = self.clip_model(img, text)
             img_emb = clip_model_out["image_features"]
@@ -113,6 +324,8 @@ class UrbanCross_without_sam(nn.Module):
             # Calculate cosine similarity between image and text embeddings
             sim_img2text = cosine_sim(img_emb, text_emb)
 
+        if return_embeddings:
+            return sim_img2text, {"image": img_emb, "text": text_emb}
         return sim_img2text
 
 
@@ -197,7 +410,7 @@ class TripletLoss(nn.Module):
         return loss
 
 
-class UrbanCross_finetune(nn.Module):
+class UrbanCross_finetune(EncoderMixin, nn.Module):
     def __init__(self, args):
         """
         Initialize the UrbanCross_finetune model.
@@ -212,11 +425,9 @@ class UrbanCross_finetune(nn.Module):
             pretrained=PRETRAINED,
             output_dict=True,
         )
-        # Create a copy of the OpenCLIP model for segmented images
-        self.clip_img_seg = copy.deepcopy(self.clip_model)
-        # Remove the transformer layer from the copied model
-        del self.clip_img_seg.transformer
-       
+        # No segment tower: fine-tuning never encodes segments, and the pretrained
+        # clip_img_seg weights are skipped when loading with strict=False
+
         # Define the discriminator network
         self.discriminator = nn.Sequential(
             nn.Linear(768, 768),
@@ -231,16 +442,28 @@ class UrbanCross_finetune(nn.Module):
 
         # Initialize the CLIP loss module
         self.clip_loss = open_clip.ClipLoss()
-
-    def forward(self, img_source, img_target, text_source, text_target, num_cycle_of_target=0, val=False):
+        # Cross-batch negatives of the CLIP loss, set by utils.memory_bank.set_memory_bank
+        self.memory_bank = None
+        # Negatives from the batches of all ranks with --cross_rank_negatives
+        self.cross_rank = CrossRank(args)
+
+    @staticmethod
+    def source_ratio(num_cycle_of_target):
+        """Fraction of the source batch kept for the target batch: a constant 20%."""
+        return 0.2
+
+    def forward(
+        self, img_source, img_target, text_source, text_target, num_cycle_of_target=0, source_preselected=False,
+        target_weights=None, val=False,
+    ):
         if val:
             return self.forward_val(img_target, text_target)
         
-        ratio = 0.2
+        ratio = self.source_ratio(num_cycle_of_target)
 
-        with torch.cuda.amp.autocast():
-            clip_model_out_source = self.clip_model(img_source, text_source)
-            clip_model_out_target = self.clip_model(img_target, text_target)
+        with self.autocast():
+            clip_model_out_source = self.clip_forward(img_source, text_source)
+            clip_model_out_target = self.clip_forward(img_target, text_target)
             
             img_emb_source = clip_model_out_source['image_features']
             img_emb_target = clip_model_out_target['image_features']
@@ -251,17 +474,20 @@ class UrbanCross_finetune(nn.Module):
             W1 = cosine_sim(text_emb_target, text_emb_source)
             W1_mean = W1.mean(dim=0)
             batchsize = img_emb_source.shape[0]
-            selected_batchsize = int(batchsize * ratio)
-            # Sort W1 along each row, from large to small
-            sorted_W1, _ = torch.sort(W1, dim=1, descending=True)
-            W2 = sorted_W1[:, :selected_batchsize]
+            # With source_preselected the sampler has already kept the top `ratio` rows
+            selected_batchsize = batchsize if source_preselected else int(batchsize * ratio)
             _, sorted_W1_mean_index = torch.sort(W1_mean, descending=True)
 
             img_emb_source_filtered = img_emb_source[sorted_W1_mean_index[:selected_batchsize]]
             text_emb_source_filtered = text_emb_source[sorted_W1_mean_index[:selected_batchsize]]
 
-            # Sum W_2 over the second dimension to get a vector
-            W2 = torch.sum(W2, dim=1)
+            if target_weights is not None:
+                # Summed over the whole candidate batch by the sampler, from its text embedding cache
+                W2 = target_weights.to(W1.dtype)
+            else:
+                # Sort W1 along each row, from large to small, and sum the top W_2 over the second dimension
+                sorted_W1, _ = torch.sort(W1, dim=1, descending=True)
+                W2 = torch.sum(sorted_W1[:, :selected_batchsize], dim=1)
 
             # Scale W_tilde_2 to range [0, 1]
             W2_min = torch.min(W2)
@@ -286,17 +512,25 @@ class UrbanCross_finetune(nn.Module):
                                     )
             adv_loss = adv_loss_img + adv_loss_text
             
-            clip_loss = self.clip_loss(img_emb_source_filtered, 
-                                    text_emb_source_filtered,
-                                    logit_scale=1.0
-                                    )
+            if self.memory_bank is not None or self.cross_rank.enabled:
+                # Source pairs of all ranks and the queued ones of the previous steps as extra negatives
+                clip_loss = self.cross_rank.clip_loss(
+                    img_emb_source_filtered, text_emb_source_filtered, logit_scale=1.0, memory_bank=self.memory_bank
+                )
+                if self.memory_bank is not None:
+                    self.memory_bank.enqueue(image=img_emb_source_filtered, text=text_emb_source_filtered)
+            else:
+                clip_loss = self.clip_loss(img_emb_source_filtered, 
+                                        text_emb_source_filtered,
+                                        logit_scale=1.0
+                                        )
         return clip_loss, adv_loss, ratio
     
     
     def forward_val(self, img_target, text_target):
     
-        with torch.cuda.amp.autocast():
-            clip_model_out = self.clip_model(img_target, text_target)
+        with self.autocast():
+            clip_model_out = self.clip_forward(img_target, text_target)
     
             
             img_emb = clip_model_out['image_features']
@@ -307,7 +541,7 @@ class UrbanCross_finetune(nn.Module):
         return sim_img2text
     
 
-class UrbanCross_finetune_curriculum(nn.Module):
+class UrbanCross_finetune_curriculum(EncoderMixin, nn.Module):
     def __init__(self, args):
         super().__init__()
         self.clip_model, _, transform = open_clip.create_model_and_transforms(
@@ -316,8 +550,7 @@ class UrbanCross_finetune_curriculum(nn.Module):
             output_dict=True,
         )
 
-        self.clip_img_seg = copy.deepcopy(self.clip_model)
-        del self.clip_img_seg.transformer
+        # No segment tower, segments are not used in curriculum fine-tuning
         self.discriminator = nn.Sequential(
             nn.Linear(768, 768),
             nn.ReLU(),
@@ -330,44 +563,70 @@ class UrbanCross_finetune_curriculum(nn.Module):
         self.adv_loss = AdversarialLoss()
         self.clip_loss = open_clip.ClipLoss()
         self.triplet_loss = TripletLoss(initial_margin=0.5, margin_increase_per_cycle=0.2, max_margin=1.5)
-
-    def forward(self, img_source, img_target, text_source, text_target, num_cycle_of_target=0, val=False):
+        # Hard negatives searched among the target images of all ranks with --cross_rank_negatives
+        self.cross_rank = CrossRank(args)
+        # Select the source samples from the captions before running the image tower,
+        # so only the selected source images are encoded (--full_forward encodes all of them)
+        self.staged_forward = not getattr(args, "full_forward", False)
+
+    @staticmethod
+    def source_ratio(num_cycle_of_target):
+        """Fraction of the source batch kept for the target batch: 20% in cycle 0, +20% per cycle."""
+        return min(0.2 + 0.2 * num_cycle_of_target, 1.0)
+
+    def forward(
+        self, img_source, img_target, text_source, text_target, num_cycle_of_target=0, source_preselected=False,
+        target_weights=None, val=False,
+    ):
         if val:
             return self.forward_val(img_target, text_target)
-        ratio = 0.2
-    
-        # Progressive ratio increase per cycle (start with 20%, increase by 20% each cycle)
-        ratio = min(0.2 + 0.2 * num_cycle_of_target, 1.0)
 
-        with torch.cuda.amp.autocast():
-            clip_model_out_source = self.clip_model(img_source, text_source)
-            clip_model_out_target = self.clip_model(img_target, text_target)
-            
-            img_emb_source = clip_model_out_source['image_features']
-            img_emb_target = clip_model_out_target['image_features']
-            
-            text_emb_source = clip_model_out_source['text_features']
-            text_emb_target = clip_model_out_target['text_features']
+        # Progressive ratio increase per cycle (start with 20%, increase by 20% each cycle)
+        ratio = self.source_ratio(num_cycle_of_target)
+
+        with self.autocast():
+            if self.staged_forward:
+                # The selection only depends on the captions: encode the text first
+                text_emb_source = self.clip_model.encode_text(text_source, normalize=True)
+                text_emb_target = self.clip_model.encode_text(text_target, normalize=True)
+            else:
+                clip_model_out_source = self.clip_forward(img_source, text_source)
+                clip_model_out_target = self.clip_forward(img_target, text_target)
+
+                img_emb_source = clip_model_out_source['image_features']
+                img_emb_target = clip_model_out_target['image_features']
+
+                text_emb_source = clip_model_out_source['text_features']
+                text_emb_target = clip_model_out_target['text_features']
             
             # Calculate similarity between text embeddings
             W1 = cosine_sim(text_emb_target, text_emb_source)
             W1_mean = W1.mean(dim=0)
 
-            batchsize = img_emb_source.shape[0]
-            selected_batchsize = int(batchsize * ratio)
+            batchsize = text_emb_source.shape[0]
+            # With source_preselected the sampler has already kept the top `ratio` rows
+            selected_batchsize = batchsize if source_preselected else int(batchsize * ratio)
    
-            # Sort W1 along each row, from large to small (select more similar samples)
-            sorted_W1, _ = torch.sort(W1, dim=1, descending=True)
-          
             # Progressive source sampling: expand selected samples as num_cycle_of_target increases
-            W2 = sorted_W1[:, :selected_batchsize]
             _, sorted_W1_mean_index = torch.sort(W1_mean, descending=True)
-
-            img_emb_source_filtered = img_emb_source[sorted_W1_mean_index[:selected_batchsize]]
-            text_emb_source_filtered = text_emb_source[sorted_W1_mean_index[:selected_batchsize]]
-
-            # Sum W_2 over the second dimension to get a vector for weighting
-            W2 = torch.sum(W2, dim=1)
+            selected = sorted_W1_mean_index[:selected_batchsize]
+
+            if self.staged_forward:
+                # One image tower pass over the selected source images and the target images
+                img_emb = self.clip_image_features(torch.cat([img_source[selected], img_target]))
+                img_emb_source_filtered, img_emb_target = img_emb.split([selected_batchsize, img_target.size(0)])
+            else:
+                img_emb_source_filtered = img_emb_source[selected]
+            text_emb_source_filtered = text_emb_source[selected]
+
+            if target_weights is not None:
+                # Summed over the whole candidate batch by the sampler, from its text embedding cache
+                W2 = target_weights.to(W1.dtype)
+            else:
+                # Sort W1 along each row, from large to small (select more similar samples),
+                # and sum the top W_2 over the second dimension to get a vector for weighting
+                sorted_W1, _ = torch.sort(W1, dim=1, descending=True)
+                W2 = torch.sum(sorted_W1[:, :selected_batchsize], dim=1)
 
             # Scale W_2 to range [0, 1]
             W2_min = torch.min(W2)
@@ -378,7 +637,7 @@ class UrbanCross_finetune_curriculum(nn.Module):
             W2 = W2 / torch.sum(W2)
             
             # Select hard negatives based on cosine similarity
-            negatives = img_emb_target  # target domain embeddings as candidates for negatives
+            negatives = self.cross_rank.gather_negatives(img_emb_target)  # target domain embeddings (of all ranks) as candidates for negatives
             similarity_matrix = cosine_sim(img_emb_source_filtered, negatives)
             # Find the most similar (hard) negatives
             hard_negatives_idx = torch.argmax(similarity_matrix, dim=1)
@@ -406,8 +665,8 @@ class UrbanCross_finetune_curriculum(nn.Module):
         return triplet_loss, adv_loss, ratio
        
     def forward_val(self, img_target, text_target):
-        with torch.cuda.amp.autocast():
-            clip_model_out = self.clip_model(img_target, text_target)
+        with self.autocast():
+            clip_model_out = self.clip_forward(img_target, text_target)
             
             img_emb = clip_model_out['image_features']
             text_emb = clip_model_out['text_features']
@@ -417,7 +676,7 @@ class UrbanCross_finetune_curriculum(nn.Module):
         return sim_img2text
         
     
-class UrbanCross_zeroshot(nn.Module):
+class UrbanCross_zeroshot(EncoderMixin, nn.Module):
     def __init__(self, args):
         super().__init__()
         self.clip_model, _, transform = open_clip.create_model_and_transforms(
@@ -425,11 +684,10 @@ class UrbanCross_zeroshot(nn.Module):
             pretrained=PRETRAINED,
             output_dict=True,
         )
-        self.clip_img_seg = copy.deepcopy(self.clip_model)
-        del self.clip_img_seg.transformer
+        # No segment tower, zero-shot retrieval only uses the image and text towers
 
     def forward(self, img, text):
-        with torch.cuda.amp.autocast():
+        with self.autocast():
             clip_model_out = self.clip_model(img, text)
             
             img_emb = clip_model_out['image_features']
@@ -475,6 +733,61 @@ def cosine_sim(im, s):
     return w12
 
 
+def segment_mean(seg_emb, seg_counts):
+    """
+    Average packed segment embeddings per sample, ignoring padding.
+
+    Args:
+        seg_emb (torch.Tensor): Packed segment embeddings [sum(seg_counts), D], sample after sample.
+        seg_counts (torch.Tensor): Number of segments of each sample [bs].
+
+    Returns:
+        torch.Tensor: Mean segment embedding of each sample [bs, D]; zero for samples without segments.
+    """
+    seg_counts = seg_counts.to(seg_emb.device)
+    # The output size is known on the host: without it the device counts are read back (a sync)
+    sample_idx = torch.repeat_interleave(
+        torch.arange(seg_counts.size(0), device=seg_emb.device), seg_counts, output_size=seg_emb.size(0)
+    )
+    summed = seg_emb.new_zeros(seg_counts.size(0), seg_emb.size(-1))
+    summed = summed.index_add(0, sample_idx, seg_emb)
+    return summed / seg_counts.clamp(min=1).unsqueeze(1).to(summed.dtype)
+
+
+def foreground_patches(segment_imgs, patch_size, tol=0.05):
+    """
+    Indices of the patches of each segment that are not entirely white
+    background, for dropping the background tokens before the transformer.
+
+    All segments of the batch keep the same number of patches, the largest
+    foreground count, so segments with fewer foreground patches also keep
+    some background ones. The foreground patches come first, in raster order.
+
+    Only white counts as background. This matches the segment transforms in
+    data.py (resize and normalize, no augmentation). A rotation there would need
+    fill=255; the default black corners would be kept as foreground. The
+    RandomRotation of the parent image transform does not touch the segments.
+
+    Args:
+        segment_imgs (torch.Tensor): Normalized segments [N, 3, H, W].
+        patch_size (tuple): Patch size of the vision tower.
+        tol (float, optional): Tolerance below white, in [0, 1] pixel units.
+
+    Returns:
+        torch.Tensor: Patch indices [N, num_keep].
+    """
+    mean = segment_imgs.new_tensor(SEGMENT_MEAN).view(1, 3, 1, 1)
+    std = segment_imgs.new_tensor(SEGMENT_STD).view(1, 3, 1, 1)
+    pixels = segment_imgs * std + mean  # back to [0, 1]
+    # a patch is background when its darkest value is white
+    darkest = -torch.nn.functional.max_pool2d(-pixels.amin(dim=1, keepdim=True), patch_size)
+    background = (darkest > 1.0 - tol).flatten(1)  # [N, grid_h * grid_w]
+
+    num_keep = max(1, int((~background).sum(dim=1).max()))
+    order = torch.argsort(background.to(torch.uint8), dim=1, stable=True)
+    return order[:, :num_keep]
+
+
 def clones(module, N):
     """
     Produce N identical layers.
@@ -0,0 +1,114 @@
+""" Low-rank adapters (LoRA) for the transformer blocks.
+
+The adapters are registered as weight parametrizations, W -> W + B @ A * alpha / rank,
+so they also apply to `nn.MultiheadAttention`, which reads its projection weights
+directly instead of calling its Linear submodules.
+"""
+import math
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+import torch
+from torch import nn
+from torch.nn.utils import parametrize
+
+from .transformer import Attention
+
+LORA_TARGETS = ("attn", "mlp")
+
+
+class LoRAParametrization(nn.Module):
+    def __init__(self, fan_out: int, fan_in: int, rank: int = 8, alpha: float = 16.):
+        super().__init__()
+        self.lora_A = nn.Parameter(torch.empty(rank, fan_in))
+        self.lora_B = nn.Parameter(torch.zeros(fan_out, rank))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scaling = alpha / rank
+        self.enabled = True
+
+    def forward(self, weight: torch.Tensor):
+        if not self.enabled:
+            return weight
+        return weight + (self.lora_B @ self.lora_A).to(weight.dtype) * self.scaling
+
+
+def _lora_weights(block: nn.Module, targets: Iterable[str]):
+    """(module, parameter name) pairs of the projections of one residual block."""
+    weights = []
+    if "attn" in targets:
+        attn = block.attn
+        if isinstance(attn, (nn.MultiheadAttention, Attention)):
+            weights.append((attn, "in_proj_weight"))
+        weights.append((attn.out_proj, "weight"))
+    if "mlp" in targets:
+        weights.append((block.mlp.c_fc, "weight"))
+        weights.append((block.mlp.c_proj, "weight"))
+    return weights
+
+
+def add_lora(
+        model: nn.Module,
+        rank: int = 8,
+        alpha: float = 16.,
+        targets: Iterable[str] = LORA_TARGETS,
+) -> List[LoRAParametrization]:
+    """
+    Inject LoRA adapters into the attention and/or MLP projections of every
+    residual block found in `model` (a CLIP model, or one of its towers).
+
+    Returns:
+        The added parametrizations.
+    """
+    added = []
+    blocks = [m for m in model.modules() if hasattr(m, "attn") and hasattr(m, "mlp")]
+    for block in blocks:
+        for module, name in _lora_weights(block, targets):
+            if parametrize.is_parametrized(module, name):
+                continue
+            weight = getattr(module, name)
+            lora = LoRAParametrization(weight.shape[0], weight.shape[1], rank=rank, alpha=alpha)
+            lora.to(device=weight.device, dtype=torch.float32)
+            parametrize.register_parametrization(module, name, lora)
+            added.append(lora)
+    return added
+
+
+def lora_modules(model: nn.Module) -> List[LoRAParametrization]:
+    return [m for m in model.modules() if isinstance(m, LoRAParametrization)]
+
+
+def set_lora_enabled(model: nn.Module, enabled: bool = True):
+    for m in lora_modules(model):
+        m.enabled = enabled
+
+
+@contextmanager
+def lora_enabled(model: nn.Module, enabled: bool = True):
+    """Temporarily switch the adapters of `model` on (or off)."""
+    modules = lora_modules(model)
+    previous = [m.enabled for m in modules]
+    for m in modules:
+        m.enabled = enabled
+    try:
+        yield
+    finally:
+        for m, state in zip(modules, previous):
+            m.enabled = state
+
+
+def mark_only_lora_as_trainable(model: nn.Module):
+    for name, param in model.named_parameters():
+        param.requires_grad = "lora_" in name
+
+
+def lora_state_dict(model: nn.Module) -> Dict[str, torch.Tensor]:
+    return {k: v for k, v in model.state_dict().items() if "lora_" in k}
+
+
+def merge_lora(model: nn.Module):
+    """Fold the enabled adapters into the base weights and remove the parametrizations."""
+    for module in list(model.modules()):
+        if not parametrize.is_parametrized(module):
+            continue
+        for name in list(module.parametrizations.keys()):
+            parametrize.remove_parametrizations(module, name, leave_parametrized=True)
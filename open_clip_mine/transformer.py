@@ -61,16 +61,8 @@ class PatchDropout(nn.Module):
         if not self.training or self.prob == 0.:
             return x
 
-        if self.exclude_first_token:
-            cls_tokens, x = x[:, :1], x[:, 1:]
-        else:
-            cls_tokens = torch.jit.annotate(torch.Tensor, x[:, :1])
-
         batch = x.size()[0]
-        num_tokens = x.size()[1]
-
-        batch_indices = torch.arange(batch)
-        batch_indices = batch_indices[..., None]
+        num_tokens = x.size()[1] - 1 if self.exclude_first_token else x.size()[1]
 
         keep_prob = 1 - self.prob
         num_patches_keep = max(1, int(num_tokens * keep_prob))
@@ -78,15 +70,97 @@ class PatchDropout(nn.Module):
         rand = torch.randn(batch, num_tokens)
         patch_indices_keep = rand.topk(num_patches_keep, dim=-1).indices
 
-        x = x[batch_indices, patch_indices_keep]
+        return self.keep_patches(x, patch_indices_keep, self.exclude_first_token)
+
+    @staticmethod
+    def keep_patches(x, patch_indices_keep, exclude_first_token: bool = True):
+        """Keep the patch tokens `patch_indices_keep` [batch, num_keep] of x [batch, tokens, width]."""
+        if exclude_first_token:
+            cls_tokens, x = x[:, :1], x[:, 1:]
+        else:
+            cls_tokens = torch.jit.annotate(torch.Tensor, x[:, :1])
+
+        batch_indices = torch.arange(x.size()[0], device=x.device)
+        batch_indices = batch_indices[..., None]
 
-        if self.exclude_first_token:
+        x = x[batch_indices, patch_indices_keep.to(x.device)]
+
+        if exclude_first_token:
             x = torch.cat((cls_tokens, x), dim=1)
 
         return x
 
 
+# Attention goes through F.scaled_dot_product_attention when available,
+# toggled per module with set_fused_attn (e.g. for parity checks)
+FUSED_ATTN = hasattr(F, "scaled_dot_product_attention")
+
+_causal_masks = {}
+
+
+def attn_mask_dtype(cast_dtype: torch.dtype, device=None):
+    """
+    Dtype the attention sees the mask in: the autocast dtype when autocast is
+    enabled on `device`, so a cached mask is not re-cast in every block.
+    """
+    device_type = torch.device(device).type if device is not None else "cpu"
+    if hasattr(torch, "get_autocast_dtype"):
+        if torch.is_autocast_enabled(device_type):
+            return torch.get_autocast_dtype(device_type)
+    elif device_type == "cuda" and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    elif device_type == "cpu" and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return cast_dtype
+
+
+def causal_attn_mask(length: int, dtype: torch.dtype = torch.float32, device=None):
+    """Additive causal mask [length, length], cached per (length, dtype, device)."""
+    key = (length, dtype, torch.device(device) if device is not None else torch.device("cpu"))
+    mask = _causal_masks.get(key)
+    if mask is None:
+        mask = torch.full((length, length), float("-inf"), dtype=dtype, device=key[2]).triu_(1)
+        _causal_masks[key] = mask
+    return mask
+
+
+def _sdpa_mask(attn_mask: Optional[torch.Tensor], dtype: torch.dtype, batch_size: int, num_heads: int):
+    """Adapt an open_clip attention mask to the conventions of F.scaled_dot_product_attention."""
+    if attn_mask is None:
+        return None
+    if attn_mask.dtype == torch.bool:
+        # open_clip masks out the True positions, SDPA keeps them
+        attn_mask = ~attn_mask
+    elif attn_mask.dtype != dtype:
+        attn_mask = attn_mask.to(dtype)
+    if attn_mask.dim() == 3:
+        # [N * heads, L, S] as built for nn.MultiheadAttention
+        attn_mask = attn_mask.view(batch_size, num_heads, attn_mask.shape[-2], attn_mask.shape[-1])
+    return attn_mask
+
+
+def _sdpa(q, k, v, num_heads: int, attn_mask: Optional[torch.Tensor] = None, dropout_p: float = 0.):
+    """Multi-head attention on LND inputs, returns LND."""
+    L, N, C = q.shape
+    S = k.shape[0]
+    q = q.view(L, N, num_heads, -1).permute(1, 2, 0, 3)
+    k = k.view(S, N, num_heads, -1).permute(1, 2, 0, 3)
+    v = v.view(S, N, num_heads, -1).permute(1, 2, 0, 3)
+    attn_mask = _sdpa_mask(attn_mask, q.dtype, N, num_heads)
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    return x.permute(2, 0, 1, 3).reshape(L, N, C)
+
+
+def set_fused_attn(model: nn.Module, enable: bool = True):
+    """Switch the fused attention path of every attention block of `model`."""
+    for m in model.modules():
+        if hasattr(m, "fused_attn"):
+            m.fused_attn = enable and FUSED_ATTN
+
+
 class Attention(nn.Module):
+    fused_attn: torch.jit.Final[bool]
+
     def __init__(
             self,
             dim,
@@ -125,10 +199,19 @@ class Attention(nn.Module):
             self.head_scale = None
         self.out_proj = nn.Linear(dim, dim)
         self.out_drop = nn.Dropout(proj_drop)
+        # scaled cosine attention and head scaling are not expressible with SDPA
+        self.fused_attn = FUSED_ATTN and not scaled_cosine and not scale_heads
 
     def forward(self, x, attn_mask: Optional[torch.Tensor] = None):
         L, N, C = x.shape
         q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        if self.fused_attn and self.logit_scale is None and self.head_scale is None:
+            dropout_p = self.attn_drop.p if self.training else 0.
+            x = _sdpa(q, k, v, self.num_heads, attn_mask=attn_mask, dropout_p=dropout_p)
+            x = self.out_proj(x)
+            x = self.out_drop(x)
+            return x
+
         q = q.contiguous().view(L, N * self.num_heads, -1).transpose(0, 1)
         k = k.contiguous().view(L, N * self.num_heads, -1).transpose(0, 1)
         v = v.contiguous().view(L, N * self.num_heads, -1).transpose(0, 1)
@@ -154,8 +237,8 @@ class Attention(nn.Module):
 
         x = torch.bmm(attn, v)
         if self.head_scale is not None:
-            x = x.view(N, self.num_heads, L, C) * self.head_scale
-            x = x.view(-1, L, C)
+            x = x.view(N, self.num_heads, L, self.head_dim) * self.head_scale
+            x = x.view(-1, L, self.head_dim)
         x = x.transpose(0, 1).reshape(L, N, C)
         x = self.out_proj(x)
         x = self.out_drop(x)
@@ -186,6 +269,8 @@ class AttentionalPooler(nn.Module):
 
 
 class ResidualAttentionBlock(nn.Module):
+    fused_attn: torch.jit.Final[bool]
+
     def __init__(
             self,
             d_model: int,
@@ -203,6 +288,8 @@ class ResidualAttentionBlock(nn.Module):
         self.ls_1 = LayerScale(d_model, ls_init_value) if ls_init_value is not None else nn.Identity()
         if is_cross_attention:
             self.ln_1_kv = norm_layer(d_model)
+        # computes the attention with SDPA from the weights of self.attn, same parameters
+        self.fused_attn = FUSED_ATTN
 
         self.ln_2 = norm_layer(d_model)
         mlp_width = int(d_model * mlp_ratio)
@@ -220,6 +307,9 @@ class ResidualAttentionBlock(nn.Module):
             v_x: Optional[torch.Tensor] = None,
             attn_mask: Optional[torch.Tensor] = None,
     ):
+        if self.fused_attn and not torch.jit.is_scripting():
+            return self._fused_attention(q_x, k_x, v_x, attn_mask)
+
         k_x = k_x if k_x is not None else q_x
         v_x = v_x if v_x is not None else q_x
 
@@ -228,6 +318,27 @@ class ResidualAttentionBlock(nn.Module):
             q_x, k_x, v_x, need_weights=False, attn_mask=attn_mask
         )[0]
 
+    def _fused_attention(
+            self,
+            q_x: torch.Tensor,
+            k_x: Optional[torch.Tensor] = None,
+            v_x: Optional[torch.Tensor] = None,
+            attn_mask: Optional[torch.Tensor] = None,
+    ):
+        attn = self.attn
+        # the weights are read through the module attributes so parametrizations (LoRA) apply
+        if k_x is None and v_x is None:
+            q, k, v = F.linear(q_x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+        else:
+            w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+            b_q, b_k, b_v = attn.in_proj_bias.chunk(3) if attn.in_proj_bias is not None else (None, None, None)
+            q = F.linear(q_x, w_q, b_q)
+            k = F.linear(k_x if k_x is not None else q_x, w_k, b_k)
+            v = F.linear(v_x if v_x is not None else q_x, w_v, b_v)
+        dropout_p = attn.dropout if self.training else 0.
+        x = _sdpa(q, k, v, attn.num_heads, attn_mask=attn_mask, dropout_p=dropout_p)
+        return F.linear(x, attn.out_proj.weight, attn.out_proj.bias)
+
     def forward(
             self,
             q_x: torch.Tensor,
@@ -380,6 +491,7 @@ class VisionTransformer(nn.Module):
 
         # setting a patch_dropout of 0. would mean it is disabled and this function would be the identity fn
         self.patch_dropout = PatchDropout(patch_dropout) if patch_dropout > 0. else nn.Identity()
+        self._resized_pos_embed = {}  # grid_size -> (version key, embedding), filled without gradients
 
         self.ln_pre = nn.Identity() if no_ln_pre else norm_layer(width)
         self.transformer = Transformer(
@@ -499,17 +611,62 @@ class VisionTransformer(nn.Module):
 
         return pooled, tokens
 
-    def forward(self, x: torch.Tensor):
+    def resized_positional_embedding(self, grid_size: Tuple[int, int]):
+        """Positional embedding interpolated to another patch grid (inputs of another resolution).
+
+        Same bicubic resize as model.resize_pos_embed. Without gradients the result is
+        cached per grid size until the embedding is updated or moved.
+        """
+        pos_embed = self.positional_embedding
+        cacheable = not (torch.is_grad_enabled() and pos_embed.requires_grad)
+        key = (pos_embed._version, pos_embed.data_ptr(), pos_embed.device, pos_embed.dtype)
+        if cacheable:
+            cached = self._resized_pos_embed.get(grid_size)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+
+        old_grid_size = self.grid_size
+        pos_emb_tok, pos_emb_img = pos_embed[:1], pos_embed[1:]
+        pos_emb_img = pos_emb_img.reshape(1, old_grid_size[0], old_grid_size[1], -1).permute(0, 3, 1, 2)
+        pos_emb_img = F.interpolate(
+            pos_emb_img,
+            size=grid_size,
+            mode='bicubic',
+            antialias=True,
+            align_corners=False,
+        )
+        pos_emb_img = pos_emb_img.permute(0, 2, 3, 1).reshape(1, grid_size[0] * grid_size[1], -1)[0]
+        resized = torch.cat([pos_emb_tok, pos_emb_img], dim=0)
+        if cacheable:
+            self._resized_pos_embed[grid_size] = (key, resized.detach())
+        return resized
+
+    def forward(self, x: torch.Tensor, keep_patches: Optional[torch.Tensor] = None, project: bool = True):
+        """
+        Args:
+            x: Images [batch, 3, H, W]. Other sizes than image_size use an
+                interpolated positional embedding.
+            keep_patches: Optional indices [batch, num_keep] of the patch tokens to
+                encode, the others are dropped before the transformer.
+            project: Apply the output projection; without it the pooled
+                features [batch, pool_dim] are returned (as cached by a frozen tower).
+        """
         x = self.conv1(x)  # shape = [*, width, grid, grid]
+        grid_size = (x.shape[2], x.shape[3])
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
 
         # class embeddings and positional embeddings
         x = torch.cat([_expand_token(self.class_embedding, x.shape[0]).to(x.dtype), x], dim=1)
         # shape = [*, grid ** 2 + 1, width]
-        x = x + self.positional_embedding.to(x.dtype)
+        if grid_size == tuple(self.grid_size):
+            x = x + self.positional_embedding.to(x.dtype)
+        else:
+            x = x + self.resized_positional_embedding(grid_size).to(x.dtype)
 
         x = self.patch_dropout(x)
+        if keep_patches is not None:
+            x = PatchDropout.keep_patches(x, keep_patches)
         x = self.ln_pre(x)
 
         x = x.permute(1, 0, 2)  # NLD -> LND
@@ -538,7 +695,7 @@ class VisionTransformer(nn.Module):
             x = self.ln_post(x)
             pooled, tokens = self._global_pool(x)
 
-        if self.proj is not None:
+        if self.proj is not None and project:
             pooled = pooled @ self.proj
 
         if self.output_tokens:
@@ -681,6 +838,9 @@ class TextTransformer(nn.Module):
             cls_mask = self.build_cls_mask(text, cast_dtype)
             if attn_mask is not None:
                 attn_mask = attn_mask[None, :seq_len, :seq_len] + cls_mask[:, :seq_len, :seq_len]
+        elif attn_mask is not None:
+            # text may be trimmed below num_pos (dynamic length batches)
+            attn_mask = causal_attn_mask(seq_len, attn_mask_dtype(cast_dtype, attn_mask.device), attn_mask.device)
 
         x = x + self.positional_embedding[:seq_len].to(cast_dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
@@ -2,12 +2,13 @@ import os,random,copy
 import shutil
 import torch
 import argparse
-import wandb
 from loguru import logger
 import torch.distributed as dist
 import utils.utils as utils
 import data
 import engine
+from utils import metrics
+from utils.precision import build_precision, set_precision
 from utils.vocab import deserialize_vocab
 
 def parser_options():
@@ -36,6 +37,7 @@ def parser_options():
     parser.add_argument('--batch_size', default=100, type=int, help="Batch size for training")
     parser.add_argument('--batch_size_val', default=100, type=int, help="Batch size for validation")
     parser.add_argument('--shard_size', default=256, type=int, help="Batch shard size")
+    parser.add_argument('--text_bucket', default=0, type=int, help="Trim caption tokens to the longest caption, rounded up to a multiple of this (0: full 77 token context)")
     parser.add_argument('--workers', default=3, type=int, help="Number of workers for data loading")
     parser.add_argument('-kf', '--k_fold_nums', default=1, type=int, help="Total number of k-folds")
     parser.add_argument('--k_fold_current_num', default=0, type=int, help="Current fold number for k-fold validation")
@@ -61,6 +63,7 @@ def parser_options():
     parser.add_argument('--rank', default=0, type=int, help='Rank of current process')
     parser.add_argument('--world_size', default=2, type=int, help="World size")
     parser.add_argument('--use_mix_precision', default=False, action='store_true', help="Whether to use mixed precision")
+    parser.add_argument('--precision', default=None, type=str, choices=['fp32', 'fp16', 'bf16'], help="Autocast precision, fp16 adds a GradScaler (default: fp16 on CUDA, fp32 on CPU; --use_mix_precision forces fp16)")
 
     # Other settings
     parser.add_argument('--logger_name', default='logs/', type=str, help="Path for logging")
@@ -81,11 +84,28 @@ def parser_options():
     parser.add_argument("--close_wandb", action='store_true', help="Close WandB")
     parser.add_argument("--wandb_id", type=str, default=None, help="WandB id")
     parser.add_argument("--wandb_logging_dir", type=str, default='./outputs', help="WandB logging directory")
+    parser.add_argument("--metrics_sinks", type=str, default='jsonl', help="Comma-separated metrics sinks: jsonl, wandb, stdout")
+    parser.add_argument("--resource_interval", type=float, default=10.0, help="Seconds between CPU/memory/GPU samples (0 disables)")
 
     # Additional settings
     parser.add_argument("--country", type=str, default='Finland', help="Country name")
     parser.add_argument("--num_seg", type=int, default=10, help="Number of segments")
 
+    # Image decoding settings
+    parser.add_argument("--decode_backend", type=str, default='auto', help="Image decode backend (auto|pil|pil_draft|cv2_reduced|torchvision)")
+    parser.add_argument("--decode_tolerance", type=float, default=2.0, help="Max mean abs pixel difference to PIL accepted by auto backend selection")
+
+    # Segment storage settings
+    parser.add_argument("--segment_format", type=str, default='jpeg', help="Segment storage (jpeg: masked JPEG per segment|packed: RLE masks and boxes rendered from the parent image)")
+    parser.add_argument("--segment_dir", type=str, default=None, help="Segment directory under the country (default: image_segments, or image_segments_packed for packed)")
+
+    # Segment tower settings
+    parser.add_argument("--segment_tower", type=str, default='copy', help="Segment encoder (copy: separate vision tower|shared: main vision tower|lora: main tower with segment-only LoRA adapters)")
+    parser.add_argument("--segment_lora_rank", type=int, default=8, help="Rank of the segment LoRA adapters")
+    parser.add_argument("--segment_resolution", type=int, default=224, help="Resolution segments are encoded at (e.g. 160 or 112 for throughput, position embeddings are interpolated)")
+    parser.add_argument("--segment_drop_background", action="store_true", help="Drop the all-white background patches of segments before the vision transformer")
+    parser.add_argument("--segment_mode_bench", action="store_true", help="Benchmark segment accuracy versus throughput over the segment resolution/background dropping modes")
+
     args = parser.parse_args()
 
     # Generate dataset paths
@@ -109,25 +129,8 @@ def main(args):
     Args:
         args (argparse.Namespace): Parsed arguments.
     """
-    # Set WANDB_DIR environment variable
-    os.environ["WANDB_DIR"] = args.wandb_logging_dir
-    
-    # Generate WANDB_ID if not provided
-    if not args.wandb_id:
-        args.wandb_id = wandb.util.generate_id()
-    
-    # Login to W&B
-    wandb.login(key='d7ec29907ca115fe6d605741c40d09cf563aa0db')
-    logger.info(f"W&B ID: {args.wandb_id}")
-    
-    # Initialize W&B run
-    wandb.init(
-        project="UrbanCross",
-        config=args,
-        name=args.experiment_name,
-        id=args.wandb_id,
-        mode='dryrun',
-    )
+    # Metrics go to a local JSONL file by default, W&B and stdout are optional (--metrics_sinks)
+    metrics.init_sinks(args)
 
     # Create test data loader
     test_loader = data.get_test_loader_mine(args)
@@ -141,6 +144,9 @@ def main(args):
 
     # Initialize the model
     model = models.factory(args, cuda=True, data_parallel=args.distributed)
+    # Autocast (and loss scaling) of the model forward passes
+    precision = build_precision(args)
+    set_precision(model, precision)
 
     # Optionally resume from a checkpoint
     if args.resume:
@@ -153,6 +159,10 @@ def main(args):
             print("=> no checkpoint found at '{}'".format(args.resume))
             return
     
+    if args.segment_mode_bench:
+        engine.benchmark_segment_modes(args, test_loader, model)
+        return
+
     # Test the model
     rsum_, all_scores_ = engine.validate_test(args, test_loader, model)
     print("Test scores:", all_scores_)
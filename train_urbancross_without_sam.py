@@ -3,12 +3,14 @@ import os,random,copy
 import shutil
 import torch
 import argparse
-import wandb
 from loguru import logger
 import torch.distributed as dist
 import utils.utils as utils
 import data
 import engine
+from utils import metrics
+from utils.memory_bank import build_memory_bank, set_memory_bank
+from utils.precision import build_precision, set_precision
 import time
 from utils.vocab import deserialize_vocab
 
@@ -36,8 +38,13 @@ def parser_options():
     parser.add_argument('--eval_step', default=1, type=int, help="Evaluation frequency in epochs")
     parser.add_argument('--test_step', default=0, type=int, help="Testing frequency in epochs")
     parser.add_argument('--batch_size', default=100, type=int, help="Batch size for training")
+    parser.add_argument('--memory_bank_size', default=0, type=int, help="Embeddings of previous batches kept as extra negatives of the contrastive loss (0 disables)")
+    parser.add_argument('--memory_bank_max_age', default=0, type=int, help="Only use memory bank entries of the last this many steps (0 keeps all)")
+    parser.add_argument('--grad_cache_chunk', default=0, type=int, help="Encode the batch in chunks of this many samples with a gradient cache, so the loss sees all batch_size negatives (0 disables)")
+    parser.add_argument('--loss_chunk_size', default=0, type=int, help="Compute the hinge loss over blocks of this many rows without [B, B] cost matrices, for large batches (0 disables)")
     parser.add_argument('--batch_size_val', default=100, type=int, help="Batch size for validation")
     parser.add_argument('--shard_size', default=256, type=int, help="Batch shard size")
+    parser.add_argument('--text_bucket', default=0, type=int, help="Trim caption tokens to the longest caption, rounded up to a multiple of this (0: full 77 token context)")
     parser.add_argument('--workers', default=3, type=int, help="Number of workers for data loading")
     parser.add_argument('-kf', '--k_fold_nums', default=1, type=int, help="Total number of k-folds")
     parser.add_argument('--k_fold_current_num', default=0, type=int, help="Current fold number for k-fold validation")
@@ -59,15 +66,24 @@ def parser_options():
     # GPU settings
     parser.add_argument('-g', '--gpuid', default=2, type=int, help="GPU device ID to use")
     parser.add_argument('--distributed', default=False, action='store_true', help='Whether to use distributed computing')
+    parser.add_argument('--cross_rank_negatives', default=False, action='store_true', help="Gather the embeddings of all ranks as negatives of the contrastive losses")
+    parser.add_argument('--local_loss', default=False, action='store_true', help="With --cross_rank_negatives, only compute the loss rows of the local samples")
+    parser.add_argument('--gather_with_grad', default=False, action='store_true', help="With --cross_rank_negatives, backpropagate through the gathered embeddings")
     parser.add_argument('--init_method', default='tcp://localhost:18888', help="Initialization method for distributed computing")
     parser.add_argument('--rank', default=0, type=int, help='Rank of current process')
     parser.add_argument('--world_size', default=2, type=int, help="World size")
     parser.add_argument('--use_mix_precision', default=False, action='store_true', help="Whether to use mixed precision")
+    parser.add_argument('--precision', default=None, type=str, choices=['fp32', 'fp16', 'bf16'], help="Autocast precision, fp16 adds a GradScaler (default: fp16 on CUDA, fp32 on CPU; --use_mix_precision forces fp16)")
 
     # Other settings
     parser.add_argument('--logger_name', default='logs/', type=str, help="Path for logging")
     parser.add_argument('-p', '--ckpt_save_path', default='checkpoint/', type=str, help="Path for saving checkpoints")
     parser.add_argument('--print_freq', default=10, type=int,  help="Frequency of printing results")
+    parser.add_argument('--sync_timing', default=False, action='store_true', help="Synchronize the device around each step for exact batch times (stalls the pipeline)")
+    parser.add_argument('--profile', default=False, action='store_true', help="Time the phases of each training step and log a per-epoch summary")
+    parser.add_argument('--profile_dir', default='./profile/', type=str, help="Where the phase summaries and Chrome traces are written")
+    parser.add_argument('--profile_trace_steps', default=0, type=int, help="With --profile, record this many steps per epoch with torch.profiler (0 disables)")
+    parser.add_argument('--profile_trace_wait', default=5, type=int, help="Steps skipped before the torch.profiler window")
     parser.add_argument('--lr', default=0.0002, type=float, help="Learning rate")
     parser.add_argument('--lr_update_epoch', default=20, type=int, help="Epochs after which learning rate is updated")
     parser.add_argument('--lr_decay_param', default=0.7, type=float, help="Decay parameter for learning rate")
@@ -83,11 +99,20 @@ def parser_options():
     parser.add_argument("--close_wandb", action='store_true', help="Close WandB")
     parser.add_argument("--wandb_id", type=str, default=None, help="WandB id")
     parser.add_argument("--wandb_logging_dir", type=str, default='./outputs', help="WandB logging directory")
+    parser.add_argument("--metrics_sinks", type=str, default='jsonl', help="Comma-separated metrics sinks: jsonl, wandb, stdout")
+    parser.add_argument("--resource_interval", type=float, default=10.0, help="Seconds between CPU/memory/GPU samples (0 disables)")
 
     # Additional settings
     parser.add_argument("--country", type=str, default='Finland', help="Country name")
     parser.add_argument("--num_seg", type=int, default=10, help="Number of segments")
 
+    # Image decoding settings
+    parser.add_argument("--decode_backend", type=str, default='auto', help="Image decode backend (auto|pil|pil_draft|cv2_reduced|torchvision)")
+    parser.add_argument("--decode_tolerance", type=float, default=2.0, help="Max mean abs pixel difference to PIL accepted by auto backend selection")
+
+    # Data prefetching settings
+    parser.add_argument("--prefetch", type=int, default=2, help="Number of batches prefetched to the device in a background thread (0 disables)")
+
     args = parser.parse_args()
 
     # Generate dataset paths
@@ -111,25 +136,8 @@ def main(args):
     Args:
         args (argparse.Namespace): Parsed arguments.
     """
-    # Set WANDB_DIR environment variable
-    os.environ["WANDB_DIR"] = args.wandb_logging_dir
-    
-    # Generate WANDB_ID if not provided
-    if not args.wandb_id:
-        args.wandb_id = wandb.util.generate_id()
-    
-    # Login to W&B
-    wandb.login(key='d7ec29907ca115fe6d605741c40d09cf563aa0db')
-    logger.info(f"W&B ID: {args.wandb_id}")
-    
-    # Initialize W&B run
-    wandb.init(
-        project="UrbanCross",
-        config=args,
-        name=args.experiment_name,
-        id=args.wandb_id,
-        mode='dryrun',
-    )
+    # Metrics go to a local JSONL file by default, W&B and stdout are optional (--metrics_sinks)
+    metrics.init_sinks(args)
 
     # Set random seed
     utils.setup_seed(args.seed)
@@ -152,6 +160,11 @@ def main(args):
 
     # Initialize the model
     model = models.factory_without_sam(args, cuda=True, data_parallel=args.distributed)
+    # Autocast (and loss scaling) of the model forward passes
+    precision = build_precision(args)
+    set_precision(model, precision)
+    # Extra negatives queued across steps and epochs, None unless --memory_bank_size
+    memory_bank = build_memory_bank(args)
 
     # Print and save model information
     if args.rank == 0:
@@ -177,6 +190,8 @@ def main(args):
             start_epoch = checkpoint['epoch']
             best_rsum = checkpoint['best_rsum']
             model.load_state_dict(checkpoint['model'], strict =False)
+            if 'precision' in checkpoint:
+                precision.load_state_dict(checkpoint['precision'])
             print("=> loaded checkpoint '{}' (epoch {}, best_rsum {})".format(args.resume, start_epoch, best_rsum))
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
@@ -190,7 +205,7 @@ def main(args):
         utils.adjust_learning_rate(args, optimizer, epoch)
 
         # Train for one epoch
-        engine.train_without_sam(args, train_loader, model, optimizer, epoch)
+        engine.train_without_sam(args, train_loader, model, optimizer, epoch, precision=precision, memory_bank=memory_bank)
 
         # evaluate on validation set
         if (epoch + 1) % args.eval_step == 0:
@@ -205,7 +220,7 @@ def main(args):
 
             if args.rank == 0:
                 utils.save_checkpoint(
-                    {'epoch': epoch + 1, 'model': model.state_dict(), 'best_rsum': best_rsum,'args': args,},
+                    {'epoch': epoch + 1, 'model': model.state_dict(), 'best_rsum': best_rsum,'args': args, 'precision': precision.state_dict(),},
                     epoch,
                     filename = '{}_without_sam_{}_epoch{}_bestRsum{:.4f}.pth'.format(args.data_name, args.model_name, epoch + 1, best_rsum),
                     prefix=args.ckpt_save_path,
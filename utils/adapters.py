@@ -0,0 +1,212 @@
+import os
+import torch
+
+import open_clip_mine as open_clip
+from open_clip_mine.lora import LORA_TARGETS
+
+
+def _module(model):
+    return model.module if hasattr(model, "module") else model
+
+
+def apply_lora(model, rank=8, alpha=16., targets=LORA_TARGETS, text_only=False):
+    """
+    Parameter-efficient fine-tuning: inject LoRA adapters into the attention
+    and/or MLP projections of the CLIP towers of `model`, then freeze all the
+    base weights. The adapters and the discriminator (a new head) stay trainable.
+
+    Args:
+        model (nn.Module): Fine-tuning model holding `clip_model` (and `discriminator`), possibly wrapped in DDP.
+        rank (int, optional): Rank of the adapters. Defaults to 8.
+        alpha (float, optional): Scaling numerator of the adapters. Defaults to 16.
+        targets (iterable, optional): Projections to adapt, among open_clip_mine.lora.LORA_TARGETS.
+        text_only (bool, optional): Only adapt the text tower, for a vision tower
+            frozen on stored features (utils.feature_store), whose projection stays trainable.
+
+    Returns:
+        nn.Module: `model`.
+    """
+    module = _module(model)
+    clip_model = module.clip_model
+    open_clip.add_lora(clip_model.transformer if text_only else clip_model, rank=rank, alpha=alpha, targets=targets)
+    open_clip.mark_only_lora_as_trainable(module)
+    if getattr(module, "discriminator", None) is not None:
+        module.discriminator.requires_grad_(True)
+    if text_only and clip_model.visual.proj is not None:
+        clip_model.visual.proj.requires_grad_(True)
+    module.lora_config = {"rank": rank, "alpha": alpha, "targets": list(targets), "text_only": text_only}
+    return model
+
+
+def set_lora(model, args):
+    """Add the adapters of `--lora_rank` (0: full fine-tuning) after the base weights are loaded."""
+    if not getattr(args, "lora_rank", 0):
+        return model
+    targets = [t for t in getattr(args, "lora_targets", ",".join(LORA_TARGETS)).split(",") if t]
+    return apply_lora(
+        model,
+        rank=args.lora_rank,
+        alpha=getattr(args, "lora_alpha", 16.),
+        targets=targets,
+        text_only=getattr(args, "frozen_image_tower", False),
+    )
+
+
+def checkpoint_weights(model, args):
+    """
+    The weights entries of a fine-tuning checkpoint: the whole state dict, or
+    with LoRA only the trainable tensors (adapters, discriminator) plus the
+    adapter config and the base checkpoint they apply to (`--load_path`).
+    """
+    module = _module(model)
+    config = getattr(module, "lora_config", None)
+    if config is None:
+        return {"model": model.state_dict()}
+    trainable = {name for name, p in module.named_parameters() if p.requires_grad}
+    state = {k: v for k, v in module.state_dict().items() if k in trainable}
+    return {"model": state, "lora": config, "base": os.path.abspath(args.load_path)}
+
+
+def load_weights(model, path, map_location=None, merge=True):
+    """
+    Load a checkpoint into `model` (non-strict, as the scripts do). An adapter
+    checkpoint of `checkpoint_weights` first loads its base checkpoint, then
+    injects and loads the adapters and, with `merge`, folds them into the base
+    weights, leaving a plain model with no adapter overhead.
+
+    Returns:
+        dict: The loaded checkpoint.
+    """
+    checkpoint = torch.load(path, map_location=map_location)
+    config = checkpoint.get("lora")
+    if config is None:
+        model.load_state_dict(checkpoint["model"], strict=False)
+        return checkpoint
+
+    load_weights(model, checkpoint["base"], map_location=map_location)
+    module = _module(model)
+    clip_model = module.clip_model
+    tower = clip_model.transformer if config["text_only"] else clip_model
+    open_clip.add_lora(tower, rank=config["rank"], alpha=config["alpha"], targets=config["targets"])
+    unexpected = module.load_state_dict(checkpoint["model"], strict=False).unexpected_keys
+    if unexpected:
+        raise KeyError(f"Adapter weights without a matching parameter: {unexpected[:5]}")
+    if merge:
+        open_clip.merge_lora(tower)
+    return checkpoint
+
+
+def parity_check(model_name="ViT-B-16", rank=4, device="cpu"):
+    """
+    Save an adapter-only checkpoint of a model with trained (random) adapters,
+    load it into a fresh model with merging, and compare the embeddings with
+    those of the adapted model.
+
+    Returns:
+        dict: "image"/"text" -> max abs difference, "checkpoint_mb" -> (full, adapter) sizes.
+    """
+    import types
+    import tempfile
+    from utils.curriculum_bench import BenchModel
+
+    torch.manual_seed(0)
+    model = BenchModel(model_name, staged_forward=True).to(device).eval()
+    base_state = {k: v.clone() for k, v in model.state_dict().items()}
+    apply_lora(model, rank=rank)
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            if "lora_" in name:
+                p.normal_(std=0.02)
+    image_size = model.clip_model.visual.image_size
+    images = torch.randn(2, 3, image_size[0], image_size[1], device=device)
+    texts = torch.randint(1, 49407, (2, 77), device=device)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_path, adapter_path = os.path.join(tmp, "base.pth"), os.path.join(tmp, "adapter.pth")
+        torch.save({"model": base_state}, base_path)
+        torch.save(checkpoint_weights(model, types.SimpleNamespace(load_path=base_path)), adapter_path)
+        sizes = (os.path.getsize(base_path) / 2 ** 20, os.path.getsize(adapter_path) / 2 ** 20)
+        merged = BenchModel(model_name, staged_forward=True).to(device).eval()
+        load_weights(merged, adapter_path, map_location=device)
+
+    with torch.no_grad():
+        diffs = {
+            "image": (model.clip_model.encode_image(images) - merged.clip_model.encode_image(images)).abs().max().item(),
+            "text": (model.clip_model.encode_text(texts) - merged.clip_model.encode_text(texts)).abs().max().item(),
+        }
+    diffs["checkpoint_mb"] = sizes
+    return diffs
+
+
+def benchmark(model_name="ViT-B-16", batch_size=3, rank=8, iters=2, device="cpu"):
+    """
+    Full fine-tuning against LoRA fine-tuning of a curriculum step (cycle 0,
+    with the Adam update): step time, trainable parameters, Adam state and,
+    on CUDA, peak memory of the step. Retrieval accuracy needs the real data:
+    compare the val mR logged by the fine-tuning scripts with and without `--lora_rank`.
+
+    Returns:
+        dict: Mode -> {"ms", "trainable_m", "adam_state_mb", "peak_mb"}.
+    """
+    import time
+    from utils.curriculum_bench import BenchModel
+
+    use_cuda = device.startswith("cuda")
+    results = {}
+    for mode in ("full", f"lora r={rank}"):
+        torch.manual_seed(0)
+        model = BenchModel(model_name, staged_forward=True).to(device)
+        if mode != "full":
+            apply_lora(model, rank=rank)
+        params = [p for p in model.parameters() if p.requires_grad]
+        optimizer = torch.optim.Adam(params, lr=1e-5)
+        image_size = model.clip_model.visual.image_size
+        source_size = batch_size * 5  # 20% of the source batch is selected in cycle 0
+        images = [torch.randn(n, 3, image_size[0], image_size[1], device=device) for n in (source_size, batch_size)]
+        texts = [torch.randint(1, 49407, (n, 77), device=device) for n in (source_size, batch_size)]
+
+        def step():
+            optimizer.zero_grad()
+            triplet_loss, adv_loss, _ = model(images[0], images[1], texts[0], texts[1], num_cycle_of_target=0)
+            (triplet_loss + adv_loss).backward()
+            optimizer.step()
+
+        step()  # warmup, allocates the Adam state
+        if use_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(iters):
+            step()
+        if use_cuda:
+            torch.cuda.synchronize()
+        state_bytes = sum(t.numel() * t.element_size() for s in optimizer.state.values() for t in s.values() if torch.is_tensor(t))
+        results[mode] = {
+            "ms": (time.perf_counter() - start) * 1000 / iters,
+            "trainable_m": sum(p.numel() for p in params) / 1e6,
+            "adam_state_mb": state_bytes / 2 ** 20,
+            "peak_mb": torch.cuda.max_memory_allocated() / 2 ** 20 if use_cuda else None,
+        }
+        del model, optimizer
+    return results
+
+
+if __name__ == "__main__":
+    # python -m utils.adapters --rank 8
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="ViT-B-16", type=str, help="open_clip model name")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--batch_size", default=3, type=int, help="Target batch size (and selected source samples)")
+    parser.add_argument("--rank", default=8, type=int)
+    parser.add_argument("--iters", default=2, type=int)
+    opt = parser.parse_args()
+
+    diffs = parity_check(opt.model, device=opt.device)
+    print(f"merged adapter checkpoint: image max abs diff {diffs['image']:.2e}, text max abs diff {diffs['text']:.2e}, "
+          f"checkpoint {diffs['checkpoint_mb'][0]:.1f} MiB full / {diffs['checkpoint_mb'][1]:.2f} MiB adapters")
+    for mode, row in benchmark(opt.model, opt.batch_size, opt.rank, opt.iters, opt.device).items():
+        peak = f", peak {row['peak_mb']:.0f} MiB" if row["peak_mb"] is not None else ""
+        print(f"{mode}: {row['ms']:.0f} ms per step, {row['trainable_m']:.2f} M trainable, "
+              f"Adam state {row['adam_state_mb']:.1f} MiB{peak}")
@@ -0,0 +1,102 @@
+import time
+import argparse
+import torch
+
+import open_clip_mine
+from open_clip_mine.transformer import Attention, FUSED_ATTN, set_fused_attn
+
+
+def _inputs(model, tokenizer, batch_size, device):
+    image_size = model.visual.image_size
+    images = torch.randn(batch_size, 3, image_size[0], image_size[1], device=device)
+    captions = ["an aerial view of a dense urban block next to a river with a bridge"] * batch_size
+    texts = tokenizer(captions).to(device)
+    return images, texts
+
+
+def parity_check(model, tokenizer, batch_size=8, device="cpu"):
+    """
+    Max abs difference of the image and text features between the fused
+    (SDPA) and the reference attention, plus the standalone Attention module
+    with and without scaled cosine attention (which always takes the reference path).
+
+    Returns:
+        dict: Name -> max abs difference.
+    """
+    images, texts = _inputs(model, tokenizer, batch_size, device)
+    diffs = {}
+    with torch.no_grad():
+        features = {}
+        for fused in (False, True):
+            set_fused_attn(model, fused)
+            features[fused] = (model.encode_image(images), model.encode_text(texts))
+        set_fused_attn(model, True)
+        diffs["image"] = (features[True][0] - features[False][0]).abs().max().item()
+        diffs["text"] = (features[True][1] - features[False][1]).abs().max().item()
+
+        x = torch.randn(50, batch_size, 64, device=device)
+        mask = torch.rand(50, 50, device=device) > 0.8
+        mask.fill_diagonal_(False)
+        for name, kwargs in (("attention", {}), ("attention_scaled_cosine", {"scaled_cosine": True, "scale_heads": True})):
+            attn = Attention(64, num_heads=4, **kwargs).to(device).eval()
+            out = {}
+            for fused in (False, True):
+                set_fused_attn(attn, fused)
+                out[fused] = attn(x, attn_mask=mask)
+            diffs[name] = (out[True] - out[False]).abs().max().item()
+    return diffs
+
+
+def _timeit(fn, iters, device):
+    fn()  # warmup
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.time() - start) / iters
+
+
+def benchmark(model, tokenizer, batch_size=32, iters=10, device="cpu", amp=False):
+    """
+    Throughput (samples/s) of the image and text towers with the reference
+    and the fused attention.
+
+    Returns:
+        dict: (tower, fused) -> samples per second.
+    """
+    images, texts = _inputs(model, tokenizer, batch_size, device)
+    results = {}
+    with torch.no_grad(), torch.autocast(device_type=device.split(":")[0], enabled=amp):
+        for fused in (False, True):
+            set_fused_attn(model, fused)
+            results[("image", fused)] = batch_size / _timeit(lambda: model.encode_image(images), iters, device)
+            results[("text", fused)] = batch_size / _timeit(lambda: model.encode_text(texts), iters, device)
+    set_fused_attn(model, True)
+    return results
+
+
+if __name__ == "__main__":
+    # python -m utils.attention_bench --device cuda --batch_size 64 --amp
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="ViT-B-16", type=str, help="open_clip model name")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--iters", default=10, type=int)
+    parser.add_argument("--amp", action="store_true", help="Benchmark under autocast")
+    opt = parser.parse_args()
+
+    if not FUSED_ATTN:
+        raise SystemExit("F.scaled_dot_product_attention is not available in this torch version")
+
+    model = open_clip_mine.create_model(opt.model, output_dict=True).to(opt.device).eval()
+    tokenizer = open_clip_mine.get_tokenizer(opt.model)
+
+    for name, diff in parity_check(model, tokenizer, device=opt.device).items():
+        print(f"parity {name}: max abs diff {diff:.2e}")
+    results = benchmark(model, tokenizer, opt.batch_size, opt.iters, opt.device, opt.amp)
+    for tower in ("image", "text"):
+        reference, fused = results[(tower, False)], results[(tower, True)]
+        print(f"{tower} tower: reference {reference:.1f} samples/s, fused {fused:.1f} samples/s ({fused / reference:.2f}x)")
@@ -0,0 +1,372 @@
+import time
+import torch
+
+
+# Diagonal masks [size, size] by (size, device), built once instead of on every call
+_MASKS = {}
+
+
+def diag_mask(size, device):
+    """Boolean identity mask [size, size] on `device`, cached."""
+    key = (size, torch.device(device))
+    mask = _MASKS.get(key)
+    if mask is None:
+        mask = torch.eye(size, dtype=torch.bool, device=device)
+        _MASKS[key] = mask
+    return mask
+
+
+def _row_chunks(size, chunk_size):
+    chunk_size = chunk_size or size
+    for start in range(0, size, chunk_size):
+        yield start, min(start + chunk_size, size)
+
+
+def _hardest(scores, mask, chunk_size):
+    """
+    Largest off-diagonal score of every row and every column, with their
+    indices, computed over blocks of `chunk_size` rows.
+    """
+    size = scores.size(0)
+    row_max = scores.new_empty(size)
+    row_idx = torch.empty(size, dtype=torch.long, device=scores.device)
+    col_max = col_idx = None
+    for start, end in _row_chunks(size, chunk_size):
+        block = scores[start:end].masked_fill(mask[start:end], float("-inf"))
+        row_max[start:end], row_idx[start:end] = block.max(1)
+        block_max, block_idx = block.max(0)
+        if col_max is None:
+            col_max, col_idx = block_max, block_idx + start
+        else:
+            # keep the first row on ties, as a max over the whole column does
+            better = block_max > col_max
+            col_max = torch.where(better, block_max, col_max)
+            col_idx = torch.where(better, block_idx + start, col_idx)
+    return row_max, row_idx, col_max, col_idx
+
+
+class _HingeLoss(torch.autograd.Function):
+    """
+    Hinge contrastive loss of a square score matrix, computed and
+    differentiated over blocks of rows. Only the scores (and with
+    max_violation, the indices of the hardest negatives) are saved for the
+    backward: the cost matrices are never materialized.
+    """
+
+    @staticmethod
+    def forward(ctx, scores, margin, max_violation, chunk_size):
+        mask = diag_mask(scores.size(0), scores.device)
+        diagonal = scores.diagonal()
+        ctx.margin, ctx.max_violation, ctx.chunk_size = margin, max_violation, chunk_size
+        if max_violation:
+            row_max, row_idx, col_max, col_idx = _hardest(scores, mask, chunk_size)
+            cost_s = margin + row_max - diagonal
+            cost_im = margin + col_max - diagonal
+            ctx.save_for_backward(row_idx, col_idx, cost_s >= 0, cost_im >= 0)
+            return cost_s.clamp(min=0).sum() + cost_im.clamp(min=0).sum()
+
+        ctx.save_for_backward(scores)
+        loss = scores.new_zeros(())
+        for start, end in _row_chunks(scores.size(0), chunk_size):
+            block = margin + scores[start:end]
+            cost = (block - diagonal[start:end, None]).clamp_(min=0)
+            cost += (block - diagonal[None, :]).clamp_(min=0)
+            loss += cost.masked_fill_(mask[start:end], 0).sum()
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        margin, chunk_size = ctx.margin, ctx.chunk_size
+        if ctx.max_violation:
+            row_idx, col_idx, active_s, active_im = ctx.saved_tensors
+            size = row_idx.size(0)
+            rows = torch.arange(size, device=row_idx.device)
+            active_s, active_im = active_s.to(grad_output.dtype), active_im.to(grad_output.dtype)
+            grad = grad_output.new_zeros(size, size)
+            grad.index_put_((rows, row_idx), active_s, accumulate=True)
+            grad.index_put_((col_idx, rows), active_im, accumulate=True)
+            grad.diagonal().sub_(active_s + active_im)
+            return grad * grad_output, None, None, None
+
+        scores, = ctx.saved_tensors
+        size = scores.size(0)
+        mask = diag_mask(size, scores.device)
+        diagonal = scores.diagonal()
+        grad = torch.empty_like(scores)
+        col_active = scores.new_zeros(size)
+        for start, end in _row_chunks(size, chunk_size):
+            block = margin + scores[start:end]
+            active_s = (block >= diagonal[start:end, None]).masked_fill_(mask[start:end], False)
+            active_im = (block >= diagonal[None, :]).masked_fill_(mask[start:end], False)
+            col_active += active_im.sum(0)
+            grad[start:end] = active_s.to(grad.dtype).add_(active_im.to(grad.dtype))
+            grad.diagonal()[start:end] = -active_s.sum(1).to(grad.dtype)
+        grad.diagonal().sub_(col_active)
+        return grad * grad_output, None, None, None
+
+
+def hinge_loss(scores, margin, max_violation=False, chunk_size=0):
+    """
+    Hinge contrastive loss of utils.calcul_contraloss in one pass: the
+    matching pairs are on the diagonal of `scores` and every row (caption
+    retrieval) and every column (image retrieval) is a set of negatives.
+
+    Args:
+        scores (torch.Tensor): Similarity scores [B, B].
+        margin (float): Margin of the hinge.
+        max_violation (bool, optional): Only keep the hardest negative of every row and column.
+        chunk_size (int, optional): Compute the loss as a custom autograd
+            function over blocks of this many rows, so no [B, B] cost matrix
+            is allocated (0 uses plain autograd ops on the whole matrix).
+
+    Returns:
+        torch.Tensor: Loss.
+    """
+    if chunk_size:
+        return _HingeLoss.apply(scores, margin, max_violation, chunk_size)
+    mask = diag_mask(scores.size(0), scores.device)
+    diagonal = scores.diagonal()
+    if max_violation:
+        # the hinge is monotonic, so the hardest cost is that of the largest off-diagonal score
+        negatives = scores.masked_fill(mask, float("-inf"))
+        cost_s = (margin + negatives.max(1)[0] - diagonal).clamp(min=0)
+        cost_im = (margin + negatives.max(0)[0] - diagonal).clamp(min=0)
+        return cost_s.sum() + cost_im.sum()
+    block = margin + scores
+    cost = (block - diagonal[:, None]).clamp(min=0) + (block - diagonal[None, :]).clamp(min=0)
+    return cost.masked_fill(mask, 0).sum()
+
+
+class _RowHingeLoss(torch.autograd.Function):
+    """
+    One-directional hinge loss of a rectangular score matrix [R, C] whose row
+    r matches column r + offset, computed and differentiated over blocks of
+    rows like _HingeLoss.
+    """
+
+    @staticmethod
+    def forward(ctx, scores, margin, offset, max_violation, chunk_size):
+        positives = scores.diagonal(offset)
+        ctx.margin, ctx.offset, ctx.max_violation, ctx.chunk_size = margin, offset, max_violation, chunk_size
+        if max_violation:
+            row_max = scores.new_empty(scores.size(0))
+            row_idx = torch.empty(scores.size(0), dtype=torch.long, device=scores.device)
+            for start, end in _row_chunks(scores.size(0), chunk_size):
+                block = scores[start:end].clone()
+                block.diagonal(start + offset).fill_(float("-inf"))
+                row_max[start:end], row_idx[start:end] = block.max(1)
+            cost = margin + row_max - positives
+            ctx.save_for_backward(row_idx, cost >= 0)
+            ctx.shape = scores.shape
+            return cost.clamp(min=0).sum()
+
+        ctx.save_for_backward(scores)
+        loss = scores.new_zeros(())
+        for start, end in _row_chunks(scores.size(0), chunk_size):
+            cost = (margin + scores[start:end] - positives[start:end, None]).clamp_(min=0)
+            cost.diagonal(start + offset).zero_()
+            loss += cost.sum()
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        margin, offset, chunk_size = ctx.margin, ctx.offset, ctx.chunk_size
+        if ctx.max_violation:
+            row_idx, active = ctx.saved_tensors
+            rows = torch.arange(row_idx.size(0), device=row_idx.device)
+            active = active.to(grad_output.dtype)
+            grad = grad_output.new_zeros(ctx.shape)
+            grad[rows, row_idx] = active
+            grad.diagonal(offset).sub_(active)
+            return grad * grad_output, None, None, None, None
+
+        scores, = ctx.saved_tensors
+        positives = scores.diagonal(offset)
+        grad = torch.empty_like(scores)
+        for start, end in _row_chunks(scores.size(0), chunk_size):
+            active = margin + scores[start:end] >= positives[start:end, None]
+            active.diagonal(start + offset).fill_(False)
+            grad[start:end] = active
+            grad[start:end].diagonal(start + offset).copy_(-active.sum(1))
+        return grad * grad_output, None, None, None, None
+
+
+def row_hinge_loss(scores, margin, offset=0, max_violation=False, chunk_size=0):
+    """
+    Hinge loss of every row of a rectangular score matrix against its positive
+    column, summed: one direction of `hinge_loss`, for rows scored against more
+    candidates than there are rows (negatives gathered from other ranks, a
+    memory bank).
+
+    Args:
+        scores (torch.Tensor): Similarity scores [R, C], C >= R + offset.
+        margin (float): Margin of the hinge.
+        offset (int, optional): Row r matches column r + offset. Defaults to 0.
+        max_violation (bool, optional): Only keep the hardest negative of every row.
+        chunk_size (int, optional): As `hinge_loss`, no [R, C] cost matrix is
+            allocated (0 uses plain autograd ops on the whole matrix).
+
+    Returns:
+        torch.Tensor: Loss.
+    """
+    if chunk_size:
+        return _RowHingeLoss.apply(scores, margin, offset, max_violation, chunk_size)
+    positives = scores.diagonal(offset)
+    if max_violation:
+        negatives = scores.clone()
+        negatives.diagonal(offset).fill_(float("-inf"))
+        return (margin + negatives.max(1)[0] - positives).clamp(min=0).sum()
+    cost = (margin + scores - positives[:, None]).clamp(min=0)
+    cost.diagonal(offset).zero_()
+    return cost.sum()
+
+
+def hard_negative_loss(scores):
+    """Mean of the hardest (non-negative) off-diagonal score of every row plus that of every column."""
+    negatives = scores.masked_fill(diag_mask(scores.size(0), scores.device), 0)
+    return negatives.max(1)[0].mean() + negatives.max(0)[0].mean()
+
+
+def _reference_loss(scores, margin, max_violation):
+    # utils.calcul_contraloss before the fused loss
+    size = scores.size(0)
+    diagonal = scores.diag().view(size, 1)
+    cost_s = (margin + scores - diagonal.expand_as(scores)).clamp(min=0)
+    cost_im = (margin + scores - diagonal.t().expand_as(scores)).clamp(min=0)
+    mask = (torch.eye(size) > .5).to(scores.device)
+    cost_s = cost_s.masked_fill_(mask, 0)
+    cost_im = cost_im.masked_fill_(mask, 0)
+    if max_violation:
+        cost_s = cost_s.max(1)[0]
+        cost_im = cost_im.max(0)[0]
+    return cost_s.sum() + cost_im.sum()
+
+
+def _reference_row_loss(scores, offset, margin, max_violation):
+    # utils.cross_rank before the fused loss
+    positives = (torch.arange(scores.size(0), device=scores.device) + offset).unsqueeze(1)
+    cost = (margin + scores - scores.gather(1, positives)).clamp(min=0)
+    cost = cost.scatter(1, positives, 0)
+    if max_violation:
+        cost = cost.max(1)[0]
+    return cost.sum()
+
+
+def _scores(batch_size, dim, device, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    a = torch.nn.functional.normalize(torch.randn(batch_size, dim, generator=generator), dim=-1)
+    b = torch.nn.functional.normalize(a + torch.randn(batch_size, dim, generator=generator), dim=-1)
+    return (a @ b.t()).to(device)
+
+
+def parity_check(batch_sizes=(1, 7, 100), chunk_size=16, margin=0.2, dim=32, device="cpu"):
+    """
+    Loss and score gradients of `hinge_loss` (plain and chunked) against the
+    original two-matrix implementation.
+
+    Returns:
+        dict: (batch size, max_violation, chunk size) -> (loss abs diff, gradient max abs diff).
+    """
+    diffs = {}
+    for batch_size in batch_sizes:
+        scores = _scores(batch_size, dim, device)
+        for max_violation in (False, True):
+            ref = scores.clone().requires_grad_()
+            ref_loss = _reference_loss(ref, margin, max_violation)
+            ref_loss.backward()
+            for chunk in (0, chunk_size):
+                s = scores.clone().requires_grad_()
+                loss = hinge_loss(s, margin, max_violation, chunk_size=chunk)
+                loss.backward()
+                diffs[(batch_size, max_violation, chunk)] = (
+                    abs(loss.item() - ref_loss.item()), (s.grad - ref.grad).abs().max().item()
+                )
+    return diffs
+
+
+def row_parity_check(batch_sizes=(1, 7, 100), extra=9, chunk_size=16, margin=0.2, dim=32, device="cpu"):
+    """
+    Loss and score gradients of `row_hinge_loss` (plain and chunked) against
+    the former cross-rank loss, on [B, 2B + extra] scores whose positives start
+    at column B (the second rank of a gathered batch, plus bank entries).
+
+    Returns:
+        dict: (batch size, max_violation, chunk size) -> (loss abs diff, gradient max abs diff).
+    """
+    diffs = {}
+    for batch_size in batch_sizes:
+        generator = torch.Generator().manual_seed(0)
+        scores = torch.randn(batch_size, 2 * batch_size + extra, generator=generator).to(device)
+        for max_violation in (False, True):
+            ref = scores.clone().requires_grad_()
+            ref_loss = _reference_row_loss(ref, batch_size, margin, max_violation)
+            ref_loss.backward()
+            for chunk in (0, chunk_size):
+                s = scores.clone().requires_grad_()
+                loss = row_hinge_loss(s, margin, offset=batch_size, max_violation=max_violation, chunk_size=chunk)
+                loss.backward()
+                diffs[(batch_size, max_violation, chunk)] = (
+                    abs(loss.item() - ref_loss.item()), (s.grad - ref.grad).abs().max().item()
+                )
+    return diffs
+
+
+def benchmark(batch_sizes=(100, 1000, 8000), chunk_size=1024, margin=0.2, dim=64, repeats=5, device="cpu"):
+    """
+    Forward + backward latency (ms) and, on CUDA, peak memory allocated by the
+    loss (MiB) of the original loss, `hinge_loss` and its chunked version.
+
+    Returns:
+        dict: (batch size, max_violation, implementation) -> (ms, MiB or None).
+    """
+    use_cuda = torch.device(device).type == "cuda"
+    impls = {
+        "reference": lambda s, mv: _reference_loss(s, margin, mv),
+        "fused": lambda s, mv: hinge_loss(s, margin, mv),
+        f"chunked({chunk_size})": lambda s, mv: hinge_loss(s, margin, mv, chunk_size=chunk_size),
+    }
+    results = {}
+    for batch_size in batch_sizes:
+        scores = _scores(batch_size, dim, device)
+        for max_violation in (False, True):
+            for name, fn in impls.items():
+                s = scores.clone().requires_grad_()
+                fn(s, max_violation).backward()  # warmup (and mask cache)
+                s.grad = None
+                if use_cuda:
+                    torch.cuda.synchronize(device)
+                    torch.cuda.reset_peak_memory_stats(device)
+                    base = torch.cuda.memory_allocated(device)
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    fn(s, max_violation).backward()
+                    s.grad = None
+                if use_cuda:
+                    torch.cuda.synchronize(device)
+                ms = (time.perf_counter() - start) * 1000 / repeats
+                peak = (torch.cuda.max_memory_allocated(device) - base) / 2 ** 20 if use_cuda else None
+                results[(batch_size, max_violation, name)] = (ms, peak)
+    return results
+
+
+if __name__ == "__main__":
+    # python -m utils.contrastive --batch_sizes 100,1000,8000
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", default="100,1000,8000", type=str)
+    parser.add_argument("--chunk_size", default=1024, type=int)
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    opt = parser.parse_args()
+
+    for (batch_size, max_violation, chunk), (loss_diff, grad_diff) in parity_check(device=opt.device).items():
+        print(f"parity B={batch_size} max_violation={max_violation} chunk={chunk}: "
+              f"loss abs diff {loss_diff:.2e}, gradient max abs diff {grad_diff:.2e}")
+    for (batch_size, max_violation, chunk), (loss_diff, grad_diff) in row_parity_check(device=opt.device).items():
+        print(f"row parity B={batch_size} max_violation={max_violation} chunk={chunk}: "
+              f"loss abs diff {loss_diff:.2e}, gradient max abs diff {grad_diff:.2e}")
+    results = benchmark([int(b) for b in opt.batch_sizes.split(",")], opt.chunk_size, repeats=opt.repeats, device=opt.device)
+    for (batch_size, max_violation, name), (ms, peak) in results.items():
+        memory = f", peak {peak:.1f} MiB" if peak is not None else ""
+        print(f"B={batch_size} max_violation={max_violation} {name}: {ms:.2f} ms{memory}")
@@ -0,0 +1,192 @@
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+
+from open_clip_mine.loss import gather_features
+from utils.contrastive import row_hinge_loss
+
+
+class CrossRank(object):
+    """
+    Negatives from every rank for the contrastive losses, enabled with
+    `--cross_rank_negatives` in distributed training.
+
+    The embeddings are all-gathered with open_clip's `gather_features`:
+    without `--gather_with_grad` only the local rows keep their graph, and
+    with `--local_loss` every rank only computes the loss rows of its own
+    samples against all the gathered candidates (use both together to split
+    the loss across ranks, as in open_clip). The negative pool of a loss is
+    world_size * batch_size, plus the memory bank entries when one is given.
+
+    Without distributed training (or when disabled) the losses are the
+    in-batch losses of utils.calcul_contraloss and open_clip.ClipLoss. The
+    hinge loss is utils.contrastive.row_hinge_loss, over blocks of
+    `--loss_chunk_size` rows when set.
+    """
+
+    def __init__(self, args):
+        self.world_size = getattr(args, "world_size", 1) if getattr(args, "distributed", False) else 1
+        self.enabled = getattr(args, "cross_rank_negatives", False) and self.world_size > 1
+        self.rank = getattr(args, "rank", 0)
+        self.local_loss = getattr(args, "local_loss", False)
+        self.gather_with_grad = getattr(args, "gather_with_grad", False)
+        self.chunk_size = getattr(args, "loss_chunk_size", 0)
+
+    def gather(self, query_emb, key_emb):
+        """All-gather two sets of paired embeddings [bs, D] -> [world_size * bs, D]."""
+        if not self.enabled:
+            return query_emb, key_emb
+        return gather_features(
+            query_emb.contiguous(), key_emb.contiguous(),
+            local_loss=self.local_loss, gather_with_grad=self.gather_with_grad,
+            rank=self.rank, world_size=self.world_size,
+        )
+
+    def gather_negatives(self, emb):
+        """All-gather candidate negatives [bs, D] -> [world_size * bs, D]; the local rows keep their graph."""
+        if not self.enabled:
+            return emb
+        if self.gather_with_grad:
+            return torch.cat(torch.distributed.nn.all_gather(emb.contiguous()), dim=0)
+        gathered = [torch.zeros_like(emb) for _ in range(self.world_size)]
+        dist.all_gather(gathered, emb.contiguous())
+        gathered[self.rank] = emb
+        return torch.cat(gathered, dim=0)
+
+    def _pairs(self, query_emb, key_emb, memory_bank, query, key):
+        """
+        Loss rows (queries and keys), their candidates (keys and queries of
+        all ranks, then the memory bank) and the offset of the positives: row
+        r matches candidate r + offset.
+        """
+        query_emb = F.normalize(query_emb.float(), dim=-1)
+        key_emb = F.normalize(key_emb.float(), dim=-1)
+        all_query, all_key = self.gather(query_emb, key_emb)
+        if self.enabled and self.local_loss:
+            rows_query, rows_key = query_emb, key_emb
+            offset = self.rank * query_emb.size(0)
+        else:
+            rows_query, rows_key = all_query, all_key
+            offset = 0
+
+        if memory_bank is not None:
+            bank_key, bank_query = memory_bank.get(key), memory_bank.get(query)
+            if bank_key is not None:
+                all_key = torch.cat([all_key, bank_key])
+            if bank_query is not None:
+                all_query = torch.cat([all_query, bank_query])
+        return rows_query, rows_key, all_query, all_key, offset
+
+    def contraloss(self, query_emb, key_emb, margin, max_violation=False, memory_bank=None, query="image", key="text"):
+        """
+        Hinge contrastive loss of utils.calcul_contraloss over the gathered
+        batch: every query against all keys and every key against all queries.
+
+        Args:
+            query_emb (torch.Tensor): Local query embeddings [bs, D] (images or segments).
+            key_emb (torch.Tensor): Local key embeddings [bs, D] (captions).
+            margin (float): Margin of the hinge.
+            max_violation (bool, optional): Only keep the hardest negative of every row.
+            memory_bank (utils.memory_bank.MemoryBank, optional): Queued `key`
+                and `query` embeddings appended to the candidates.
+
+        Returns:
+            torch.Tensor: Loss.
+        """
+        rows_query, rows_key, all_query, all_key, offset = self._pairs(query_emb, key_emb, memory_bank, query, key)
+        return (row_hinge_loss(rows_query @ all_key.t(), margin, offset, max_violation, self.chunk_size)
+                + row_hinge_loss(rows_key @ all_query.t(), margin, offset, max_violation, self.chunk_size))
+
+    def clip_loss(self, img_emb, text_emb, logit_scale=1.0, memory_bank=None):
+        """Symmetric InfoNCE of open_clip.ClipLoss over the gathered batch (and the memory bank)."""
+        rows_img, rows_text, all_img, all_text, offset = self._pairs(img_emb, text_emb, memory_bank, "image", "text")
+        positives = torch.arange(rows_img.size(0), device=rows_img.device) + offset
+        return (F.cross_entropy(logit_scale * rows_img @ all_text.t(), positives)
+                + F.cross_entropy(logit_scale * rows_text @ all_img.t(), positives)) / 2
+
+
+def _parity_worker(rank, world_size, port, query, key, margin, results):
+    import types
+
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    bs = query.size(0) // world_size
+    for local_loss, gather_with_grad, loss_chunk_size in ((False, False, 0), (True, True, 3)):
+        args = types.SimpleNamespace(distributed=True, world_size=world_size, rank=rank, cross_rank_negatives=True,
+                                     local_loss=local_loss, gather_with_grad=gather_with_grad, loss_chunk_size=loss_chunk_size)
+        cross_rank = CrossRank(args)
+        for name in ("contraloss", "contraloss_max_violation", "clip_loss"):
+            q = query[rank * bs:(rank + 1) * bs].clone().requires_grad_()
+            k = key[rank * bs:(rank + 1) * bs].clone().requires_grad_()
+            if name == "clip_loss":
+                loss = cross_rank.clip_loss(q, k, logit_scale=10.0)
+            else:
+                loss = cross_rank.contraloss(q, k, margin, max_violation=name.endswith("max_violation"))
+            loss.backward()
+            # the local rows sum (hinge) or average (InfoNCE) to the global loss
+            total = loss.detach().clone()
+            grad_scale = 1.0
+            if local_loss:
+                dist.all_reduce(total)
+                if name == "clip_loss":
+                    total /= world_size
+                    # every rank averages its own rows and the gathers sum the gradients
+                    # of all ranks, as in open_clip; DDP's gradient averaging undoes it
+                    grad_scale = world_size
+            results[(rank, local_loss, name)] = (total.item(), q.grad / grad_scale, k.grad / grad_scale)
+    dist.destroy_process_group()
+
+
+def parity_check(world_size=2, batch_size=8, dim=16, margin=0.2, port=29533):
+    """
+    Losses and embedding gradients computed on `world_size` gloo processes
+    with cross-rank negatives, against a single process holding the whole
+    batch, with (local_loss, gather_with_grad, loss_chunk_size) = (False, False, 0)
+    and (True, True, 3).
+
+    Returns:
+        dict: (local_loss, loss name) -> (loss abs diff, max gradient abs diff).
+    """
+    import types
+    import torch.multiprocessing as mp
+    import utils.utils as utils
+
+    torch.manual_seed(0)
+    query, key = torch.randn(world_size * batch_size, dim), torch.randn(world_size * batch_size, dim)
+    results = mp.Manager().dict()
+    mp.spawn(_parity_worker, args=(world_size, port, query, key, margin, results), nprocs=world_size)
+
+    args = types.SimpleNamespace(gpuid=0)
+    diffs = {}
+    for name in ("contraloss", "contraloss_max_violation", "clip_loss"):
+        q, k = query.clone().requires_grad_(), key.clone().requires_grad_()
+        qn, kn = F.normalize(q, dim=-1), F.normalize(k, dim=-1)
+        if name == "clip_loss":
+            logits = 10.0 * qn @ kn.t()
+            labels = torch.arange(q.size(0))
+            loss = (F.cross_entropy(logits, labels) + F.cross_entropy(logits.t(), labels)) / 2
+        else:
+            loss = utils.calcul_contraloss(args, qn @ kn.t(), q.size(0), margin, max_violation=name.endswith("max_violation"))
+        loss.backward()
+        for local_loss in (False, True):
+            loss_diff, grad_diff = 0.0, 0.0
+            for rank in range(world_size):
+                rank_loss, q_grad, k_grad = results[(rank, local_loss, name)]
+                rows = slice(rank * batch_size, (rank + 1) * batch_size)
+                loss_diff = max(loss_diff, abs(rank_loss - loss.item()))
+                grad_diff = max(grad_diff, (q_grad - q.grad[rows]).abs().max().item(), (k_grad - k.grad[rows]).abs().max().item())
+            diffs[(local_loss, name)] = (loss_diff, grad_diff)
+    return diffs
+
+
+if __name__ == "__main__":
+    # python -m utils.cross_rank --world_size 2
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_size", default=2, type=int)
+    parser.add_argument("--batch_size", default=8, type=int, help="Batch size per rank")
+    parser.add_argument("--port", default=29533, type=int)
+    opt = parser.parse_args()
+
+    for (local_loss, name), (loss_diff, grad_diff) in parity_check(opt.world_size, opt.batch_size, port=opt.port).items():
+        print(f"{name} (local_loss={local_loss}): loss abs diff {loss_diff:.2e}, gradient max abs diff {grad_diff:.2e}")
@@ -0,0 +1,184 @@
+import time
+import types
+import argparse
+import torch
+import torch.nn as nn
+
+import open_clip_mine
+from data import SimilarityCurriculumSampler
+from layers.urbancross import UrbanCross_finetune_curriculum, AdversarialLoss, TripletLoss
+from utils.cross_rank import CrossRank
+
+
+class BenchModel(UrbanCross_finetune_curriculum):
+    """Curriculum model on a randomly initialized open_clip model, without downloading weights."""
+
+    def __init__(self, model_name, staged_forward):
+        nn.Module.__init__(self)
+        self.clip_model = open_clip_mine.create_model(model_name, output_dict=True)
+        dim = self.clip_model.visual.output_dim
+        self.discriminator = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, 2))
+        self.adv_loss = AdversarialLoss()
+        self.triplet_loss = TripletLoss(initial_margin=0.5, margin_increase_per_cycle=0.2, max_margin=1.5)
+        self.cross_rank = CrossRank(types.SimpleNamespace())
+        self.staged_forward = staged_forward
+
+
+def _inputs(model, target_size, cycle, device):
+    # The adversarial loss weights the selected source rows by W2, which has one
+    # entry per target sample: the source batch is sized so that they match
+    source_size = round(target_size / BenchModel.source_ratio(cycle))
+    image_size = model.clip_model.visual.image_size
+    images = [torch.randn(n, 3, image_size[0], image_size[1], device=device) for n in (source_size, target_size)]
+    texts = [torch.randint(1, 49407, (n, 77), device=device) for n in (source_size, target_size)]
+    return images[0], images[1], texts[0], texts[1]
+
+
+def _step(model, inputs, cycle, **kwargs):
+    model.zero_grad()
+    triplet_loss, adv_loss, _ = model(*inputs, num_cycle_of_target=cycle, **kwargs)
+    loss = triplet_loss + adv_loss
+    loss.backward()
+    return triplet_loss.item(), adv_loss.item()
+
+
+def parity_check(model_name="ViT-B-16", batch_size=4, cycles=(0, 2), device="cpu"):
+    """
+    Losses and parameter gradients of the staged curriculum forward against
+    the forward that encodes every source image.
+
+    Returns:
+        dict: cycle -> (max loss abs diff, max gradient abs diff relative to the largest gradient).
+    """
+    torch.manual_seed(0)
+    model = BenchModel(model_name, staged_forward=False).to(device)
+    diffs = {}
+    for cycle in cycles:
+        inputs = _inputs(model, batch_size, cycle, device)
+        results = {}
+        for staged in (False, True):
+            model.staged_forward = staged
+            losses = _step(model, inputs, cycle)
+            results[staged] = (losses, [p.grad.clone() for p in model.parameters() if p.grad is not None])
+        (full_losses, full_grads), (staged_losses, staged_grads) = results[False], results[True]
+        scale = max(g.abs().max().item() for g in full_grads)
+        grad_diff = max((a - b).abs().max().item() for a, b in zip(full_grads, staged_grads))
+        loss_diff = max(abs(a - b) for a, b in zip(full_losses, staged_losses))
+        diffs[cycle] = (loss_diff, grad_diff / scale)
+    return diffs
+
+
+def benchmark(model_name="ViT-B-16", batch_size=12, cycles=(0, 1, 2, 3, 4), iters=3, device="cpu"):
+    """
+    Forward + backward time of a curriculum step per cycle, with the full and
+    the staged forward. The selected source ratio is 20% in cycle 0, +20% per
+    cycle, of a source batch of `batch_size / ratio` samples.
+
+    Returns:
+        dict: cycle -> (full ms, staged ms).
+    """
+    torch.manual_seed(0)
+    model = BenchModel(model_name, staged_forward=False).to(device)
+
+    def timeit(inputs, cycle):
+        _step(model, inputs, cycle)  # warmup
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            _step(model, inputs, cycle)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) * 1000 / iters
+
+    results = {}
+    for cycle in cycles:
+        inputs = _inputs(model, batch_size, cycle, device)
+        times = {}
+        for staged in (False, True):
+            model.staged_forward = staged
+            times[staged] = timeit(inputs, cycle)
+        results[cycle] = (times[False], times[True])
+    return results
+
+
+def sampler_check(model_name="ViT-B-16", batch_size=4, cycles=(0, 2), iters=2, device="cpu"):
+    """
+    The similarity curriculum sampler against the selection inside the model,
+    on one candidate batch with a cache encoded by the same weights (no
+    staleness): loss differences of the pre-selected step with the sampler's
+    target weights and with the weights recomputed over the kept rows only,
+    and step time of the full step against the pre-selected step plus the
+    caption refresh of its candidate and target batches (what `refresh`
+    costs per step; the one-off encoding of all captions is not included).
+
+    Returns:
+        dict: cycle -> {"loss_diff", "kept_rows_loss_diff", "full_ms", "sampler_ms"}.
+    """
+    torch.manual_seed(0)
+    model = BenchModel(model_name, staged_forward=True).to(device)
+    results = {}
+    for cycle in cycles:
+        img_source, img_target, text_source, text_target = _inputs(model, batch_size, cycle, device)
+
+        def encode(source_indices, target_indices):
+            with torch.no_grad():
+                return (model.clip_model.encode_text(text_source[source_indices.to(device)], normalize=True),
+                        model.clip_model.encode_text(text_target[target_indices.to(device)], normalize=True))
+
+        sampler = SimilarityCurriculumSampler(
+            len(text_source), batch_size, len(text_source), batch_size, refresh_fn=encode,
+            ratio_fn=lambda _: BenchModel.source_ratio(cycle), num_batches=1,
+        )
+
+        def sampler_step():
+            sampler.plan()
+            sampler.cache = None
+            sampler.refresh()
+            source_indices, target_indices, _, target_weights = next(iter(sampler))
+            inputs = (img_source[source_indices], img_target[target_indices],
+                      text_source[source_indices], text_target[target_indices])
+            losses = _step(model, inputs, cycle, source_preselected=True, target_weights=target_weights.to(device))
+            return losses, inputs, target_indices
+
+        (triplet, adv), inputs, target_indices = sampler_step()
+        # the full step on the same target order, as the weights are per target sample
+        full = _step(model, (img_source, img_target[target_indices], text_source, text_target[target_indices]), cycle)
+        kept_rows = _step(model, inputs, cycle, source_preselected=True)
+        row = {
+            "loss_diff": max(abs(triplet - full[0]), abs(adv - full[1])),
+            "kept_rows_loss_diff": abs(kept_rows[1] - full[1]),
+        }
+        for name, fn in (("full_ms", lambda: _step(model, (img_source, img_target, text_source, text_target), cycle)),
+                         ("sampler_ms", sampler_step)):
+            fn()  # warmup
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(iters):
+                fn()
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            row[name] = (time.perf_counter() - start) * 1000 / iters
+        results[cycle] = row
+    return results
+
+
+if __name__ == "__main__":
+    # python -m utils.curriculum_bench --batch_size 12
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="ViT-B-16", type=str, help="open_clip model name")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--batch_size", default=12, type=int, help="Target batch size (and selected source samples)")
+    parser.add_argument("--iters", default=3, type=int)
+    opt = parser.parse_args()
+
+    for cycle, (loss_diff, grad_diff) in parity_check(opt.model, device=opt.device).items():
+        print(f"parity cycle {cycle}: loss abs diff {loss_diff:.2e}, gradient max rel diff {grad_diff:.2e}")
+    for cycle, (full_ms, staged_ms) in benchmark(opt.model, opt.batch_size, iters=opt.iters, device=opt.device).items():
+        print(f"cycle {cycle} (ratio {BenchModel.source_ratio(cycle):.1f}): full {full_ms:.0f} ms, staged {staged_ms:.0f} ms, "
+              f"saved {1 - staged_ms / full_ms:.1%}")
+    for cycle, row in sampler_check(opt.model, device=opt.device).items():
+        print(f"sampler cycle {cycle}: loss abs diff {row['loss_diff']:.2e} "
+              f"({row['kept_rows_loss_diff']:.2e} with weights over the kept rows), "
+              f"full {row['full_ms']:.0f} ms, refresh + pre-selected {row['sampler_ms']:.0f} ms")
@@ -0,0 +1,273 @@
+import os
+import json
+import random
+import hashlib
+import numpy as np
+import torch
+import torch.distributed as dist
+from loguru import logger
+
+
+# A store is <feature_store_dir>/<name>.npy, pooled features [N, views, pool_dim]
+# in float16 read as a memory map, plus <name>.json describing what it was built from
+STORE_VERSION = 2
+
+
+class FeatureStore(object):
+    """
+    Memory-mapped pooled image features of one split, computed once by
+    `build_feature_store` with the vision tower frozen. The map is opened
+    lazily in every process (DataLoader workers included), so it is never
+    pickled nor read as a whole.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".json", "r") as f:
+            self.meta = json.load(f)
+        self.views = self.meta["views"]
+        self._features = None
+
+    def __len__(self):
+        return self.meta["num"]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_features"] = None
+        return state
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = np.load(self.path + ".npy", mmap_mode="r")
+        return self._features
+
+    def get(self, index, view=0):
+        """Pooled features [pool_dim] of sample `index`, in float32."""
+        return torch.from_numpy(np.array(self.features[index, view], dtype=np.float32))
+
+
+def _store_meta(args, module, dataset, views, pool_dim):
+    from layers.urbancross import MODEL_NAME, PRETRAINED
+
+    names = "\n".join(dataset.images).encode("utf-8")
+    load_path = getattr(args, "load_path", None)
+    precision = getattr(module, "precision", None)
+    return {
+        "version": STORE_VERSION,
+        "num": len(dataset),
+        "views": views,
+        "pool_dim": pool_dim,
+        "images": hashlib.sha1(names).hexdigest(),
+        "model": MODEL_NAME,
+        "pretrained": PRETRAINED,
+        "input_size": list(module.clip_model.visual.image_size),
+        # decoding size and the whole preprocessing (sizes, augmentations, normalization)
+        "decode_size": list(dataset.image_size),
+        "transform": repr(dataset.transform),
+        "precision": precision.precision if precision is not None else "fp16",
+        "load_path": load_path,
+        "load_mtime": os.path.getmtime(load_path) if load_path and os.path.exists(load_path) else None,
+    }
+
+
+def _is_current(path, meta):
+    if not (os.path.exists(path + ".npy") and os.path.exists(path + ".json")):
+        return False
+    with open(path + ".json", "r") as f:
+        return json.load(f) == meta
+
+
+@torch.no_grad()
+def build_feature_store(args, model, dataset, path, views=1):
+    """
+    Encode every image of `dataset` with the vision tower of `model`, up to
+    its output projection, `views` times (one pass per view: with the random
+    augmentations of a training split every view is a different one).
+
+    Skipped when the store at `path` was already built from the same images,
+    number of views, model and weights (`--load_path` and its modification
+    time), preprocessing (decoding size and transforms) and precision.
+
+    Args:
+        args: Parsed arguments (`shard_size`, `workers`, `gpuid`, `load_path`).
+        model (nn.Module): Fine-tuning model holding `clip_model`, possibly wrapped in DDP.
+        dataset (data.PrecompDataset_mine_finetune): Split to encode.
+        path (str): Store path without extension.
+        views (int, optional): Augmented views per image. Defaults to 1.
+
+    Returns:
+        FeatureStore: The store.
+    """
+    import data
+
+    module = model.module if hasattr(model, "module") else model
+    visual = module.clip_model.visual
+    pool_dim = visual.proj.shape[0] if visual.proj is not None else visual.output_dim
+    meta = _store_meta(args, module, dataset, views, pool_dim)
+    if _is_current(path, meta):
+        logger.info(f"Using the feature store {path}.npy")
+        return FeatureStore(path)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    device = torch.device(f"cuda:{args.gpuid}" if torch.cuda.is_available() else "cpu")
+    loader = torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=args.shard_size,
+        shuffle=False,
+        pin_memory=True,
+        collate_fn=data.collate_fn_mine_finetune,
+        num_workers=args.workers,
+    )
+    # Written under a temporary name, so an interrupted build is never mistaken for a store
+    tmp_path = path + ".tmp.npy"
+    features = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float16, shape=(len(dataset), views, pool_dim))
+    was_training = module.training
+    module.eval()
+    for view in range(views):
+        logger.info(f"Building the feature store {path}.npy: view {view + 1}/{views}, {len(dataset)} images")
+        start = 0
+        for images, _ in loader:
+            with module.autocast():
+                pooled = visual(images.to(device, non_blocking=True), project=False)
+            features[start:start + len(pooled), view] = pooled.float().cpu().numpy()
+            start += len(pooled)
+    module.train(was_training)
+    features.flush()
+    del features
+    os.replace(tmp_path, path + ".npy")
+    with open(path + ".json", "w") as f:
+        json.dump(meta, f, indent=2)
+    return FeatureStore(path)
+
+
+class FeatureDataset(torch.utils.data.Dataset):
+    """
+    Fine-tuning dataset whose images are replaced by their stored pooled
+    features (a random view per access), in the item layout of
+    data.PrecompDataset_mine_finetune, so the collate functions, the paired
+    loaders and the curriculum sampler work unchanged.
+    """
+
+    def __init__(self, dataset, store):
+        if len(dataset) != len(store):
+            raise ValueError(f"The feature store has {len(store)} samples, the dataset {len(dataset)}")
+        self.dataset = dataset
+        self.store = store
+        self.captions = dataset.captions
+        self.images = dataset.images
+        self.clip_tokenizer = dataset.clip_tokenizer
+
+    def __getitem__(self, index):
+        view = random.randrange(self.store.views) if self.store.views > 1 else 0
+        caption = self.captions[index]
+        return self.store.get(index, view), caption, index, index, self.clip_tokenizer(caption)
+
+    def __len__(self):
+        return len(self.store)
+
+
+def freeze_image_tower(model):
+    """
+    Freeze the vision tower of `model` (LiT style, `lock_image_tower`) except
+    its output projection, which is trained on the stored features. Call it
+    before building the optimizer and before any DDP wrapping.
+    """
+    module = model.module if hasattr(model, "module") else model
+    module.clip_model.lock_image_tower()
+    if module.clip_model.visual.proj is not None:
+        module.clip_model.visual.proj.requires_grad_(True)
+    return model
+
+
+def build_feature_loaders(args, model, source_dataset, target_dataset, val_dataset):
+    """
+    Frozen image tower fine-tuning (`--frozen_image_tower`): freeze the tower,
+    build (or reuse) the feature stores of the source and target training
+    splits (`--feature_views` views) and of the target validation split, and
+    return the loaders of data.get_loaders_finetune over them. Epochs then
+    neither decode nor encode images; only the text tower, the projections
+    and the discriminator are trained.
+
+    Returns:
+        tuple: As data.get_loaders_finetune.
+    """
+    import data
+
+    freeze_image_tower(model)
+    splits = (
+        (f"{args.country_source}_train_source", source_dataset, args.feature_views),
+        (f"{args.country_target}_train_target", target_dataset, args.feature_views),
+        (f"{args.country_target}_val_target", val_dataset, 1),
+    )
+    datasets = []
+    for name, dataset, views in splits:
+        path = os.path.join(args.feature_store_dir, name)
+        # Rank 0 builds the stores, the other ranks wait for them
+        if args.rank == 0:
+            build_feature_store(args, model, dataset, path, views)
+        if getattr(args, "distributed", False):
+            dist.barrier()
+        datasets.append(FeatureDataset(dataset, FeatureStore(path)))
+    return data.get_loaders_finetune_from_datasets(args, *datasets)
+
+
+def benchmark(model_name="ViT-B-16", batch_size=12, iters=3, device="cpu"):
+    """
+    Forward + backward time of a curriculum fine-tuning step (cycle 0) on
+    images with the whole model trained, on images with the vision tower
+    frozen, and on stored pooled features. Data loading, which the features
+    also skip (decoding and augmenting the images), is not included.
+
+    Returns:
+        dict: Mode -> ms per step.
+    """
+    import time
+    from utils.curriculum_bench import BenchModel
+
+    torch.manual_seed(0)
+    model = BenchModel(model_name, staged_forward=True).to(device)
+    visual = model.clip_model.visual
+    source_size = batch_size * 5  # 20% of the source batch is selected in cycle 0
+    image_size = visual.image_size
+    images = [torch.randn(n, 3, image_size[0], image_size[1], device=device) for n in (source_size, batch_size)]
+    texts = [torch.randint(1, 49407, (n, 77), device=device) for n in (source_size, batch_size)]
+    with torch.no_grad():
+        features = [visual(x, project=False) for x in images]
+
+    def step(img_source, img_target):
+        model.zero_grad()
+        triplet_loss, adv_loss, _ = model(img_source, img_target, texts[0], texts[1], num_cycle_of_target=0)
+        (triplet_loss + adv_loss).backward()
+
+    def timeit(inputs):
+        step(*inputs)  # warmup
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            step(*inputs)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) * 1000 / iters
+
+    results = {"images": timeit(images)}
+    freeze_image_tower(model)
+    results["images, frozen tower"] = timeit(images)
+    results["stored features"] = timeit(features)
+    return results
+
+
+if __name__ == "__main__":
+    # python -m utils.feature_store --batch_size 12
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="ViT-B-16", type=str, help="open_clip model name")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--batch_size", default=12, type=int, help="Target batch size (and selected source samples)")
+    parser.add_argument("--iters", default=3, type=int)
+    opt = parser.parse_args()
+
+    for mode, ms in benchmark(opt.model, opt.batch_size, opt.iters, opt.device).items():
+        print(f"{mode}: {ms:.0f} ms per step")
@@ -8,17 +8,78 @@ import os
 import pandas as pd
 import sys
 import re
+import argparse
 from tqdm import tqdm
 
 # Adding the parent directory to system path
 sys.path.append("..")
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from utils.segment_proposals import PROPOSAL_BACKENDS, build_proposer
+from utils.segment_store import PACKED_EXTENSION, save_packed, segment_roots
 
 # Load CLIP model to compute similarities
 # Depending on GPU availability, the model is loaded onto either GPU or CPU
 device = "cuda" if torch.cuda.is_available() else "cpu"
 clip_model, preprocess = clip.load("ViT-B/32", device=device)
 
+def encode_description(text, device=device, clip_model=clip_model):
+    """
+    Encode a text description once. Long texts are split on `;,.` and the parts
+    are encoded in a single batch, then averaged.
+
+    Args:
+        text (str): Text description.
+        device (str): The device to run computations on (either 'cpu' or 'cuda').
+        clip_model: The loaded CLIP model to encode texts.
+
+    Returns:
+        torch.Tensor: Averaged text features of shape [1, D], or None if the text is empty or cannot be tokenized.
+    """
+    # Split the text using regex to handle different punctuation marks like semicolons, commas, and periods
+    text_parts = re.split(r'[;,.]', text)
+    text_parts = [part.strip() for part in text_parts if part.strip()]
+    if not text_parts:
+        return None
+
+    try:
+        text_inputs = clip.tokenize(text_parts).to(device)
+    except RuntimeError as e:
+        print(f"Error processing text: {text}. Error: {e}")
+        return None
+    with torch.no_grad():
+        text_features = clip_model.encode_text(text_inputs)
+
+    # Calculate the average of the encoded text features
+    return text_features.mean(dim=0, keepdim=True)
+
+
+def score_images(images, text_features, device=device, clip_model=clip_model, preprocess=preprocess, batch_size=64):
+    """
+    Score in-memory images against already encoded text features with batched `encode_image` calls.
+
+    Args:
+        images (list): RGB images as PIL images or HxWx3 uint8 arrays.
+        text_features (torch.Tensor): Text features of shape [1, D] from `encode_description`.
+        device (str): The device to run computations on (either 'cpu' or 'cuda').
+        clip_model: The loaded CLIP model to encode images.
+        preprocess: Preprocessing function for input images.
+        batch_size (int): Maximum number of images per `encode_image` call.
+
+    Returns:
+        torch.Tensor: Cosine similarities of shape [len(images)] on the CPU.
+    """
+    similarities = []
+    for start in range(0, len(images), batch_size):
+        batch = [
+            preprocess(img if isinstance(img, Image.Image) else Image.fromarray(img))
+            for img in images[start:start + batch_size]
+        ]
+        batch = torch.stack(batch).to(device)
+        with torch.no_grad():
+            image_features = clip_model.encode_image(batch)
+        similarities.append(torch.cosine_similarity(text_features, image_features, dim=1).float().cpu())
+    return torch.cat(similarities)
+
+
 def compute_similarity(image_path, text, device=device, clip_model=clip_model, preprocess=preprocess):
     """
     Calculate similarity between an image and a text description. Long texts are split into smaller parts for processing.
@@ -33,35 +94,11 @@ def compute_similarity(image_path, text, device=device, clip_model=clip_model, p
     Returns:
         float: Cosine similarity between the image and text features.
     """
-    # Split the text using regex to handle different punctuation marks like semicolons, commas, and periods
-    text_parts = re.split(r'[;,.]', text)
-    text_parts = [part.strip() for part in text_parts if part.strip()]
-    text_features_list = []
-    
-    # Encode each part of the text separately
-    for part in text_parts:
-        try:
-            text_inputs = clip.tokenize([part]).to(device)
-            with torch.no_grad():
-                text_features_part = clip_model.encode_text(text_inputs)
-                text_features_list.append(text_features_part)
-        except RuntimeError as e:
-            print(f"Error processing text: {part}. Error: {e}")
-            return None
-    
-    # Calculate the average of the encoded text features
-    if not text_features_list:
+    text_features = encode_description(text, device=device, clip_model=clip_model)
+    if text_features is None:
         return None
-    text_features_avg = torch.mean(torch.stack(text_features_list), dim=0)
-    
-    # Load and preprocess the image
-    image = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
-    with torch.no_grad():
-        image_features = clip_model.encode_image(image)
-
-    # Calculate cosine similarity between the image and averaged text features
-    similarity = torch.cosine_similarity(text_features_avg, image_features, dim=1).cpu().numpy()[0]
-    return similarity
+    image = Image.open(image_path).convert("RGB")
+    return score_images([image], text_features, device=device, clip_model=clip_model, preprocess=preprocess).numpy()[0]
 
 
 def all_segments_exist(seg_path, num_segments_expected=10):
@@ -80,78 +117,194 @@ def all_segments_exist(seg_path, num_segments_expected=10):
     return len(existing_segments) >= num_segments_expected
 
 
-def show_masks_mine(anns, ori_img, img_path, description):
+def masked_segments(anns, ori_img, max_segments=50):
+    """
+    Build the masked segment images of the largest annotations in memory.
+
+    Args:
+        anns (list): List of segmentation masks.
+        ori_img (ndarray): The original image array (HxWx3, RGB).
+        max_segments (int): Number of largest segments to keep.
+
+    Returns:
+        list: (area rank, masked image array) tuples, everything outside the mask set to white.
+    """
+    # Sort annotations based on area size in descending order
+    sorted_anns = sorted(anns, key=lambda x: x["area"], reverse=True)
+    segments = []
+    for idx, ann in enumerate(sorted_anns[:max_segments]):
+        m = ann["segmentation"]
+        masked_img = np.where(m[..., None], ori_img, np.uint8(255))
+        segments.append((idx, masked_img))
+    return segments
+
+
+def show_masks_mine(anns, ori_img, img_path, description, seg_root, packed_root, max_segments=50, top_k=10, segment_format="jpeg"):
     """
     Modified function to compute the similarity between each segmented image and a text description, and save only the top 10 segments based on similarity.
+
+    The description is encoded once, all masked segments are scored from memory
+    in one batch and only the `top_k` best segments are written to disk.
     
     Args:
         anns (list): List of segmentation masks.
         ori_img (ndarray): The original image array.
         img_path (str): Path to the original image.
         description (str): Text description to compute similarity against.
+        seg_root (str): Root of the JPEG segments, one directory per image.
+        packed_root (str): Root of the packed segment files (see `segment_roots`).
+        max_segments (int): Number of largest segments scored.
+        top_k (int): Number of segments kept.
+        segment_format (str): "jpeg" (one masked JPEG per segment), "packed"
+            (RLE masks and boxes in one .npz per image) or "both".
     """
     # Extract the image name from the image path
     img_name = img_path.split("/")[-1].split(".")[0]
     # Define the path for storing segments
-    seg_path = img_path.replace("/images/", "/image_segments_new/").split(".")[0]
-    
-    # If the segment directory exists, check if all segments already exist and skip
-    if os.path.exists(seg_path):
-        if all_segments_exist(seg_path):
-            print(f"All segments for {img_name} already exist. Skipping.")
-            return
+    seg_path = os.path.join(seg_root, img_name)
+    packed_file = os.path.join(packed_root, img_name + PACKED_EXTENSION)
+    write_jpeg = segment_format in ("jpeg", "both")
+    write_packed = segment_format in ("packed", "both")
+
+    # If the segments already exist, skip
+    jpeg_done = not write_jpeg or (os.path.exists(seg_path) and all_segments_exist(seg_path, top_k))
+    packed_done = not write_packed or os.path.exists(packed_file)
+    if jpeg_done and packed_done:
+        print(f"All segments for {img_name} already exist. Skipping.")
+        return
     
     # Ensure the target directory exists
-    if not os.path.exists(seg_path):
+    if write_jpeg and not os.path.exists(seg_path):
         os.makedirs(seg_path, exist_ok=True)  # Create the directory and any necessary parent directories
 
     if len(anns) == 0:
         return
 
-    # Sort annotations based on area size in descending order
-    sorted_anns = sorted(anns, key=lambda x: x["area"], reverse=True)
-    
-    # List to store similarities and corresponding paths
+    text_features = encode_description(description)
+    if text_features is None:
+        return
+
+    segments = masked_segments(anns, ori_img, max_segments)
+    similarities = score_images([masked_img for _, masked_img in segments], text_features)
+
+    # Keep only the top segments based on similarity, named by their area rank
+    top_similarities, top_index = torch.topk(similarities, min(top_k, len(segments)))
+    top_similarities, top_index = top_similarities.tolist(), top_index.tolist()
+    if write_jpeg:
+        for similarity, i in zip(top_similarities, top_index):
+            idx, masked_img = segments[i]
+            segment_img_path = os.path.join(seg_path, f"{img_name}_{idx}.jpg")
+            plt.imsave(segment_img_path, masked_img)
+            print(f"Kept {segment_img_path} with similarity {similarity}")
+    if write_packed:
+        sorted_anns = sorted(anns, key=lambda x: x["area"], reverse=True)
+        ranks = [segments[i][0] for i in top_index]
+        save_packed(
+            packed_file,
+            [np.asarray(sorted_anns[idx]["segmentation"], dtype=bool) for idx in ranks],
+            ranks=ranks,
+            scores=top_similarities,
+        )
+
+
+def show_masks_per_segment(anns, ori_img, img_path, description, seg_root, packed_root=None):
+    """
+    Previous implementation of `show_masks_mine`, kept as the reference for the
+    benchmark: every segment is written to JPEG, re-read and scored against a
+    freshly encoded description, then all but the top 10 are deleted. Only
+    writes JPEG segments, under `seg_root`.
+    """
+    img_name = img_path.split("/")[-1].split(".")[0]
+    seg_path = os.path.join(seg_root, img_name)
+    os.makedirs(seg_path, exist_ok=True)
+
     similarities = []
-    
-    # Process a maximum of the top 50 segments
-    for idx, ann in enumerate(sorted_anns[:50]):
-        m = ann["segmentation"]
-        masked_img = np.copy(ori_img)
-        masked_img[m != 1] = [255, 255, 255]
-        
-        # Save each segment as an image
+    for idx, masked_img in masked_segments(anns, ori_img):
         segment_img_path = os.path.join(seg_path, f"{img_name}_{idx}.jpg")
         plt.imsave(segment_img_path, masked_img)
-
-        # Compute similarity with the provided description
         similarity = compute_similarity(segment_img_path, description)
         if similarity is not None:
             similarities.append((similarity, segment_img_path))
-    
-    # Keep only the top 10 segments based on similarity
-    top_similarities = sorted(similarities, key=lambda x: x[0], reverse=True)[:10]
-    for similarity, path in top_similarities:
-        print(f"Kept {path} with similarity {similarity}")
 
-    # Remove other segments
+    top_paths = [x[1] for x in sorted(similarities, key=lambda x: x[0], reverse=True)[:10]]
     for similarity, path in similarities:
-        if path not in [x[1] for x in top_similarities]:
-            if os.path.exists(path):
-                os.remove(path)
+        if path not in top_paths and os.path.exists(path):
+            os.remove(path)
+
+
+def benchmark(image_dir, df, mask_generator, num_images=20):
+    """
+    Report images per second of the per-segment and the batched scoring paths
+    on the first `num_images` images of `image_dir` that have a description.
+    Masks are generated once and shared, and segments are written to a
+    temporary directory, so only the scoring and writing stages are compared.
+
+    Args:
+        image_dir (str): Directory of images.
+        df (pandas.DataFrame): Rows with `image_name` and `description`.
+        mask_generator (SamAutomaticMaskGenerator): Mask generator.
+        num_images (int): Number of images used.
+    """
+    import shutil
+    import tempfile
+    import time
+
+    descriptions = dict(zip(df["image_name"], df["description"]))
+    samples = []
+    for image_name in sorted(os.listdir(image_dir)):
+        if image_name not in descriptions:
+            continue
+        image = cv2.imread(os.path.join(image_dir, image_name))
+        if image is None:
+            continue
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        samples.append((image_name, image, mask_generator.generate(image)))
+        if len(samples) == num_images:
+            break
+    if not samples:
+        print(f"No described images found in {image_dir}")
+        return
+
+    for name, fn in (("per-segment", show_masks_per_segment), ("batched", show_masks_mine)):
+        tmp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmp_dir, "images"))
+        seg_root, packed_root = segment_roots(tmp_dir)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for image_name, image, masks in samples:
+            fn(masks, image, os.path.join(tmp_dir, "images", image_name), descriptions[image_name], seg_root, packed_root)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(tmp_dir)
+        print(f"{name:<12} {len(samples) / elapsed:8.2f} images/s ({len(samples)} images)")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark_dir", type=str, default=None, help="Compare per-segment and batched scoring on this image directory and exit")
+    parser.add_argument("--num_benchmark", type=int, default=20, help="Number of images used by the benchmark")
+    parser.add_argument("--proposal_backend", type=str, default="sam", help="Segment proposals: " + "|".join(PROPOSAL_BACKENDS))
+    parser.add_argument("--segment_format", type=str, default="jpeg", help="jpeg|packed|both, see utils/segment_store.py")
+    opt = parser.parse_args()
+
+    # Single-process run over one country; utils/segment_runner.py runs the same
+    # steps as a pipelined, resumable and shardable job
     # Set paths for images and CSV file
     img_path = "/hpc2hdd/home/szhong691/zsr/projects/dataset/UrbanCross/Germany/images"
+    # Backends other than SAM write to their own roots, so their segments never mix with (nor skip on) SAM's
+    seg_root, packed_root = segment_roots(os.path.dirname(img_path), opt.proposal_backend)
     df = pd.read_csv("/hpc2hdd/home/szhong691/zsr/projects/dataset/UrbanCross/Germany/instructblip_generation_germany_refine.csv")
 
     # Load the segmentation model checkpoint
     sam_checkpoint = "/hpc2hdd/home/szhong691/zsr/projects/segment-anything/segment_anything/checkpoint/sam_vit_h_4b8939.pth"
     model_type = "vit_h"
-    sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
-    sam.to(device="cuda")
-    mask_generator = SamAutomaticMaskGenerator(sam)
+    mask_generator = build_proposer(opt.proposal_backend, sam_checkpoint, model_type, device=device)
+
+    if opt.benchmark_dir is not None:
+        benchmark(opt.benchmark_dir, df, mask_generator, opt.num_benchmark)
+        sys.exit(0)
 
     # List of image names from the CSV file
     img_lists = df["image_name"]
@@ -175,7 +328,9 @@ if __name__ == "__main__":
             
             # Try to generate masks and compute similarities
             try:
-                show_masks_mine(masks, image, image_path, description)
+                show_masks_mine(
+                    masks, image, image_path, description, seg_root, packed_root, segment_format=opt.segment_format
+                )
             except Exception as e:
                 print(f"Error processing image {image_name}: {e}")
                 failed_rows.append(row.Index)  # Use .Index to get the original index
@@ -0,0 +1,219 @@
+import contextlib
+import torch
+import torch.distributed as dist
+
+
+BRANCHES = ("image", "text", "segments")
+
+
+class _RandState(object):
+    """RNG state at the start of a chunk, replayed when the chunk is encoded again with gradients."""
+
+    def __init__(self, device):
+        self.device = device
+        self.cpu = torch.get_rng_state()
+        self.cuda = torch.cuda.get_rng_state(device) if device.type == "cuda" else None
+
+    @contextlib.contextmanager
+    def replay(self):
+        devices = [self.device] if self.cuda is not None else []
+        with torch.random.fork_rng(devices=devices):
+            torch.set_rng_state(self.cpu)
+            if self.cuda is not None:
+                torch.cuda.set_rng_state(self.cuda, self.device)
+            yield
+
+
+class GradCache(object):
+    """
+    Gradient-cached contrastive step: the embeddings of a large batch are
+    computed chunk by chunk without graphs, the loss and its gradient with
+    respect to the embeddings are computed over the whole batch, then every
+    chunk is encoded again with a graph and backpropagated with its cached
+    embedding gradient. Activation memory is that of one chunk, while the
+    loss sees all the negatives of the batch.
+
+        cache = GradCache(model, chunk_size, precision)
+        emb = cache.embed(image=img, text=text, segments=(segment_imgs, seg_counts))
+        loss = loss_fn(emb["image"], emb["text"], emb["segments"])
+        cache.backward(loss)
+
+    The model must implement layers.urbancross.EncoderMixin. The loss may only
+    depend on the embeddings. Dropout and other random ops see the same RNG
+    state in both passes.
+
+    Args:
+        model (nn.Module): UrbanCross model, possibly wrapped in DDP.
+        chunk_size (int): Samples encoded per pass.
+        precision (utils.precision.Precision): Autocast and loss scaling of the run.
+        args (argparse.Namespace, optional): With `args.distributed`, the
+            gradients are averaged across ranks after the last chunk.
+    """
+
+    def __init__(self, model, chunk_size, precision, args=None):
+        self.model = model
+        self.module = model.module if hasattr(model, "module") else model
+        self.chunk_size = chunk_size
+        self.precision = precision
+        self.distributed = bool(args is not None and getattr(args, "distributed", False))
+        self.world_size = getattr(args, "world_size", 1) if self.distributed else 1
+
+    def _chunks(self, branch, x):
+        if branch != "segments":
+            return list(x.split(self.chunk_size))
+        segment_imgs, seg_counts = x
+        if seg_counts is None:
+            # padded segments [bs, num_seg, 3, H, W]
+            return [(chunk, None) for chunk in segment_imgs.split(self.chunk_size)]
+        # packed segments: the segments of samples [a, b) are contiguous
+        counts = seg_counts.tolist()
+        offsets = [0]
+        for count in counts:
+            offsets.append(offsets[-1] + count)
+        chunks = []
+        for start in range(0, len(counts), self.chunk_size):
+            end = min(start + self.chunk_size, len(counts))
+            chunks.append((segment_imgs[offsets[start]:offsets[end]], seg_counts[start:end]))
+        return chunks
+
+    def _encode(self, branch, chunk):
+        if branch == "image":
+            return self.module.encode_image(chunk, normalize=False)
+        if branch == "text":
+            return self.module.encode_text(chunk, normalize=False)
+        if branch == "segments":
+            segment_imgs, seg_counts = chunk
+            return self.module.encode_segments(segment_imgs, seg_counts=seg_counts, normalize=False)
+        raise ValueError(f"Unknown branch '{branch}', expected one of {BRANCHES}")
+
+    def embed(self, **inputs):
+        """
+        Embed every branch chunk by chunk, without graphs.
+
+        Args:
+            **inputs: Branch name (image, text, segments) -> input; segments
+                are given as (segment_imgs, seg_counts).
+
+        Returns:
+            dict: Branch name -> float32 embeddings [bs, D] (unnormalized)
+                that require grad, to be fed to the loss.
+        """
+        self.chunks, self.states, self.sizes, self.embeddings = {}, {}, {}, {}
+        with torch.no_grad():
+            for branch, x in inputs.items():
+                chunks = self._chunks(branch, x)
+                states, outs = [], []
+                for chunk in chunks:
+                    device = (chunk[0] if branch == "segments" else chunk).device
+                    states.append(_RandState(device))
+                    outs.append(self._encode(branch, chunk))
+                self.chunks[branch] = chunks
+                self.states[branch] = states
+                self.sizes[branch] = [out.size(0) for out in outs]
+                self.embeddings[branch] = torch.cat(outs).requires_grad_()
+        return self.embeddings
+
+    def backward(self, loss):
+        """
+        Backpropagate `loss` (scaled with fp16) to the embeddings, then through
+        the encoders chunk by chunk.
+        """
+        self.precision.backward(loss)
+        no_sync = self.model.no_sync() if hasattr(self.model, "no_sync") else contextlib.nullcontext()
+        with no_sync:
+            for branch, chunks in self.chunks.items():
+                emb = self.embeddings[branch]
+                if emb.grad is None:
+                    continue
+                grads = emb.grad.split(self.sizes[branch])
+                for chunk, state, grad in zip(chunks, self.states[branch], grads):
+                    with state.replay():
+                        chunk_emb = self._encode(branch, chunk)
+                    # a chunk whose samples have no segments has a constant (zero) embedding
+                    if not chunk_emb.requires_grad:
+                        continue
+                    chunk_emb.backward(grad)
+        if self.world_size > 1:
+            # the chunks bypass the DDP forward, so its hooks did not reduce the gradients
+            for p in self.module.parameters():
+                if p.grad is not None:
+                    dist.all_reduce(p.grad)
+                    p.grad /= self.world_size
+        self.chunks, self.states, self.sizes, self.embeddings = {}, {}, {}, {}
+
+
+def parity_check(model_name="ViT-B-16", batch_size=8, chunk_size=3, num_seg=2, margin=0.2, device="cpu"):
+    """
+    Compare the loss and the parameter gradients of a full-batch step and of
+    a gradient-cached step of the image/segment/text hinge loss of
+    engine.train, on a randomly initialized open_clip model. The last chunk
+    has no segments at all.
+
+    Returns:
+        dict: "loss" -> abs difference, "grad" -> max abs difference of the
+            gradients relative to the largest gradient.
+    """
+    import types
+    import open_clip_mine
+    from layers.urbancross import EncoderMixin, cosine_sim, segment_mean
+    from utils.precision import Precision
+    import utils.utils as utils
+
+    class Model(EncoderMixin, torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.clip_model = open_clip_mine.create_model(model_name, output_dict=True)
+
+    torch.manual_seed(0)
+    model = Model().to(device)
+    model.precision = Precision("fp32", device.split(":")[0])
+    args = types.SimpleNamespace(gpuid=torch.device(device).index or 0)
+    image_size = model.clip_model.visual.image_size
+    images = torch.randn(batch_size, 3, image_size[0], image_size[1], device=device)
+    texts = torch.randint(1, 49407, (batch_size, 77), device=device)
+    seg_counts = torch.randint(1, num_seg + 1, (batch_size,), device=device)
+    # the samples of the last chunk have no segments, so that chunk has no graph
+    seg_counts[-(batch_size % chunk_size or chunk_size):] = 0
+    segments = torch.randn(int(seg_counts.sum()), 3, image_size[0], image_size[1], device=device)
+
+    def loss_fn(img_emb, text_emb, seg_emb):
+        return (utils.calcul_contraloss(args, cosine_sim(img_emb, text_emb), batch_size, margin)
+                + utils.calcul_contraloss(args, cosine_sim(seg_emb, text_emb), batch_size, margin))
+
+    # full batch
+    model.zero_grad()
+    with model.autocast():
+        img_emb = model.clip_model.encode_image(images)
+        text_emb = model.clip_model.encode_text(texts)
+        seg_emb = segment_mean(model.encode_segment_images(segments), seg_counts)
+    loss = loss_fn(img_emb.float(), text_emb.float(), seg_emb.float())
+    loss.backward()
+    full_loss = loss.item()
+    full_grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+
+    # gradient cache
+    model.zero_grad()
+    cache = GradCache(model, chunk_size, model.precision)
+    emb = cache.embed(image=images, text=texts, segments=(segments, seg_counts))
+    loss = loss_fn(emb["image"], emb["text"], emb["segments"])
+    cache.backward(loss)
+    cached_grads = [p.grad for p in model.parameters() if p.grad is not None]
+
+    scale = max(g.abs().max().item() for g in full_grads)
+    grad_diff = max((a - b).abs().max().item() for a, b in zip(full_grads, cached_grads))
+    return {"loss": abs(full_loss - loss.item()), "grad": grad_diff / scale}
+
+
+if __name__ == "__main__":
+    # python -m utils.grad_cache --batch_size 8 --chunk_size 3
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="ViT-B-16", type=str, help="open_clip model name")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--chunk_size", default=3, type=int)
+    opt = parser.parse_args()
+
+    diffs = parity_check(opt.model, opt.batch_size, opt.chunk_size, device=opt.device)
+    print(f"loss abs diff {diffs['loss']:.2e}, gradient max rel diff {diffs['grad']:.2e}")
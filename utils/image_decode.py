@@ -0,0 +1,306 @@
+import os
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import torchvision.io as tv_io
+except ImportError:
+    tv_io = None
+
+
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+# Order matters: on a tie in speed the earlier backend wins
+DECODE_BACKENDS = ("pil", "pil_draft", "cv2_reduced", "torchvision")
+
+
+def _to_2tuple(size):
+    if size is None:
+        return None
+    if isinstance(size, int):
+        return (size, size)
+    return tuple(size)
+
+
+def _is_jpeg(path):
+    return path.lower().endswith(JPEG_EXTENSIONS)
+
+
+def decode_pil(path, size=None):
+    """
+    Decode an image at full resolution with PIL (reference backend).
+
+    Args:
+        path (str): Path to the image file.
+        size (tuple, optional): Unused, kept for a uniform backend signature.
+
+    Returns:
+        PIL.Image.Image: RGB image.
+    """
+    return Image.open(path).convert("RGB")
+
+
+def decode_pil_draft(path, size=None):
+    """
+    Decode a JPEG with PIL, letting libjpeg downscale in the DCT domain.
+
+    `Image.draft` picks the largest 1/2, 1/4 or 1/8 reduction that keeps the
+    decoded image at least as large as `size`, so the following `Resize` in
+    the dataset transform still downsamples and never upsamples.
+
+    Args:
+        path (str): Path to the image file.
+        size (tuple, optional): Target (width, height) of the downstream resize.
+
+    Returns:
+        PIL.Image.Image: RGB image.
+    """
+    img = Image.open(path)
+    if size is not None and img.format == "JPEG":
+        img.draft("RGB", size)
+    return img.convert("RGB")
+
+
+def decode_cv2_reduced(path, size=None):
+    """
+    Decode an image with OpenCV, using `IMREAD_REDUCED_COLOR_*` for JPEGs.
+
+    The reduction factor is chosen from the image header so that the decoded
+    image is never smaller than `size`.
+
+    Args:
+        path (str): Path to the image file.
+        size (tuple, optional): Target (width, height) of the downstream resize.
+
+    Returns:
+        PIL.Image.Image: RGB image.
+    """
+    flag = cv2.IMREAD_COLOR
+    if size is not None and _is_jpeg(path):
+        # Reading the header with PIL is lazy and does not decode any pixels
+        with Image.open(path) as header:
+            width, height = header.size
+        for factor, reduced_flag in (
+            (8, cv2.IMREAD_REDUCED_COLOR_8),
+            (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2),
+        ):
+            if width // factor >= size[0] and height // factor >= size[1]:
+                flag = reduced_flag
+                break
+    img = cv2.imread(path, flag)
+    if img is None:
+        raise IOError(f"cv2 failed to decode {path}")
+    return Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+
+
+def decode_torchvision(path, size=None):
+    """
+    Decode an image with `torchvision.io` (libjpeg-turbo for JPEGs).
+
+    Args:
+        path (str): Path to the image file.
+        size (tuple, optional): Unused, kept for a uniform backend signature.
+
+    Returns:
+        PIL.Image.Image: RGB image.
+    """
+    raw = tv_io.read_file(path)
+    if _is_jpeg(path):
+        img = tv_io.decode_jpeg(raw, mode=tv_io.ImageReadMode.RGB)
+    else:
+        img = tv_io.decode_image(raw, mode=tv_io.ImageReadMode.RGB)
+    return Image.fromarray(img.permute(1, 2, 0).numpy())
+
+
+_DECODE_FNS = {
+    "pil": decode_pil,
+    "pil_draft": decode_pil_draft,
+    "cv2_reduced": decode_cv2_reduced,
+    "torchvision": decode_torchvision,
+}
+
+
+def available_backends():
+    """Return the decode backends whose libraries are importable."""
+    backends = []
+    for name in DECODE_BACKENDS:
+        if name == "cv2_reduced" and cv2 is None:
+            continue
+        if name == "torchvision" and tv_io is None:
+            continue
+        backends.append(name)
+    return backends
+
+
+def _resized_array(img, size):
+    return np.asarray(img.resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def benchmark_decoders(paths, size=(224, 224), repeats=3, backends=None):
+    """
+    Time every decode backend on a sample of images and measure its deviation
+    from the full-resolution PIL reference after resizing to `size`.
+
+    Args:
+        paths (list): Image paths to decode.
+        size (int or tuple): Target (width, height) of the downstream resize.
+        repeats (int, optional): Number of timed passes over `paths`. Defaults to 3.
+        backends (list, optional): Backends to test. Defaults to all available ones.
+
+    Returns:
+        dict: backend -> {"ms_per_image", "mean_abs_diff", "max_abs_diff"}.
+    """
+    size = _to_2tuple(size)
+    backends = backends or available_backends()
+    reference = [_resized_array(decode_pil(p), size) for p in paths]
+
+    results = {}
+    for name in backends:
+        fn = _DECODE_FNS[name]
+        mean_diffs, max_diffs = [], []
+        try:
+            for path, ref in zip(paths, reference):
+                diff = np.abs(_resized_array(fn(path, size), size) - ref)
+                mean_diffs.append(diff.mean())
+                max_diffs.append(diff.max())
+        except Exception as e:
+            logger.warning(f"Decode backend {name} failed: {e}")
+            continue
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for path in paths:
+                fn(path, size)
+        elapsed = time.perf_counter() - start
+
+        results[name] = {
+            "ms_per_image": 1000.0 * elapsed / max(1, repeats * len(paths)),
+            "mean_abs_diff": float(np.mean(mean_diffs)),
+            "max_abs_diff": float(np.max(max_diffs)),
+        }
+    return results
+
+
+def select_backend(paths, size=(224, 224), tolerance=2.0, repeats=1):
+    """
+    Pick the fastest backend whose output stays within `tolerance` (mean
+    absolute difference in 0-255 pixel units after resizing) of PIL.
+
+    Args:
+        paths (list): Sample image paths used for the selection.
+        size (int or tuple): Target (width, height) of the downstream resize.
+        tolerance (float, optional): Accepted mean absolute difference. Defaults to 2.0.
+        repeats (int, optional): Number of timed passes. Defaults to 1.
+
+    Returns:
+        str: Name of the selected backend.
+    """
+    if not paths:
+        return "pil"
+    results = benchmark_decoders(paths, size=size, repeats=repeats)
+    acceptable = [
+        name for name, r in results.items() if r["mean_abs_diff"] <= tolerance
+    ]
+    if not acceptable:
+        return "pil"
+    return min(acceptable, key=lambda name: results[name]["ms_per_image"])
+
+
+class ImageDecoder(object):
+    """
+    Callable that turns an image path into an RGB PIL image using one of the
+    registered backends. With backend "auto" the fastest acceptable backend is
+    selected once from `sample_paths`; the choice is then fixed so that it is
+    shared by all DataLoader workers.
+    """
+
+    def __init__(self, backend="auto", sample_paths=None, size=(224, 224), tolerance=2.0):
+        """
+        Initialize the ImageDecoder.
+
+        Args:
+            backend (str, optional): One of DECODE_BACKENDS or "auto". Defaults to "auto".
+            sample_paths (list, optional): Images used for "auto" selection.
+            size (int or tuple, optional): Target size used during selection.
+            tolerance (float, optional): Accepted mean absolute pixel difference.
+        """
+        if backend == "auto":
+            backend = select_backend(sample_paths or [], size=size, tolerance=tolerance)
+            logger.info(f"Selected image decode backend: {backend}")
+        if backend not in available_backends():
+            raise ValueError(
+                f"Unknown or unavailable decode backend '{backend}', "
+                f"expected one of {available_backends()}"
+            )
+        self.backend = backend
+        self.decode_fn = _DECODE_FNS[backend]
+
+    def __call__(self, path, size=None):
+        """
+        Decode `path` to RGB, reduced to no less than `size` where the backend supports it.
+
+        Args:
+            path (str): Path to the image file.
+            size (int or tuple, optional): Target (width, height) of the downstream resize.
+
+        Returns:
+            PIL.Image.Image: RGB image.
+        """
+        return self.decode_fn(path, _to_2tuple(size))
+
+
+def build_decoder(args, image_paths, size=(224, 224), num_samples=8):
+    """
+    Build the ImageDecoder configured by the command line arguments.
+
+    Args:
+        args (argparse.Namespace): Parsed arguments (`decode_backend`, `decode_tolerance`).
+        image_paths (list): Full paths of the dataset images; a few are used for "auto".
+        size (int or tuple, optional): Target size used during selection.
+        num_samples (int, optional): Number of images used for "auto". Defaults to 8.
+
+    Returns:
+        ImageDecoder: The decoder.
+    """
+    backend = getattr(args, "decode_backend", "auto")
+    tolerance = getattr(args, "decode_tolerance", 2.0)
+    sample_paths = [p for p in image_paths[:num_samples] if os.path.isfile(p)]
+    return ImageDecoder(backend, sample_paths=sample_paths, size=size, tolerance=tolerance)
+
+
+if __name__ == "__main__":
+    # Micro-benchmark, e.g.
+    # python -m utils.image_decode --image_dir /path/to/UrbanCross/Finland/images --size 278
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", required=True, type=str, help="Directory of images to decode")
+    parser.add_argument("--num_images", default=64, type=int, help="Number of images to sample")
+    parser.add_argument("--size", default=224, type=int, help="Target size of the downstream resize")
+    parser.add_argument("--repeats", default=3, type=int, help="Number of timed passes")
+    parser.add_argument("--tolerance", default=2.0, type=float, help="Accepted mean absolute pixel difference")
+    opt = parser.parse_args()
+
+    names = sorted(
+        f for f in os.listdir(opt.image_dir)
+        if f.lower().endswith(JPEG_EXTENSIONS + (".png", ".tif", ".tiff"))
+    )[: opt.num_images]
+    sample = [os.path.join(opt.image_dir, f) for f in names]
+
+    results = benchmark_decoders(sample, size=opt.size, repeats=opt.repeats)
+    print("{:<14}{:>14}{:>16}{:>16}{:>12}".format("backend", "ms/image", "mean_abs_diff", "max_abs_diff", "accepted"))
+    for name, r in results.items():
+        print(
+            "{:<14}{:>14.3f}{:>16.3f}{:>16.1f}{:>12}".format(
+                name, r["ms_per_image"], r["mean_abs_diff"], r["max_abs_diff"],
+                str(r["mean_abs_diff"] <= opt.tolerance),
+            )
+        )
+    print("selected:", select_backend(sample, size=opt.size, tolerance=opt.tolerance))
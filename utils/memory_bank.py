@@ -0,0 +1,167 @@
+import collections
+import torch
+import torch.nn.functional as F
+
+
+class MemoryBank(object):
+    """
+    Cross-batch memory of recent embeddings, used as extra negatives by the
+    contrastive losses of utils.cross_rank.CrossRank (no momentum encoder: the
+    embeddings are queued as the model produced them).
+
+    Every stream (image, segments, text) is a ring buffer [size, D] on the
+    device, allocated at the first `enqueue`. Entries older
+    than `max_age` steps are left out, which bounds how stale the negatives
+    get while the encoders move. Losses only see the batches queued before
+    the current one, so a sample is never its own negative within a step.
+
+    Args:
+        size (int): Embeddings kept per stream.
+        max_age (int, optional): Only use the entries of the last `max_age`
+            steps (0 keeps everything in the buffer).
+    """
+
+    def __init__(self, size, max_age=0):
+        self.size = size
+        self.max_age = max_age
+        self.buffers = {}
+        self.ptr = 0
+        self.count = 0
+        # batch sizes of the recent steps, to find the entries younger than max_age on the host
+        self.recent = collections.deque(maxlen=max_age or None)
+
+    def __len__(self):
+        if self.max_age:
+            return min(self.count, sum(self.recent))
+        return self.count
+
+    @torch.no_grad()
+    def enqueue(self, **embeddings):
+        """Queue the L2-normalized embeddings of one step, stream name -> [bs, D]."""
+        bs = None
+        for name, emb in embeddings.items():
+            emb = F.normalize(emb.detach().float(), dim=-1)
+            if name not in self.buffers:
+                self.buffers[name] = emb.new_zeros(self.size, emb.size(-1))
+            bs = emb.size(0)
+            idx = (self.ptr + torch.arange(bs, device=emb.device)) % self.size
+            # out of place: the buffer may still be saved for the backward of this step's loss
+            self.buffers[name] = self.buffers[name].index_copy(0, idx, emb)
+        if bs is None:
+            return
+        self.ptr = (self.ptr + bs) % self.size
+        self.count = min(self.count + bs, self.size)
+        self.recent.append(bs)
+
+    def get(self, name):
+        """Valid entries of a stream [n, D], the most recent last; None when empty."""
+        n = len(self)
+        if name not in self.buffers or n == 0:
+            return None
+        buffer = self.buffers[name]
+        if n == self.size:
+            return buffer
+        start = self.ptr - n
+        if start >= 0:
+            return buffer[start:self.ptr]
+        return torch.cat([buffer[start:], buffer[:self.ptr]])
+
+
+def build_memory_bank(args):
+    """Memory bank of `--memory_bank_size` entries, or None when disabled."""
+    size = getattr(args, "memory_bank_size", 0)
+    if not size:
+        return None
+    return MemoryBank(size, getattr(args, "memory_bank_max_age", 0))
+
+
+def set_memory_bank(model, memory_bank):
+    """Make the losses inside the forward of `model` (possibly DDP-wrapped) use `memory_bank`."""
+    module = model.module if hasattr(model, "module") else model
+    module.memory_bank = memory_bank
+    return model
+
+
+def benchmark(bank_sizes=(0, 1024), batch_size=16, dim=64, latent=64, noise=5.0, steps=1000, eval_every=10,
+              target_mr=90.0, margin=0.2, device="cpu", seed=0):
+    """
+    Convergence speed of the hinge loss with and without the memory bank, on
+    synthetic paired data: two linear encoders learn to align noisy views of
+    shared latents. The real comparison (epochs to a given mR on a dataset)
+    is the same loop with the training scripts and `--memory_bank_size`.
+
+    Returns:
+        dict: bank size -> steps to reach `target_mr` on held-out pairs
+            (None if not reached), final mR.
+    """
+    import types
+    import numpy as np
+    import utils.utils as utils
+    from utils.cross_rank import CrossRank
+
+    def make_data(n, generator):
+        z = torch.randn(n, latent, generator=generator)
+        return z @ proj_a + noise * torch.randn(n, dim, generator=generator), \
+            z @ proj_b + noise * torch.randn(n, dim, generator=generator)
+
+    def mean_recall(enc_a, enc_b, a, b):
+        with torch.no_grad():
+            sims = F.normalize(enc_a(a), dim=-1) @ F.normalize(enc_b(b), dim=-1).t()
+        sims = sims.cpu().numpy()
+        recalls = []
+        for s in (sims, sims.T):
+            ranks = (s > np.diag(s)[:, None]).sum(1)
+            recalls += [100 * (ranks < k).mean() for k in (1, 5, 10)]
+        return float(np.mean(recalls))
+
+    generator = torch.Generator().manual_seed(seed)
+    proj_a = torch.randn(latent, dim, generator=generator)
+    proj_b = torch.randn(latent, dim, generator=generator)
+    test_a, test_b = (x.to(device) for x in make_data(1000, generator))
+    args = types.SimpleNamespace(gpuid=torch.device(device).index or 0)
+    losses = CrossRank(args)
+
+    results = {}
+    for bank_size in bank_sizes:
+        torch.manual_seed(seed)
+        data_generator = torch.Generator().manual_seed(seed + 1)
+        enc_a, enc_b = torch.nn.Linear(dim, dim).to(device), torch.nn.Linear(dim, dim).to(device)
+        optimizer = torch.optim.Adam(list(enc_a.parameters()) + list(enc_b.parameters()), lr=1e-3)
+        bank = MemoryBank(bank_size) if bank_size else None
+        reached, mr = None, 0.0
+        for step in range(1, steps + 1):
+            a, b = (x.to(device) for x in make_data(batch_size, data_generator))
+            emb_a, emb_b = enc_a(a), enc_b(b)
+            scores = F.normalize(emb_a, dim=-1) @ F.normalize(emb_b, dim=-1).t()
+            if bank is None:
+                loss = utils.calcul_contraloss(args, scores, batch_size, margin, max_violation=True)
+            else:
+                loss = losses.contraloss(emb_a, emb_b, margin, max_violation=True, memory_bank=bank)
+                bank.enqueue(image=emb_a, text=emb_b)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if step % eval_every == 0:
+                mr = mean_recall(enc_a, enc_b, test_a, test_b)
+                if reached is None and mr >= target_mr:
+                    reached = step
+        results[bank_size] = (reached, mr)
+    return results
+
+
+if __name__ == "__main__":
+    # python -m utils.memory_bank --bank_sizes 0,1024,4096
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bank_sizes", default="0,1024", type=str, help="Comma-separated bank sizes, 0 is in-batch only")
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--steps", default=1000, type=int)
+    parser.add_argument("--target_mr", default=90.0, type=float)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    opt = parser.parse_args()
+
+    results = benchmark([int(s) for s in opt.bank_sizes.split(",")], opt.batch_size, steps=opt.steps,
+                        target_mr=opt.target_mr, device=opt.device)
+    for bank_size, (reached, mr) in results.items():
+        print(f"bank {bank_size}: steps to mR {opt.target_mr:g}: {reached}, final mR {mr:.2f}")
@@ -0,0 +1,358 @@
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+from collections import OrderedDict
+import torch
+from loguru import logger
+
+import utils.utils as utils
+
+
+SINKS = ("jsonl", "wandb", "stdout")
+
+# Sinks of this process, set by init_sinks. Nothing is logged before.
+_sinks = []
+_sampler = None
+
+
+def _to_json(value):
+    # tensors and numpy scalars
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class JsonlSink(object):
+    """
+    Append records as JSON lines to `path`. Records are queued and written in
+    batches by a background thread, every `flush_every` records or
+    `flush_interval` seconds, so logging never waits for the disk.
+    """
+
+    def __init__(self, path, flush_every=256, flush_interval=5.0):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="metrics-jsonl", daemon=True)
+        self.thread.start()
+
+    def log(self, record):
+        self.queue.put(record)
+
+    def _run(self):
+        buffer = []
+        last_write = time.time()
+        with open(self.path, "a") as f:
+            while True:
+                try:
+                    record = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    record = False
+                if record:
+                    buffer.append(json.dumps(record, default=_to_json))
+                if buffer and (record is None or len(buffer) >= self.flush_every
+                               or time.time() - last_write >= self.flush_interval):
+                    f.write("\n".join(buffer) + "\n")
+                    f.flush()
+                    buffer = []
+                    last_write = time.time()
+                if record is None:
+                    return
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class StdoutSink(object):
+    def log(self, record):
+        logger.info(" ".join(f"{k}: {v:.4f}" if isinstance(v, float) else f"{k}: {v}" for k, v in record.items()))
+
+    def close(self):
+        pass
+
+
+class WandbSink(object):
+    """
+    W&B run of `args`. The API key is read by wandb from WANDB_API_KEY or
+    ~/.netrc and the mode from WANDB_MODE (offline by default).
+    """
+
+    def __init__(self, args):
+        import wandb
+
+        os.environ["WANDB_DIR"] = args.wandb_logging_dir
+        self.wandb = wandb
+        wandb.init(
+            project="UrbanCross",
+            config=args,
+            name=args.experiment_name,
+            id=args.wandb_id,
+            mode=os.environ.get("WANDB_MODE", "offline"),
+        )
+
+    def log(self, record):
+        self.wandb.log(record)
+
+    def close(self):
+        self.wandb.finish()
+
+
+def init_sinks(args):
+    """
+    Set up the metrics sinks listed in `args.metrics_sinks` (comma-separated,
+    from SINKS) and the resource sampler, on the main process only. The JSONL
+    file is `<wandb_logging_dir>/metrics/<experiment_name>-<wandb_id>.jsonl`.
+    """
+    global _sampler
+    if not args.wandb_id:
+        args.wandb_id = uuid.uuid4().hex[:8]
+    logger.info(f"Run ID: {args.wandb_id}")
+    if getattr(args, "rank", 0) != 0:
+        return
+
+    for name in args.metrics_sinks.split(","):
+        name = name.strip()
+        if name == "jsonl":
+            path = os.path.join(args.wandb_logging_dir, "metrics", f"{args.experiment_name}-{args.wandb_id}.jsonl")
+            _sinks.append(JsonlSink(path))
+            logger.info(f"Metrics written to {path}")
+        elif name == "wandb":
+            _sinks.append(WandbSink(args))
+        elif name == "stdout":
+            _sinks.append(StdoutSink())
+        elif name:
+            raise ValueError(f"Unknown metrics sink '{name}', expected one of {SINKS}")
+
+    interval = getattr(args, "resource_interval", 0)
+    if interval > 0:
+        _sampler = ResourceSampler(interval, getattr(args, "gpuid", 0))
+        _sampler.start()
+    atexit.register(close_sinks)
+
+
+def log(values):
+    """Hand `values` (name -> number) to every sink, stamped with the wall time."""
+    if not _sinks:
+        return
+    record = dict(values)
+    record.setdefault("time", time.time())
+    for sink in _sinks:
+        sink.log(record)
+
+
+def close_sinks():
+    global _sampler
+    if _sampler is not None:
+        _sampler.stop()
+        _sampler = None
+    while _sinks:
+        _sinks.pop().close()
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Log the resources of the process every `interval` seconds from a
+    background thread: CPU utilization, resident memory and, with CUDA,
+    the allocated/reserved memory of the device (plus its utilization when
+    pynvml is installed).
+    """
+
+    def __init__(self, interval=10.0, gpuid=0):
+        super().__init__(name="metrics-resources", daemon=True)
+        self.interval = interval
+        self.gpuid = gpuid
+        self.stopped = threading.Event()
+        self.last = None
+
+    @staticmethod
+    def _rss_mb():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+        except (OSError, ValueError):
+            import resource
+
+            # peak RSS where /proc is not available
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def sample(self, nvml_handle=None):
+        times = os.times()
+        now = time.time()
+        cpu = times.user + times.system
+        values = {"sys/rss_mb": self._rss_mb()}
+        if self.last is not None:
+            values["sys/cpu_percent"] = 100 * (cpu - self.last[0]) / max(now - self.last[1], 1e-6)
+        self.last = (cpu, now)
+        if torch.cuda.is_available():
+            values["sys/gpu_allocated_mb"] = torch.cuda.memory_allocated(self.gpuid) / 2 ** 20
+            values["sys/gpu_reserved_mb"] = torch.cuda.memory_reserved(self.gpuid) / 2 ** 20
+            if nvml_handle is not None:
+                import pynvml
+
+                values["sys/gpu_util_percent"] = pynvml.nvmlDeviceGetUtilizationRates(nvml_handle).gpu
+        return values
+
+    def run(self):
+        nvml_handle = None
+        if torch.cuda.is_available():
+            try:
+                import pynvml
+
+                pynvml.nvmlInit()
+                nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(self.gpuid)
+            except Exception:
+                nvml_handle = None
+        while not self.stopped.wait(self.interval):
+            log(self.sample(nvml_handle))
+        if nvml_handle is not None:
+            import pynvml
+
+            pynvml.nvmlShutdown()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def synchronize(args):
+    """
+    Wait for the device, only when `--sync_timing` asks for exact per-step
+    timings. Otherwise the host runs ahead and batch times are host times
+    (with fp16 the GradScaler step still waits for the backward, see
+    utils.precision.Precision).
+    """
+    if getattr(args, "sync_timing", False) and torch.cuda.is_available():
+        torch.cuda.synchronize(device=args.gpuid)
+
+
+class StepMetrics(object):
+    """
+    Loss components accumulated as device tensors during training, so logging
+    never makes a step wait for the device. `flush` copies their means to the host in one
+    transfer (reduced across ranks when distributed) and hands them to the
+    LogCollector and the metrics sinks.
+    """
+
+    def __init__(self, args, train_logger):
+        self.args = args
+        self.train_logger = train_logger
+        self.sums = OrderedDict()
+        self.steps = 0
+
+    def update(self, **values):
+        for k, v in values.items():
+            v = v.detach().float().reshape(())
+            self.sums[k] = v if k not in self.sums else self.sums[k] + v
+        self.steps += 1
+
+    def flush(self, **host_values):
+        """
+        Log the means since the last flush. Must be called by every rank at
+        the same step when distributed.
+
+        Args:
+            **host_values: Values already on the host (epoch, timings), logged as is.
+
+        Returns:
+            dict: Mean of every metric.
+        """
+        means = {}
+        if self.steps:
+            keys = list(self.sums)
+            values = torch.stack([self.sums[k] for k in keys]) / self.steps
+            if self.args.distributed:
+                values = utils.reduce_value(self.args, values, average=True)
+            means = dict(zip(keys, values.cpu().tolist()))
+            for k, v in means.items():
+                self.train_logger.update(k.capitalize(), v)
+            self.sums.clear()
+            self.steps = 0
+        log(dict(means, **host_values))
+        return means
+
+
+def benchmark(model_name="ViT-B-16", batch_size=32, steps=20, print_freq=10, device="cuda"):
+    """
+    Training steps per second of an open_clip model (randomly initialized)
+    with the former per-step logging (three synchronizations and a host copy
+    of every loss component) and with StepMetrics. The steps run in fp32
+    without loss scaling, so the fp16 GradScaler sync is in neither mode.
+
+    Returns:
+        dict: "per_step_sync" / "step_metrics" -> steps per second.
+    """
+    import time
+    import types
+    import open_clip_mine
+
+    model = open_clip_mine.create_model(model_name, output_dict=True).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    image_size = model.visual.image_size
+    images = torch.randn(batch_size, 3, image_size[0], image_size[1], device=device)
+    texts = torch.randint(1, 49407, (batch_size, 77), device=device)
+    labels = torch.arange(batch_size, device=device)
+    use_cuda = device.startswith("cuda")
+    args = types.SimpleNamespace(distributed=False, gpuid=torch.device(device).index or 0, sync_timing=False)
+
+    def step():
+        out = model(images, texts)
+        logits = out["logit_scale"] * out["image_features"] @ out["text_features"].t()
+        loss_i = torch.nn.functional.cross_entropy(logits, labels)
+        loss_t = torch.nn.functional.cross_entropy(logits.t(), labels)
+        loss = (loss_i + loss_t) / 2
+        optimizer.zero_grad()
+        loss.backward()
+        return loss, loss_i, loss_t
+
+    results = {}
+    for mode in ("per_step_sync", "step_metrics"):
+        step_metrics = StepMetrics(args, utils.LogCollector())
+        step()  # warmup
+        if use_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for i in range(steps):
+            if mode == "per_step_sync":
+                if use_cuda:
+                    torch.cuda.synchronize()
+                loss, loss_i, loss_t = step()
+                [v.cpu().data.numpy() for v in (loss, loss_i, loss_t)]
+                if use_cuda:
+                    torch.cuda.synchronize()
+                optimizer.step()
+                if use_cuda:
+                    torch.cuda.synchronize()
+            else:
+                loss, loss_i, loss_t = step()
+                step_metrics.update(loss=loss, loss_i=loss_i, loss_t=loss_t)
+                optimizer.step()
+                if i % print_freq == 0:
+                    step_metrics.flush()
+        if use_cuda:
+            torch.cuda.synchronize()
+        results[mode] = steps / (time.time() - start)
+    return results
+
+
+if __name__ == "__main__":
+    # python -m utils.metrics --device cuda --batch_size 64
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="ViT-B-16", type=str, help="open_clip model name")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--steps", default=20, type=int)
+    parser.add_argument("--print_freq", default=10, type=int)
+    opt = parser.parse_args()
+
+    results = benchmark(opt.model, opt.batch_size, opt.steps, opt.print_freq, opt.device)
+    for mode, steps_per_s in results.items():
+        print(f"{mode}: {steps_per_s:.2f} steps/s")
@@ -0,0 +1,164 @@
+import contextlib
+import torch
+from torch.nn.utils import clip_grad_norm_
+
+
+PRECISIONS = ("fp32", "fp16", "bf16")
+
+_AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def _grad_scaler(device_type, enabled):
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    # torch < 2.3 only has the CUDA scaler
+    return torch.cuda.amp.GradScaler(enabled=enabled and device_type == "cuda")
+
+
+class Precision(object):
+    """
+    Autocast and loss scaling of one training run.
+
+    fp32 runs without autocast, bf16 autocasts without loss scaling and fp16
+    autocasts with a GradScaler. Works with CUDA and CPU autocast.
+
+    The fp16 optimizer step reads the scaler's inf/nan check on the host, so
+    it waits for the backward to finish: one device synchronization per step
+    that fp32 and bf16 do not have.
+    """
+
+    def __init__(self, precision="fp32", device_type="cuda"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+        self.precision = precision
+        self.device_type = device_type
+        self.dtype = _AUTOCAST_DTYPES.get(precision, torch.float32)
+        self.scaler = _grad_scaler(device_type, enabled=precision == "fp16")
+        # ids of the optimizers whose gradients `clip` has unscaled since the last step
+        self._unscaled = set()
+
+    def autocast(self):
+        if self.precision == "fp32":
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def clip(self, optimizer, params, grad_clip):
+        """Unscale the gradients and clip them, if `grad_clip` > 0. At most once per step."""
+        if grad_clip > 0 and id(optimizer) not in self._unscaled:
+            self.scaler.unscale_(optimizer)
+            self._unscaled.add(id(optimizer))
+            clip_grad_norm_(params, grad_clip)
+
+    def step(self, optimizer, params=None, grad_clip=0):
+        """
+        Unscale the gradients, clip them if `grad_clip` > 0 (unless `clip` was
+        already called) and step the optimizer. With fp16 the step is skipped
+        when the gradients overflowed.
+        """
+        self.clip(optimizer, params, grad_clip)
+        self.scaler.step(optimizer)
+        self.scaler.update()
+        self._unscaled.discard(id(optimizer))
+
+    def state_dict(self):
+        return {"precision": self.precision, "scaler": self.scaler.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        # the scale is only meaningful for the same precision
+        if state_dict.get("precision") == self.precision and state_dict.get("scaler"):
+            self.scaler.load_state_dict(state_dict["scaler"])
+
+
+def build_precision(args):
+    """
+    Precision of a run from `args.precision`. Without it, `--use_mix_precision`
+    selects fp16; otherwise CUDA keeps the fp16 autocast the models always
+    used and CPU runs in fp32.
+    """
+    device_type = "cuda" if torch.cuda.is_available() else "cpu"
+    precision = getattr(args, "precision", None)
+    if precision is None:
+        if getattr(args, "use_mix_precision", False) or device_type == "cuda":
+            precision = "fp16"
+        else:
+            precision = "fp32"
+    return Precision(precision, device_type)
+
+
+def set_precision(model, precision):
+    """Make the autocast inside the forward of `model` (possibly DDP-wrapped) follow `precision`."""
+    module = model.module if hasattr(model, "module") else model
+    module.precision = precision
+    return model
+
+
+def benchmark(model_name="ViT-B-16", batch_size=32, steps=5, device="cuda", precisions=PRECISIONS):
+    """
+    Step time and peak memory of a contrastive training step of an open_clip
+    model (randomly initialized) in every precision mode.
+
+    Peak memory is the CUDA allocator peak of the mode; on CPU it is the peak
+    RSS of the process, which only grows across modes.
+
+    Returns:
+        dict: precision -> (seconds per step, peak memory in MB).
+    """
+    import time
+    import resource
+    import open_clip_mine
+
+    device_type = device.split(":")[0]
+    results = {}
+    for name in precisions:
+        model = open_clip_mine.create_model(model_name, output_dict=True).to(device)
+        set_precision(model, Precision(name, device_type))
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+        image_size = model.visual.image_size
+        images = torch.randn(batch_size, 3, image_size[0], image_size[1], device=device)
+        texts = torch.randint(1, 49407, (batch_size, 77), device=device)
+        labels = torch.arange(batch_size, device=device)
+
+        if device_type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        for step in range(steps + 1):
+            if step == 1:  # the first step is warmup
+                if device_type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.time()
+            with model.precision.autocast():
+                out = model(images, texts)
+                logits = out["logit_scale"] * out["image_features"] @ out["text_features"].t()
+                loss = (torch.nn.functional.cross_entropy(logits, labels)
+                        + torch.nn.functional.cross_entropy(logits.t(), labels)) / 2
+            optimizer.zero_grad()
+            model.precision.backward(loss)
+            model.precision.step(optimizer, list(model.parameters()), grad_clip=2.0)
+        if device_type == "cuda":
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() / 2 ** 20
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        results[name] = ((time.time() - start) / steps, peak)
+        del model, optimizer
+    return results
+
+
+if __name__ == "__main__":
+    # python -m utils.precision --device cuda --batch_size 64
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="ViT-B-16", type=str, help="open_clip model name")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--steps", default=5, type=int)
+    parser.add_argument("--precisions", default=",".join(PRECISIONS), type=str, help="Comma-separated modes")
+    opt = parser.parse_args()
+
+    results = benchmark(opt.model, opt.batch_size, opt.steps, opt.device, opt.precisions.split(","))
+    for name, (step_time, peak) in results.items():
+        print(f"{name}: {step_time:.3f} s/step, peak memory {peak:.0f} MB")
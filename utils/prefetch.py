@@ -0,0 +1,170 @@
+import queue
+import threading
+import time
+import torch
+
+
+class _WorkerError(object):
+    """Carries an exception raised in the prefetch thread to the training loop."""
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+_END = object()
+
+
+def move_to_device(batch, device, non_blocking=True):
+    """
+    Recursively move the tensors of a (possibly nested) batch to `device`.
+
+    Args:
+        batch: Tensor, or tuple/list/dict of batches. Other objects are returned unchanged.
+        device (torch.device): Target device.
+        non_blocking (bool, optional): Asynchronous copy from pinned memory. Defaults to True.
+
+    Returns:
+        The batch with every tensor on `device`.
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(move_to_device(b, device, non_blocking) for b in batch)
+    if isinstance(batch, dict):
+        return {k: move_to_device(v, device, non_blocking) for k, v in batch.items()}
+    return batch
+
+
+def _record_stream(batch, stream):
+    # Tell the caching allocator the tensors are now used on `stream`,
+    # so their memory is not reused while the copy stream moves on
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, (tuple, list)):
+        for b in batch:
+            _record_stream(b, stream)
+    elif isinstance(batch, dict):
+        for b in batch.values():
+            _record_stream(b, stream)
+
+
+class BatchPrefetcher(object):
+    """
+    Iterate over a loader while a background thread keeps `num_prefetch`
+    batches ahead, already collated and copied to `device`.
+
+    Works with any iterable of batches, including the paired
+    (source_batch, target_batch) iterables used for fine-tuning. On CUDA
+    the host-to-device copies run on a side stream, so they overlap with
+    the compute of the previous step; on CPU batches are passed through.
+    """
+
+    def __init__(self, loader, device=None, num_prefetch=2, length=None):
+        """
+        Initialize the BatchPrefetcher.
+
+        Args:
+            loader (iterable): DataLoader or any iterable of (nested) batches.
+            device (torch.device, optional): Target device. Defaults to CPU.
+            num_prefetch (int, optional): Number of batches kept ahead. Defaults to 2.
+            length (int, optional): Number of batches, if `loader` has no len().
+        """
+        self.loader = loader
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+        self.num_prefetch = max(1, num_prefetch)
+        self.length = length
+        self.use_cuda = self.device.type == "cuda"
+
+        # Time the consumer spent blocked waiting for the next batch
+        self.last_wait = 0.0
+        self.wait_time = 0.0
+        self.num_batches = 0
+
+    def __len__(self):
+        if self.length is not None:
+            return self.length
+        return len(self.loader)
+
+    def _worker(self, out_queue, stop_event, stream):
+        try:
+            for batch in self.loader:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = move_to_device(batch, self.device)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = move_to_device(batch, self.device)
+                    event = None
+                if not self._put(out_queue, stop_event, (batch, event)):
+                    return
+            self._put(out_queue, stop_event, _END)
+        except Exception as e:
+            self._put(out_queue, stop_event, _WorkerError(e))
+
+    @staticmethod
+    def _put(out_queue, stop_event, item):
+        # Bounded put that gives up once the consumer has stopped iterating
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        out_queue = queue.Queue(maxsize=self.num_prefetch)
+        stop_event = threading.Event()
+        stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        thread = threading.Thread(
+            target=self._worker, args=(out_queue, stop_event, stream), daemon=True
+        )
+        thread.start()
+
+        try:
+            while True:
+                start = time.time()
+                item = out_queue.get()
+                self.last_wait = time.time() - start
+                self.wait_time += self.last_wait
+
+                if item is _END:
+                    break
+                if isinstance(item, _WorkerError):
+                    raise item.exc
+
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    # Make the compute stream wait for the copy without blocking the host
+                    event.wait(current_stream)
+                    _record_stream(batch, current_stream)
+                self.num_batches += 1
+                yield batch
+        finally:
+            # Also reached when the consumer breaks out early or drops the iterator
+            stop_event.set()
+            thread.join(timeout=1.0)
+
+
+def build_prefetcher(args, loader, length=None):
+    """
+    Wrap `loader` in a BatchPrefetcher configured by the command line arguments.
+
+    Args:
+        args (argparse.Namespace): Parsed arguments (`prefetch`, `gpuid`).
+        loader (iterable): DataLoader or iterable of (nested) batches.
+        length (int, optional): Number of batches, if `loader` has no len().
+
+    Returns:
+        iterable: The prefetcher, or `loader` itself when prefetching is disabled.
+    """
+    num_prefetch = getattr(args, "prefetch", 0)
+    if num_prefetch <= 0:
+        return loader
+    if torch.cuda.is_available():
+        device = torch.device("cuda", args.gpuid)
+    else:
+        device = torch.device("cpu")
+    return BatchPrefetcher(loader, device=device, num_prefetch=num_prefetch, length=length)
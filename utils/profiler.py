@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import contextlib
+from collections import OrderedDict
+
+import torch
+from loguru import logger
+
+
+# Phases of a training step, in order. Steps whose model computes the losses
+# inside forward (fine-tuning) have no separate "loss" phase.
+PHASES = ("data_wait", "h2d", "forward", "loss", "backward", "grad_clip", "optimizer", "logging")
+# Phases that launch no kernels of their own, timed on the host even with CUDA
+HOST_PHASES = frozenset(("data_wait", "logging", "sampler_refresh"))
+
+_DISABLED = contextlib.nullcontext()
+
+
+class _Phase(object):
+    __slots__ = ("profiler", "name", "start", "record", "use_cuda")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.use_cuda = profiler.use_cuda and name not in HOST_PHASES
+
+    def __enter__(self):
+        profiler = self.profiler
+        self.record = None
+        if profiler.torch_profiler is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        if self.use_cuda:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        if self.use_cuda:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            profiler.pending.append((self.name, self.start, end))
+        else:
+            profiler.add(self.name, (time.perf_counter() - self.start) * 1000)
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        return False
+
+
+class StepProfiler(object):
+    """
+    Per-phase timing of a training loop, enabled with `--profile`.
+
+    Device phases are timed with CUDA events that are only read once they
+    have completed, so profiling does not synchronize the steps; the phases in
+    HOST_PHASES (data wait, logging, sampler refresh) are timed on the host. When disabled, `phase` returns a shared no-op
+    context and `iterate` the iterable itself.
+
+    With `--profile_trace_steps N`, `torch.profiler` also records N steps
+    (after `--profile_trace_wait` steps and one warmup step) and exports a
+    Chrome trace. `summary` logs a per-phase table and writes it as JSON.
+    In distributed runs every rank profiles itself and the file names carry
+    a `_rank<rank>` suffix.
+    """
+
+    def __init__(self, args, epoch=0, name="train"):
+        self.enabled = getattr(args, "profile", False)
+        self.torch_profiler = None
+        if not self.enabled:
+            return
+        self.name = name
+        self.epoch = epoch
+        self.file_prefix = f"{name}_epoch{epoch}"
+        if getattr(args, "distributed", False):
+            self.file_prefix += f"_rank{args.rank}"
+        self.out_dir = getattr(args, "profile_dir", "./profile/")
+        self.use_cuda = torch.cuda.is_available()
+        self.totals = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.counts = OrderedDict((phase, 0) for phase in PHASES)
+        self.pending = []
+        self.steps = 0
+        self.start_time = time.time()
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        trace_steps = getattr(args, "profile_trace_steps", 0)
+        if trace_steps:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(
+                    wait=getattr(args, "profile_trace_wait", 5), warmup=1, active=trace_steps, repeat=1
+                ),
+                on_trace_ready=self._export_trace,
+            )
+            self.torch_profiler.start()
+
+    def _export_trace(self, prof):
+        path = os.path.join(self.out_dir, f"{self.file_prefix}_trace.json")
+        prof.export_chrome_trace(path)
+        logger.info(f"Chrome trace written to {path}")
+
+    def phase(self, name):
+        if not self.enabled:
+            return _DISABLED
+        return _Phase(self, name)
+
+    def iterate(self, iterable):
+        """Iterate over `iterable`, timing the wait for each item as the data_wait phase."""
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(iterable)
+
+    def _timed_iter(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add("data_wait", (time.perf_counter() - start) * 1000)
+            yield item
+
+    def add(self, name, ms):
+        self.totals[name] = self.totals.get(name, 0.0) + ms
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _resolve(self, wait=False):
+        remaining = []
+        for name, start, end in self.pending:
+            if wait or end.query():
+                if wait:
+                    end.synchronize()
+                self.add(name, start.elapsed_time(end))
+            else:
+                remaining.append((name, start, end))
+        self.pending = remaining
+
+    def step(self):
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self.pending:
+            self._resolve()
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def summary(self):
+        """
+        Log the per-phase table of the epoch and write it to
+        `<profile_dir>/<name>_epoch<epoch>[_rank<rank>]_phases.json`.
+
+        Returns:
+            dict: phase -> {"total_ms", "mean_ms", "share"}; empty when disabled.
+        """
+        if not self.enabled:
+            return {}
+        self._resolve(wait=True)
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+
+        measured = sum(self.totals.values()) or 1.0
+        table = OrderedDict()
+        for phase, total in self.totals.items():
+            count = self.counts[phase]
+            if not count:
+                continue
+            table[phase] = {"total_ms": total, "mean_ms": total / count, "share": total / measured}
+
+        lines = [f"{'phase':<16}{'total ms':>12}{'mean ms':>10}{'share':>8}"]
+        for phase, row in table.items():
+            lines.append(f"{phase:<16}{row['total_ms']:>12.1f}{row['mean_ms']:>10.2f}{row['share']:>8.1%}")
+        lines.append(f"{self.steps} steps, {time.time() - self.start_time:.1f} s wall")
+        logger.info(f"Step phases of {self.name} epoch {self.epoch}:\n" + "\n".join(lines))
+
+        path = os.path.join(self.out_dir, f"{self.file_prefix}_phases.json")
+        with open(path, "w") as f:
+            json.dump({"epoch": self.epoch, "steps": self.steps, "phases": table}, f, indent=2)
+        return table
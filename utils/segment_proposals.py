@@ -0,0 +1,125 @@
+import numpy as np
+import cv2
+
+try:
+    from skimage.segmentation import felzenszwalb
+except ImportError:
+    felzenszwalb = None
+
+
+# Every backend returns SamAutomaticMaskGenerator-style annotations:
+# [{"segmentation": HxW bool ndarray, "area": int, "bbox": [x, y, w, h]}, ...]
+PROPOSAL_BACKENDS = ("sam", "grid", "felzenszwalb")
+
+
+def _annotation(mask):
+    ys, xs = np.nonzero(mask)
+    x0, y0 = int(xs.min()), int(ys.min())
+    return {
+        "segmentation": mask,
+        "area": int(len(xs)),
+        "bbox": [x0, y0, int(xs.max()) - x0 + 1, int(ys.max()) - y0 + 1],
+    }
+
+
+class SamProposer(object):
+    """Segment Anything automatic mask generation (GPU, the reference backend)."""
+
+    def __init__(self, checkpoint, model_type="vit_h", device="cuda"):
+        # segment_anything is not vendored, only needed for this backend
+        from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+
+        sam = sam_model_registry[model_type](checkpoint=checkpoint)
+        sam.to(device=device)
+        self.mask_generator = SamAutomaticMaskGenerator(sam)
+
+    def generate(self, image):
+        return self.mask_generator.generate(image)
+
+
+class GridProposer(object):
+    """
+    Multi-scale grid crops: the image split into s x s rectangular tiles for
+    every scale s. No model involved, the CLIP scoring picks the tiles that
+    match the description.
+    """
+
+    def __init__(self, scales=(2, 3, 4)):
+        self.scales = scales
+
+    def generate(self, image):
+        height, width = image.shape[:2]
+        anns = []
+        for s in self.scales:
+            ys = np.linspace(0, height, s + 1).astype(int)
+            xs = np.linspace(0, width, s + 1).astype(int)
+            for i in range(s):
+                for j in range(s):
+                    mask = np.zeros((height, width), dtype=bool)
+                    mask[ys[i]:ys[i + 1], xs[j]:xs[j + 1]] = True
+                    anns.append(_annotation(mask))
+        return anns
+
+
+class FelzenszwalbProposer(object):
+    """
+    Graph-based region merging (Felzenszwalb & Huttenlocher) at several scales,
+    on CPU. Runs on a downscaled copy of the image and upsamples the labels.
+    Needs scikit-image.
+    """
+
+    def __init__(self, scales=(100, 300, 1000), sigma=0.8, min_area=0.005, max_side=512):
+        """
+        Initialize the FelzenszwalbProposer.
+
+        Args:
+            scales (tuple, optional): Felzenszwalb `scale` values, larger gives larger regions.
+            sigma (float, optional): Gaussian smoothing before segmentation.
+            min_area (float, optional): Regions smaller than this fraction of the image are dropped.
+            max_side (int, optional): The image is downscaled to this longest side first.
+        """
+        if felzenszwalb is None:
+            raise ImportError("The felzenszwalb proposal backend requires scikit-image")
+        self.scales = scales
+        self.sigma = sigma
+        self.min_area = min_area
+        self.max_side = max_side
+
+    def generate(self, image):
+        height, width = image.shape[:2]
+        factor = min(1.0, self.max_side / max(height, width))
+        small = cv2.resize(image, (max(1, int(width * factor)), max(1, int(height * factor))), interpolation=cv2.INTER_AREA)
+        min_pixels = self.min_area * small.shape[0] * small.shape[1]
+
+        anns = []
+        for scale in self.scales:
+            labels = felzenszwalb(small, scale=scale, sigma=self.sigma, min_size=int(min_pixels))
+            labels = cv2.resize(labels.astype(np.int32), (width, height), interpolation=cv2.INTER_NEAREST)
+            ids, counts = np.unique(labels, return_counts=True)
+            for label, count in zip(ids, counts):
+                if count < self.min_area * height * width:
+                    continue
+                anns.append(_annotation(labels == label))
+        return anns
+
+
+def build_proposer(backend, sam_checkpoint=None, sam_model_type="vit_h", device="cuda"):
+    """
+    Build a segment proposal backend.
+
+    Args:
+        backend (str): One of PROPOSAL_BACKENDS.
+        sam_checkpoint (str, optional): SAM checkpoint, for the "sam" backend.
+        sam_model_type (str, optional): SAM model type, for the "sam" backend.
+        device (str, optional): Device of the "sam" backend.
+
+    Returns:
+        object: Proposer with a `generate(image)` method taking an HxWx3 RGB array.
+    """
+    if backend == "sam":
+        return SamProposer(sam_checkpoint, sam_model_type, device)
+    if backend == "grid":
+        return GridProposer()
+    if backend == "felzenszwalb":
+        return FelzenszwalbProposer()
+    raise ValueError(f"Unknown segment proposal backend '{backend}', expected one of {PROPOSAL_BACKENDS}")
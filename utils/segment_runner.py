@@ -0,0 +1,307 @@
+import os
+import json
+import glob
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import torch
+import cv2
+import matplotlib.pyplot as plt
+from PIL import Image
+from loguru import logger
+
+# Usage (from the repository root), e.g. on two machines:
+# python -m utils.segment_runner --img_dir .../Germany/images --csv .../Germany/instructblip_generation_germany_refine.csv --shard 0/2
+# python -m utils.segment_runner --img_dir .../Germany/images --csv .../Germany/instructblip_generation_germany_refine.csv --shard 1/2
+import utils.get_segments_sam as gs
+from utils.segment_proposals import PROPOSAL_BACKENDS, build_proposer
+from utils.segment_store import PACKED_EXTENSION, save_packed, segment_roots
+
+
+_DONE = object()
+
+
+def parse_shard(shard):
+    """
+    Parse a "i/N" shard specification.
+
+    Args:
+        shard (str): Shard index and number of shards, e.g. "0/4".
+
+    Returns:
+        tuple: (index, count).
+    """
+    index, count = (int(x) for x in shard.split("/"))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{shard}', expected i/N with 0 <= i < N")
+    return index, count
+
+
+class Manifest(object):
+    """
+    Append-only JSON lines log of processed images, one file per shard.
+
+    A line is appended only once all segments of an image are written, so on
+    restart every image listed as "ok" in any manifest of the directory is
+    skipped without touching its segment directory.
+    """
+
+    def __init__(self, manifest_dir, shard_index, shard_count):
+        os.makedirs(manifest_dir, exist_ok=True)
+        self.manifest_dir = manifest_dir
+        self.path = os.path.join(manifest_dir, f"manifest_shard{shard_index}-of-{shard_count}.jsonl")
+        self.lock = threading.Lock()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    @staticmethod
+    def load(manifest_dir):
+        """Return image_name -> last entry over all manifests of `manifest_dir`."""
+        entries = {}
+        for path in sorted(glob.glob(os.path.join(manifest_dir, "manifest*.jsonl"))):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Line cut short by a killed job, the image is simply redone
+                        continue
+                    entries[entry["image_name"]] = entry
+        return entries
+
+    def append(self, image_name, num_segments, status="ok"):
+        entry = {"image_name": image_name, "num_segments": num_segments, "status": status, "time": time.time()}
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def _decode_worker(job_queue, decoded_queue):
+    while True:
+        try:
+            job = job_queue.get_nowait()
+        except queue.Empty:
+            decoded_queue.put(_DONE)
+            return
+        image = cv2.imread(job["image_path"])
+        if image is not None:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        decoded_queue.put((job, image))
+
+
+def _write_worker(write_queue, manifest, segment_format):
+    while True:
+        item = write_queue.get()
+        if item is _DONE:
+            return
+        job, image, segments, status = item
+        try:
+            if segments and segment_format in ("jpeg", "both"):
+                os.makedirs(job["seg_path"], exist_ok=True)
+                for idx, mask, _ in segments:
+                    masked_img = np.where(mask[..., None], image, np.uint8(255))
+                    plt.imsave(os.path.join(job["seg_path"], f"{job['img_name']}_{idx}.jpg"), masked_img)
+            if segments and segment_format in ("packed", "both"):
+                save_packed(
+                    job["packed_path"],
+                    [mask for _, mask, _ in segments],
+                    ranks=[idx for idx, _, _ in segments],
+                    scores=[score for _, _, score in segments],
+                )
+        except Exception as e:
+            logger.error(f"Error writing segments of {job['image_name']}: {e}")
+            status = "failed"
+        manifest.append(job["image_name"], len(segments), status)
+
+
+def _encode_segments(anns, image, max_segments):
+    # Preprocess every masked segment right away, so at most one full-size
+    # masked copy of the image is alive at a time
+    sorted_anns = sorted(anns, key=lambda x: x["area"], reverse=True)[:max_segments]
+    tensors = []
+    for ann in sorted_anns:
+        masked_img = np.where(ann["segmentation"][..., None], image, np.uint8(255))
+        tensors.append(gs.preprocess(Image.fromarray(masked_img)))
+    return sorted_anns, tensors
+
+
+def _score_batch(batch, mask_generator, max_segments, top_k, clip_batch_size):
+    """
+    Generate masks for a batch of decoded images and score all their segments
+    with batched `encode_image` calls over the whole batch.
+
+    Returns:
+        list: (job, image, [(area rank, mask, similarity)], status) tuples for the writers.
+    """
+    results = []
+    pending = []  # (job, image, sorted_anns, text_features, first tensor, num tensors)
+    tensors = []
+    for job, image in batch:
+        if image is None:
+            logger.warning(f"Image not found: {job['image_path']}")
+            results.append((job, None, [], "failed"))
+            continue
+        try:
+            anns = mask_generator.generate(image)
+            text_features = gs.encode_description(job["description"]) if anns else None
+            if text_features is None:
+                results.append((job, None, [], "ok"))
+                continue
+            sorted_anns, image_tensors = _encode_segments(anns, image, max_segments)
+        except Exception as e:
+            logger.error(f"Error processing image {job['image_name']}: {e}")
+            results.append((job, None, [], "failed"))
+            continue
+        pending.append((job, image, sorted_anns, text_features, len(tensors), len(image_tensors)))
+        tensors.extend(image_tensors)
+
+    if not pending:
+        return results
+
+    image_features = []
+    with torch.no_grad():
+        for start in range(0, len(tensors), clip_batch_size):
+            chunk = torch.stack(tensors[start:start + clip_batch_size]).to(gs.device)
+            image_features.append(gs.clip_model.encode_image(chunk))
+    image_features = torch.cat(image_features)
+
+    for job, image, sorted_anns, text_features, first, count in pending:
+        similarities = torch.cosine_similarity(text_features, image_features[first:first + count], dim=1)
+        top_similarities, top_index = torch.topk(similarities.float(), min(top_k, count))
+        # Masked images are rendered by the writers, only the masks travel
+        segments = [
+            (idx, np.asarray(sorted_anns[idx]["segmentation"], dtype=bool), score)
+            for score, idx in zip(top_similarities.tolist(), top_index.tolist())
+        ]
+        results.append((job, image, segments, "ok"))
+    return results
+
+
+def build_jobs(df, img_dir, seg_root, packed_root, shard_index, shard_count, done):
+    """
+    List the images of this shard that are not yet in the manifest.
+
+    Rows are assigned to shards by their position in the CSV, so every shard
+    sees a disjoint, stable subset regardless of what is already done.
+    """
+    jobs = []
+    for position, row in enumerate(df.itertuples(index=False)):
+        if position % shard_count != shard_index:
+            continue
+        image_name = row.image_name
+        entry = done.get(image_name)
+        if entry is not None and entry["status"] == "ok":
+            continue
+        image_path = os.path.join(img_dir, image_name)
+        if not os.path.exists(image_path):
+            continue
+        img_name = image_name.split(".")[0]
+        jobs.append({
+            "image_name": image_name,
+            "image_path": image_path,
+            "img_name": img_name,
+            "seg_path": os.path.join(seg_root, img_name),
+            "packed_path": os.path.join(packed_root, img_name + PACKED_EXTENSION),
+            "description": row.description,
+        })
+    return jobs
+
+
+def write_fixed_csv(df, manifest_dir, out_csv):
+    """Write `df` without the rows whose images failed in any manifest, like the old script did."""
+    done = Manifest.load(manifest_dir)
+    failed = {name for name, entry in done.items() if entry["status"] == "failed"}
+    df[~df["image_name"].isin(failed)].to_csv(out_csv, index=False)
+    logger.info(f"Wrote {out_csv} without {len(failed)} failed rows")
+
+
+def run(opt):
+    shard_index, shard_count = parse_shard(opt.shard)
+    country_dir = os.path.dirname(opt.img_dir.rstrip("/"))
+    default_seg_root, default_packed_root = segment_roots(country_dir, opt.proposal_backend)
+    seg_root = opt.seg_dir or default_seg_root
+    packed_root = opt.packed_dir or default_packed_root
+    manifest_dir = opt.manifest_dir or (packed_root if opt.segment_format == "packed" else seg_root)
+
+    df = pd.read_csv(opt.csv)
+    done = Manifest.load(manifest_dir)
+    jobs = build_jobs(df, opt.img_dir, seg_root, packed_root, shard_index, shard_count, done)
+    logger.info(f"Shard {shard_index}/{shard_count}: {len(jobs)} images to process, {len(done)} in manifest")
+
+    if jobs:
+        mask_generator = build_proposer(opt.proposal_backend, opt.sam_checkpoint, opt.model_type, device=gs.device)
+
+        job_queue = queue.Queue()
+        for job in jobs:
+            job_queue.put(job)
+        decoded_queue = queue.Queue(maxsize=opt.queue_size)
+        write_queue = queue.Queue(maxsize=opt.queue_size)
+        manifest = Manifest(manifest_dir, shard_index, shard_count)
+
+        # cv2 decoding and PIL encoding release the GIL, so threads keep the model stage fed
+        decoders = [
+            threading.Thread(target=_decode_worker, args=(job_queue, decoded_queue), daemon=True)
+            for _ in range(opt.decode_workers)
+        ]
+        writers = [
+            threading.Thread(target=_write_worker, args=(write_queue, manifest, opt.segment_format), daemon=True)
+            for _ in range(opt.write_workers)
+        ]
+        for t in decoders + writers:
+            t.start()
+
+        start = time.time()
+        num_done = 0
+        num_decoders_alive = len(decoders)
+        batch = []
+        while num_decoders_alive > 0 or batch:
+            item = decoded_queue.get() if num_decoders_alive > 0 else _DONE
+            if item is _DONE:
+                num_decoders_alive = max(0, num_decoders_alive - 1)
+            else:
+                batch.append(item)
+            if len(batch) == opt.batch_size or (num_decoders_alive == 0 and batch):
+                for result in _score_batch(batch, mask_generator, opt.max_segments, opt.top_k, opt.clip_batch_size):
+                    write_queue.put(result)
+                num_done += len(batch)
+                batch = []
+                logger.info(f"[{num_done}/{len(jobs)}] {num_done / (time.time() - start):.2f} images/s")
+
+        for _ in writers:
+            write_queue.put(_DONE)
+        for t in writers:
+            t.join()
+        manifest.close()
+
+    if opt.fixed_csv:
+        write_fixed_csv(df, manifest_dir, opt.fixed_csv)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--img_dir", required=True, type=str, help="Directory of the country images")
+    parser.add_argument("--csv", required=True, type=str, help="CSV with image_name and description columns")
+    parser.add_argument("--seg_dir", default=None, type=str, help="Output root of the segments (default: image_segments_new[_<backend>] next to img_dir)")
+    parser.add_argument("--packed_dir", default=None, type=str, help="Output root of the packed segments (default: image_segments_packed[_<backend>] next to img_dir)")
+    parser.add_argument("--segment_format", default="jpeg", type=str, help="jpeg|packed|both, see utils/segment_store.py")
+    parser.add_argument("--manifest_dir", default=None, type=str, help="Directory of the progress manifests (default: seg_dir)")
+    parser.add_argument("--proposal_backend", default="sam", type=str, help="Segment proposals: " + "|".join(PROPOSAL_BACKENDS))
+    parser.add_argument("--sam_checkpoint", default="/hpc2hdd/home/szhong691/zsr/projects/segment-anything/segment_anything/checkpoint/sam_vit_h_4b8939.pth", type=str, help="SAM checkpoint")
+    parser.add_argument("--model_type", default="vit_h", type=str, help="SAM model type")
+    parser.add_argument("--shard", default="0/1", type=str, help="Process shard i of N (i/N), to split a country across machines")
+    parser.add_argument("--decode_workers", default=4, type=int, help="Number of image decoding threads")
+    parser.add_argument("--write_workers", default=4, type=int, help="Number of segment writing threads")
+    parser.add_argument("--batch_size", default=4, type=int, help="Images per model stage batch")
+    parser.add_argument("--clip_batch_size", default=256, type=int, help="Segments per CLIP encode_image call")
+    parser.add_argument("--queue_size", default=8, type=int, help="Capacity of the queues between stages")
+    parser.add_argument("--max_segments", default=50, type=int, help="Number of largest segments scored per image")
+    parser.add_argument("--top_k", default=10, type=int, help="Number of segments kept per image")
+    parser.add_argument("--fixed_csv", default=None, type=str, help="Write the CSV without failed rows here when done")
+    opt = parser.parse_args()
+
+    run(opt)
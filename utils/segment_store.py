@@ -0,0 +1,239 @@
+import os
+import argparse
+import numpy as np
+from PIL import Image
+
+
+# Packed segments live next to the images, one file per image:
+# <country>/image_segments_packed/<img_name>.npz
+PACKED_DIR = "image_segments_packed"
+PACKED_EXTENSION = ".npz"
+# One masked JPEG per segment: <country>/image_segments_new/<img_name>/<img_name>_<rank>.jpg
+SEGMENT_DIR = "image_segments_new"
+
+
+def segment_roots(country_dir, proposal_backend="sam"):
+    """
+    JPEG and packed segment roots of a country. Backends other than SAM write
+    next to the SAM segments, under <dir>_<backend>, so their retrieval
+    accuracy can be compared.
+
+    Returns:
+        tuple: (segment root, packed root).
+    """
+    suffix = "" if proposal_backend == "sam" else "_" + proposal_backend
+    return os.path.join(country_dir, SEGMENT_DIR + suffix), os.path.join(country_dir, PACKED_DIR + suffix)
+
+
+def rle_encode(mask):
+    """
+    Run-length encode a binary mask in row-major order.
+
+    Args:
+        mask (ndarray): HxW boolean mask.
+
+    Returns:
+        ndarray: int32 run lengths, alternating background and foreground,
+            starting with a (possibly empty) background run.
+    """
+    flat = np.asarray(mask, dtype=bool).ravel()
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.int32)
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], change, [flat.size]]))
+    if flat[0]:
+        counts = np.concatenate([[0], counts])
+    return counts.astype(np.int32)
+
+
+def rle_decode(counts, shape):
+    """
+    Decode run lengths produced by `rle_encode`.
+
+    Args:
+        counts (ndarray): Run lengths.
+        shape (tuple): (height, width) of the mask.
+
+    Returns:
+        ndarray: Boolean mask of `shape`.
+    """
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(shape)
+
+
+def mask_bbox(mask):
+    """Return the (x0, y0, x1, y1) bounding box of a mask, end exclusive."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return 0, 0, 0, 0
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def save_packed(path, masks, ranks=None, scores=None):
+    """
+    Store the segments of one image as bounding boxes plus RLE masks cropped to them.
+
+    Args:
+        path (str): Output .npz path.
+        masks (list): HxW boolean masks, in the order they should be loaded (best first).
+        ranks (list, optional): Area rank of each segment, the index used in the JPEG file names.
+        scores (list, optional): CLIP similarity of each segment.
+    """
+    height, width = masks[0].shape if masks else (0, 0)
+    bboxes, counts, offsets = [], [], [0]
+    for mask in masks:
+        x0, y0, x1, y1 = mask_bbox(mask)
+        rle = rle_encode(mask[y0:y1, x0:x1])
+        bboxes.append((x0, y0, x1, y1))
+        counts.append(rle)
+        offsets.append(offsets[-1] + len(rle))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez_compressed(
+        path,
+        size=np.array([height, width], dtype=np.int32),
+        bboxes=np.array(bboxes, dtype=np.int32).reshape(-1, 4),
+        offsets=np.array(offsets, dtype=np.int64),
+        counts=np.concatenate(counts) if counts else np.zeros(0, dtype=np.int32),
+        ranks=np.array(ranks if ranks is not None else range(len(masks)), dtype=np.int32),
+        scores=np.array(scores if scores is not None else [0.0] * len(masks), dtype=np.float32),
+    )
+
+
+class PackedSegments(object):
+    """Segments of one image loaded from a packed .npz file."""
+
+    def __init__(self, path):
+        with np.load(path) as f:
+            self.size = tuple(int(x) for x in f["size"])  # (height, width) of the original image
+            self.bboxes = f["bboxes"]
+            self.offsets = f["offsets"]
+            self.counts = f["counts"]
+            self.ranks = f["ranks"]
+            self.scores = f["scores"]
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def mask(self, k):
+        """Boolean mask of segment `k`, cropped to its bounding box, at original resolution."""
+        x0, y0, x1, y1 = self.bboxes[k]
+        return rle_decode(self.counts[self.offsets[k]:self.offsets[k + 1]], (y1 - y0, x1 - x0))
+
+    def full_mask(self, k):
+        """Boolean mask of segment `k` over the whole original image."""
+        x0, y0, x1, y1 = self.bboxes[k]
+        mask = np.zeros(self.size, dtype=bool)
+        mask[y0:y1, x0:x1] = self.mask(k)
+        return mask
+
+    def render(self, image, num_seg=None):
+        """
+        Render the bounding box crops of the segments from the parent image,
+        with the pixels outside each mask painted white.
+
+        `image` may be decoded at a reduced resolution (e.g. JPEG draft mode);
+        boxes are scaled and masks resized to it.
+
+        Args:
+            image (PIL.Image.Image): Decoded RGB parent image.
+            num_seg (int, optional): Render only the first `num_seg` segments.
+
+        Returns:
+            list: PIL RGB images, one per segment.
+        """
+        arr = np.asarray(image)
+        height, width = arr.shape[:2]
+        scale_y, scale_x = height / self.size[0], width / self.size[1]
+
+        segments = []
+        for k in range(len(self) if num_seg is None else min(num_seg, len(self))):
+            x0, y0, x1, y1 = self.bboxes[k]
+            dx0, dy0 = int(x0 * scale_x), int(y0 * scale_y)
+            dx1 = min(width, max(dx0 + 1, int(round(x1 * scale_x))))
+            dy1 = min(height, max(dy0 + 1, int(round(y1 * scale_y))))
+
+            mask = self.mask(k)
+            if mask.size == 0:
+                mask = np.zeros((dy1 - dy0, dx1 - dx0), dtype=bool)
+            elif mask.shape != (dy1 - dy0, dx1 - dx0):
+                mask = np.asarray(Image.fromarray(mask).resize((dx1 - dx0, dy1 - dy0), Image.NEAREST))
+            crop = arr[dy0:dy1, dx0:dx1].copy()
+            crop[~mask] = 255
+            segments.append(Image.fromarray(crop))
+        return segments
+
+
+def packed_path(img_path, img_name, packed_dir=PACKED_DIR):
+    """Packed segment file of `img_name` for an `<country>/images` directory."""
+    return os.path.join(os.path.dirname(img_path.rstrip("/")), packed_dir, img_name + PACKED_EXTENSION)
+
+
+def parity_check(country_dir, jpeg_dir="image_segments", num_images=50):
+    """
+    Compare packed segments with the JPEG segments of the same images.
+
+    Each packed segment is rendered from the full-resolution parent image and
+    compared with the same bounding box of its JPEG segment, found by area rank
+    in the `<img>_<rank>.jpg` file name. Also reports disk usage and the number
+    of decodes per item of both formats.
+
+    Args:
+        country_dir (str): Directory holding images/, `jpeg_dir` and image_segments_packed/.
+        jpeg_dir (str): Name of the JPEG segment directory.
+        num_images (int): Number of images compared.
+    """
+    packed_dir = os.path.join(country_dir, PACKED_DIR)
+    names = sorted(f[:-len(PACKED_EXTENSION)] for f in os.listdir(packed_dir) if f.endswith(PACKED_EXTENSION))
+
+    diffs, num_compared = [], 0
+    packed_bytes, jpeg_bytes, jpeg_files = 0, 0, 0
+    num_checked = 0
+    image_files = {f.split(".")[0]: f for f in os.listdir(os.path.join(country_dir, "images"))}
+    for img_name in names:
+        seg_dir = os.path.join(country_dir, jpeg_dir, img_name)
+        if not os.path.isdir(seg_dir) or img_name not in image_files:
+            continue
+        path = os.path.join(packed_dir, img_name + PACKED_EXTENSION)
+        packed = PackedSegments(path)
+        parent = Image.open(os.path.join(country_dir, "images", image_files[img_name])).convert("RGB")
+
+        packed_bytes += os.path.getsize(path)
+        for f in os.listdir(seg_dir):
+            jpeg_bytes += os.path.getsize(os.path.join(seg_dir, f))
+            jpeg_files += 1
+
+        for k, rendered in enumerate(packed.render(parent)):
+            jpeg_path = os.path.join(seg_dir, f"{img_name}_{packed.ranks[k]}.jpg")
+            if not os.path.exists(jpeg_path):
+                continue
+            x0, y0, x1, y1 = packed.bboxes[k]
+            reference = np.asarray(Image.open(jpeg_path).convert("RGB"), dtype=np.float32)[y0:y1, x0:x1]
+            diffs.append(np.abs(np.asarray(rendered, dtype=np.float32) - reference).mean())
+            num_compared += 1
+
+        num_checked += 1
+        if num_checked == num_images:
+            break
+
+    if not num_checked:
+        print(f"No image has both packed and JPEG segments in {country_dir}")
+        return
+    print(f"images: {num_checked}, segments compared: {num_compared}")
+    if diffs:
+        print(f"mean abs pixel diff: {np.mean(diffs):.3f} (max over segments {np.max(diffs):.3f})")
+    print(f"disk per image: jpeg {jpeg_bytes / num_checked / 1024:.1f} KB, packed {packed_bytes / num_checked / 1024:.1f} KB")
+    print(f"decodes per item: jpeg {1 + jpeg_files / num_checked:.1f}, packed 1 (+1 small .npz read)")
+
+
+if __name__ == "__main__":
+    # Parity check, e.g.
+    # python -m utils.segment_store --country_dir /path/to/UrbanCross/Finland --jpeg_dir image_segments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--country_dir", required=True, type=str, help="Country directory with images/ and both segment formats")
+    parser.add_argument("--jpeg_dir", default="image_segments", type=str, help="Name of the JPEG segment directory")
+    parser.add_argument("--num_images", default=50, type=int, help="Number of images compared")
+    opt = parser.parse_args()
+
+    parity_check(opt.country_dir, opt.jpeg_dir, opt.num_images)
@@ -0,0 +1,79 @@
+import torch
+from torch.utils.data import Sampler
+
+
+# CLIP tokens are right-padded with 0 up to the 77 token context, the EOT token
+# (the highest id) closes every caption. With the causal text mask, positions
+# after the EOT never influence it, so trimming the padding leaves the argmax
+# pooled text features unchanged.
+PAD_TOKEN = 0
+
+
+def text_lengths(cap_tokens):
+    """Number of real tokens (SOT ... EOT) of each caption, [N]."""
+    return (cap_tokens != PAD_TOKEN).sum(dim=1)
+
+
+def bucketed_length(length, bucket, context_length):
+    """Round `length` up to a multiple of `bucket`, at most `context_length`."""
+    return min(context_length, -(-int(length) // bucket) * bucket)
+
+
+def trim_text_tokens(cap_tokens, bucket=8):
+    """
+    Trim the padding of a batch of caption tokens to its longest caption,
+    rounded up to a multiple of `bucket` so only a few distinct shapes occur.
+
+    Args:
+        cap_tokens (torch.Tensor): Caption tokens [N, context_length].
+        bucket (int): Length granularity, 0 disables trimming.
+
+    Returns:
+        torch.Tensor: Caption tokens [N, L] with L <= context_length.
+    """
+    if not bucket or cap_tokens.numel() == 0:
+        return cap_tokens
+    longest = int(text_lengths(cap_tokens).max())
+    return cap_tokens[:, :bucketed_length(longest, bucket, cap_tokens.shape[1])]
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler for evaluation that groups captions of similar token length,
+    so every batch can be trimmed with `trim_text_tokens` and the text tower
+    cost follows the real caption lengths. Batches are yielded from the
+    shortest to the longest captions; results must be scattered back by index.
+    """
+
+    def __init__(self, lengths, batch_size):
+        """
+        Args:
+            lengths (torch.Tensor): Token length of each caption, see `text_lengths`.
+            batch_size (int): Number of captions per batch.
+        """
+        self.order = torch.argsort(torch.as_tensor(lengths), stable=True).tolist()
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.order), self.batch_size):
+            yield self.order[start:start + self.batch_size]
+
+    def __len__(self):
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+
+def caption_batches(captions, batch_size, bucket=0):
+    """
+    Index batches of the evaluation captions: contiguous slices by default,
+    length-bucketed ones when `bucket` is set.
+
+    Returns:
+        list: (indices, tokens) pairs, `indices` being a slice or an index list.
+    """
+    if not bucket:
+        return [
+            (slice(start, min(start + batch_size, len(captions))), captions[start:start + batch_size])
+            for start in range(0, len(captions), batch_size)
+        ]
+    sampler = LengthBucketBatchSampler(text_lengths(captions), batch_size)
+    return [(idx, trim_text_tokens(captions[idx], bucket)) for idx in sampler]
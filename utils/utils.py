@@ -11,10 +11,11 @@ import time
 import torch.distributed as dist
 import seaborn as sns
 from matplotlib import pyplot as plt
-import wandb
 import pynvml
 from tqdm import tqdm
 from loguru import logger
+from utils.text_length import caption_batches, trim_text_tokens
+from utils.contrastive import diag_mask, hinge_loss, hard_negative_loss
 
 
 # 从txt文件中读取数据
@@ -65,14 +66,7 @@ def collect_neg(args, input):
     """"collect the hard negative sample"""
     if input.dim() != 2:
         return ValueError
-
-    batch_size = input.size(0)
-    mask = Variable(torch.eye(batch_size) > 0.5).cuda(args.gpuid)
-    output = input.masked_fill_(mask, 0)
-    output_r = output.max(1)[0]
-    output_c = output.max(0)[0]
-    loss_n = torch.mean(output_r) + torch.mean(output_c)
-    return loss_n
+    return hard_negative_loss(input)
 
 
 # 计算对比损失函数
@@ -90,50 +84,20 @@ def calcul_contraloss(args, scores, size, margin, max_violation=False):
     Returns:
         torch.Tensor: Computed contrastive loss.
     """
-    # Compute diagonal of the similarity matrix
-    diagonal = scores.diag().view(size, 1)
-    d1 = diagonal.expand_as(scores)
-    d2 = diagonal.t().expand_as(scores)
-
-    # Calculate cost for caption retrieval
-    cost_s = (margin + scores - d1).clamp(min=0)
-    
-    # Calculate cost for image retrieval
-    cost_im = (margin + scores - d2).clamp(min=0)
-
-    # Mask diagonal elements
-    mask = torch.eye(scores.size(0)) > .5
-    I = Variable(mask)
-    if torch.cuda.is_available():
-        I = I.cuda(args.gpuid)
-    cost_s = cost_s.masked_fill_(I, 0)
-    cost_im = cost_im.masked_fill_(I, 0)
-
-    # Apply max violation if specified
-    if max_violation:
-        cost_s = cost_s.max(1)[0]
-        cost_im = cost_im.max(0)[0]
-
-    # Sum up the costs
-    sum_cost_s = cost_s.sum()
-    sum_cost_im = cost_im.sum()
-
-    return sum_cost_s + sum_cost_im
+    # Both directions in one pass with a cached diagonal mask; `--loss_chunk_size`
+    # computes it over blocks of rows without materializing the [B, B] costs
+    return hinge_loss(scores, margin, max_violation, chunk_size=getattr(args, "loss_chunk_size", 0))
 
 
 
 # 计算内部损失函数
 def calcul_intraloss(args, scores, up=0.5, down=0.05, lamb=1.0):
     if args.il_measure == 'cosine':
-        diagonal = scores.diag()
         scores = scores.cuda(args.gpuid)
-        eye = torch.eye(scores.size(0)).float().cuda(args.gpuid)
-        scores_non_self = scores - eye
+        scores_non_self = torch.where(diag_mask(scores.size(0), scores.device), scores - 1, scores)
         # scores_non_self.gt_(self.up).lt_(1 - self.down)
         scores_non_self = scores_non_self * (
-            scores_non_self.gt(up).float())
-        scores_non_self = scores_non_self * (
-            scores_non_self.lt(1 - down).float())
+            scores_non_self.gt(up) & scores_non_self.lt(1 - down))
         scores_norm = scores_non_self.sum() / scores.size(0)
         # print(scores_norm.item())
 
@@ -366,7 +330,7 @@ def shard_dis_SWAN(args,
     return d
 
 
-def shard_dis_mine(args, images, captions, segments, model):
+def shard_dis_mine(args, images, captions, segments, model, seg_counts=None):
     """
     Compute image-caption pairwise distance during validation and test.
 
@@ -374,15 +338,20 @@ def shard_dis_mine(args, images, captions, segments, model):
         args (argparse.Namespace): Parsed arguments.
         images (list): List of images.
         captions (list): List of captions.
-        segments (list): List of segment tensors.
+        segments (list): Packed segment tensors (or padded ones when seg_counts is None).
         model (torch.nn.Module): Trained model for computing similarity.
+        seg_counts (torch.Tensor, optional): Number of segments of each image.
 
     Returns:
         np.ndarray: Image-caption pairwise distance matrix.
     """
-    # Calculate the number of shards for images and captions
+    # Calculate the number of shards for images, captions are sharded by caption_batches
     n_img_shard = (len(images) - 1) // args.shard_size + 1
-    n_cap_shard = (len(captions) - 1) // args.shard_size + 1
+    cap_shards = caption_batches(captions, args.shard_size, getattr(args, "text_bucket", 0))
+
+    # Offsets of each image's first segment in the packed segment tensor
+    if seg_counts is not None:
+        seg_offsets = torch.cat([seg_counts.new_zeros(1), seg_counts.cumsum(0)])
 
     # Initialize an array to store pairwise distances
     d = np.zeros((len(images), len(captions)))
@@ -396,20 +365,24 @@ def shard_dis_mine(args, images, captions, segments, model):
         print("Calculate the similarity in batches: [{}/{}]".format(i, n_img_shard))
 
         # Iterate over caption shards
-        for j in range(n_cap_shard):
-            cap_start, cap_end = args.shard_size * j, min(args.shard_size * (j + 1), len(captions))
+        for cap_idx, cap_tokens in cap_shards:
             with torch.no_grad():
                 img = images[img_start:img_end].cuda(args.gpuid)
-                texts = captions[cap_start:cap_end].cuda(args.gpuid)
-                segs = segments[img_start:img_end].cuda(args.gpuid)
+                texts = cap_tokens.cuda(args.gpuid)
+                if seg_counts is None:
+                    segs = segments[img_start:img_end].cuda(args.gpuid)
+                    counts = None
+                else:
+                    segs = segments[seg_offsets[img_start]:seg_offsets[img_end]].cuda(args.gpuid)
+                    counts = seg_counts[img_start:img_end].cuda(args.gpuid)
                 t1 = time.time()
                 # Compute similarity scores between images and captions
-                sim_img2text, sim_seg2text = model(img, texts, segs)
+                sim_img2text, sim_seg2text = model(img, texts, segs, counts)
                 sim = sim_img2text
                 t2 = time.time()
                 all.append(t2 - t1)
 
-                d[img_start:img_end, cap_start:cap_end] = sim.data.cpu().numpy()
+                d[img_start:img_end, cap_idx] = sim.data.cpu().numpy()
 
     # Compute average inference time
     print("infer time:{:.2f}".format(np.average(all)))
@@ -430,9 +403,9 @@ def shard_dis_without_sam_mine(args, images, captions, model):
     Returns:
         np.ndarray: Image-caption pairwise distance matrix.
     """
-    # Calculate the number of shards for images and captions
+    # Calculate the number of shards for images, captions are sharded by caption_batches
     n_img_shard = (len(images) - 1) // args.shard_size + 1
-    n_cap_shard = (len(captions) - 1) // args.shard_size + 1
+    cap_shards = caption_batches(captions, args.shard_size, getattr(args, "text_bucket", 0))
 
     # Initialize an array to store pairwise distances
     d = np.zeros((len(images), len(captions)))
@@ -446,11 +419,10 @@ def shard_dis_without_sam_mine(args, images, captions, model):
         print("Calculate the similarity in batches: [{}/{}]".format(i, n_img_shard))
 
         # Iterate over caption shards
-        for j in range(n_cap_shard):
-            cap_start, cap_end = args.shard_size * j, min(args.shard_size * (j + 1), len(captions))
+        for cap_idx, cap_tokens in cap_shards:
             with torch.no_grad():
                 img = images[img_start:img_end].cuda(args.gpuid)
-                texts = captions[cap_start:cap_end].cuda(args.gpuid)
+                texts = cap_tokens.cuda(args.gpuid)
                 t1 = time.time()
                 # Compute similarity scores between images and captions
                 sim_img2text = model(img, texts)
@@ -458,7 +430,7 @@ def shard_dis_without_sam_mine(args, images, captions, model):
                 t2 = time.time()
                 all.append(t2 - t1)
 
-                d[img_start:img_end, cap_start:cap_end] = sim.data.cpu().numpy()
+                d[img_start:img_end, cap_idx] = sim.data.cpu().numpy()
 
     # Compute average inference time
     print("infer time:{:.2f}".format(np.average(all)))
@@ -475,9 +447,9 @@ def shard_dis_mine_finetune(args, images, captions, model):
     """
     # Calculate the number of shards for images and captions
     n_img_shard = (len(images) - 1) // args.shard_size + 1
-    n_cap_shard = (len(captions) - 1) // args.shard_size + 1
+    cap_shards = caption_batches(captions, args.shard_size, getattr(args, "text_bucket", 0))
     logger.info('n_img_shard:{}'.format(n_img_shard))
-    logger.info('n_cap_shard:{}'.format(n_cap_shard))
+    logger.info('n_cap_shard:{}'.format(len(cap_shards)))
 
     # Initialize a matrix to store the pairwise distances
     d = np.zeros((len(images), len(captions)))
@@ -492,13 +464,11 @@ def shard_dis_mine_finetune(args, images, captions, model):
         print("Calculate the similarity in batches: [{}/{}]".format(i, n_img_shard))
 
         # Iterate through caption shards
-        for j in range(n_cap_shard):
-            cap_start, cap_end = args.shard_size * j, min(args.shard_size * (j + 1), len(captions))
-            
+        for cap_idx, cap_tokens in cap_shards:
             with torch.no_grad():
                 # Move images and captions to the GPU
                 img = images[img_start:img_end].cuda(args.gpuid)
-                texts = captions[cap_start:cap_end].cuda(args.gpuid)
+                texts = cap_tokens.cuda(args.gpuid)
 
                 # Compute similarity between image and caption shards
                 t1 = time.time()
@@ -514,7 +484,7 @@ def shard_dis_mine_finetune(args, images, captions, model):
                 all.append(t2 - t1)
 
                 # Store the computed similarity in the distance matrix
-                d[img_start:img_end, cap_start:cap_end] = sim.data.cpu().numpy()
+                d[img_start:img_end, cap_idx] = sim.data.cpu().numpy()
 
     # Print average inference time
     print("infer time:{:.2f}".format(np.average(all)))
@@ -523,35 +493,60 @@ def shard_dis_mine_finetune(args, images, captions, model):
     return d
 
 
-# 导出图像向量和文本向量
-def save_img_text_emb(args, images, captions, model, lengths):
-    """compute image-caption pairwise distance during validation and test"""
-    n_im_shard = (len(images) - 1) // args.shard_size + 1
-    n_cap_shard = (len(captions) - 1) // args.shard_size + 1
+def encode_text_cache(args, model, cap_tokens):
+    """
+    Encode a whole set of tokenized captions with the text tower only.
+    Used to refresh the embedding cache of the similarity curriculum sampler,
+    so it runs without gradients and in shards of `args.shard_size`.
 
-    img_emb_all = np.zeros((1,512))
-    text_emb_all = np.zeros((1, 512))
+    Args:
+        args: Parsed arguments (`gpuid`, `shard_size`).
+        model: Fine-tuning model holding `clip_model`.
+        cap_tokens (torch.Tensor): Caption tokens of shape [N, 77].
 
-    for i in range(n_im_shard):
-        im_start, im_end = args.shard_size * i, min(args.shard_size * (i + 1), len(images))
-        with torch.no_grad():
-            im = Variable(torch.from_numpy(images[im_start:im_end])).float().cuda(args.gpuid)
+    Returns:
+        torch.Tensor: L2-normalized float32 text embeddings [N, D] on the CPU.
+    """
+    model = model.module if hasattr(model, "module") else model
+    clip_model = model.clip_model
+    text_emb_all = []
+    with torch.no_grad(), model.autocast():
+        for start in range(0, len(cap_tokens), args.shard_size):
+            texts = trim_text_tokens(cap_tokens[start:start + args.shard_size], getattr(args, "text_bucket", 0))
+            texts = texts.cuda(args.gpuid, non_blocking=True)
+            text_emb = clip_model.encode_text(texts, normalize=True)
+            text_emb_all.append(text_emb.float().cpu())
+    return torch.cat(text_emb_all, dim=0)
+
+
+# 导出图像向量和文本向量
+def save_img_text_emb(args, images, captions, model, lengths=None):
+    """
+    Export normalized image and caption embeddings, computed in shards with the
+    model's encoder interface (`encode_image` / `encode_text`).
 
-            img_emb = model.get_img_emb(im)
-            img_emb = img_emb.cpu().numpy()
-            img_emb_all = np.concatenate((img_emb_all, img_emb), axis=0)
+    Args:
+        args: Parsed arguments (`gpuid`, `shard_size`).
+        images (np.ndarray or torch.Tensor): Images [N, 3, H, W].
+        captions (np.ndarray or torch.Tensor): Caption tokens [M, L].
+        model: UrbanCross model variant.
+        lengths (list, optional): Unused, CLIP tokens carry their own padding.
 
-    for j in range(n_cap_shard):
-        cap_start, cap_end = args.shard_size * j, min(args.shard_size * (j + 1), len(captions))
-        with torch.no_grad():
-            s = Variable(torch.from_numpy(captions[cap_start:cap_end])).cuda(args.gpuid)
-            l = lengths[cap_start:cap_end]
+    Returns:
+        np.ndarray: Image embeddings [N, D].
+        np.ndarray: Text embeddings [M, D].
+    """
+    images = torch.as_tensor(images).float()
+    captions = torch.as_tensor(captions).long()
 
-            text_emb = model.get_text_emb(s, l)
-            text_emb = text_emb.cpu().numpy()
-            text_emb_all = np.concatenate((text_emb_all, text_emb), axis=0)
+    img_emb_all, text_emb_all = [], []
+    with torch.no_grad():
+        for im in images.split(args.shard_size):
+            img_emb_all.append(model.encode_image(im.cuda(args.gpuid)).cpu())
+        for s in captions.split(args.shard_size):
+            text_emb_all.append(model.encode_text(s.cuda(args.gpuid)).cpu())
 
-    return img_emb_all[1:,:], text_emb_all[1:,:]
+    return torch.cat(img_emb_all).numpy(), torch.cat(text_emb_all).numpy()
 
 # 保存模型文件
 def save_checkpoint(state, epoch, filename, prefix='', model_name=None, args=None):
@@ -793,10 +788,9 @@ class LogCollector(object):
     #         tb_logger.log_value(prefix + k, v.val, step=step)
 
     def wandb_log(self):
-        """Log using wandb
+        """Log the current values to the metrics sinks, as one record
         """
-        # import ipdb;ipdb.set_trace()
-        for k, v in self.meters.items():
-            wandb.log({k: v.val})
-            # tb_logger.log_value(prefix + k, v.val, step=step)
+        from utils import metrics
+
+        metrics.log({k: v.val for k, v in self.meters.items()})
 
@@ -3,13 +3,15 @@ import shutil
 import torch
 import argparse
 # import tensorboard_logger as tb_logger
-import wandb
 # import logging
 from loguru import logger
 import torch.distributed as dist
 import utils.utils as utils
 import data
 import engine
+from utils import metrics
+from utils.adapters import load_weights
+from utils.precision import build_precision, set_precision
 from layers import urbancross as models
 from utils.vocab import deserialize_vocab
 
@@ -37,6 +39,7 @@ def parser_options():
     parser.add_argument('--batch_size_val_source', default=100, type=int, help="Batch val size")
     parser.add_argument('--batch_size_val_target', default=100, type=int, help="Batch val size")
     parser.add_argument('--shard_size', default=256, type=int, help="Batch shard size")
+    parser.add_argument('--text_bucket', default=0, type=int, help="Trim caption tokens to the longest caption, rounded up to a multiple of this (0: full 77 token context)")
     parser.add_argument('--workers', default=3, type=int, help="the worker num of dataloader")
     parser.add_argument('-kf', '--k_fold_nums', default=1, type=int, help="the total num of k_flod")
     parser.add_argument('--k_fold_current_num', default=0, type=int, help="current num of k_fold")
@@ -62,6 +65,7 @@ def parser_options():
     parser.add_argument('--rank', default=0, type=int, help='rank of current process')
     parser.add_argument('--world_size', default=2, type=int, help="world size")
     parser.add_argument('--use_mix_precision', default=False, action='store_true', help="whether to use mix precision")
+    parser.add_argument('--precision', default=None, type=str, choices=['fp32', 'fp16', 'bf16'], help="Autocast precision, fp16 adds a GradScaler (default: fp16 on CUDA, fp32 on CPU; --use_mix_precision forces fp16)")
 
     # No set setting
     parser.add_argument('--logger_name', default='logs/', type=str, help="the path of logs")
@@ -81,11 +85,17 @@ def parser_options():
     parser.add_argument("--close_wandb", action='store_true',)
     parser.add_argument("--wandb_id", type=str, default=None,)
     parser.add_argument("--wandb_logging_dir", type=str, default='./outputs',)
+    parser.add_argument("--metrics_sinks", type=str, default='jsonl', help="Comma-separated metrics sinks: jsonl, wandb, stdout")
+    parser.add_argument("--resource_interval", type=float, default=10.0, help="Seconds between CPU/memory/GPU samples (0 disables)")
     parser.add_argument("--country", type=str,)
     parser.add_argument("--country_source", type=str, default='Finland',)
     parser.add_argument("--country_target", type=str, default='Finland',)
     parser.add_argument("--load_path", type=str,)
 
+    # Image decoding settings
+    parser.add_argument("--decode_backend", type=str, default='auto', help="Image decode backend (auto|pil|pil_draft|cv2_reduced|torchvision)")
+    parser.add_argument("--decode_tolerance", type=float, default=2.0, help="Max mean abs pixel difference to PIL accepted by auto backend selection")
+
     args = parser.parse_args()
 
     # Generate dataset path
@@ -104,25 +114,8 @@ def parser_options():
 
 
 def main(args):
-    # Set WANDB_DIR environment variable
-    os.environ["WANDB_DIR"] = args.wandb_logging_dir
-    
-    # Generate WANDB_ID if not provided
-    if not args.wandb_id:
-        args.wandb_id = wandb.util.generate_id()
-    
-    # Login to W&B
-    wandb.login(key='d7ec29907ca115fe6d605741c40d09cf563aa0db')
-    logger.info(f"W&B ID: {args.wandb_id}")
-    
-    # Initialize Weights and Biases run
-    wandb.init(
-        project="UrbanCross",
-        config=args,
-        name=args.experiment_name,
-        id=args.wandb_id,
-        mode='dryrun',
-    )
+    # Metrics go to a local JSONL file by default, W&B and stdout are optional (--metrics_sinks)
+    metrics.init_sinks(args)
 
     # Set random seed for reproducibility
     utils.setup_seed(args.seed)
@@ -137,8 +130,11 @@ def main(args):
 
     # Load pretrained model weights
     model = models.factory_finetune(args, cuda=True, data_parallel=args.distributed)
-    pretrained_weight = torch.load(args.load_path, map_location='cuda:{}'.format(args.gpuid))
-    model.load_state_dict(pretrained_weight['model'], strict=False)
+    # Autocast (and loss scaling) of the model forward passes
+    precision = build_precision(args)
+    set_precision(model, precision)
+    # Adapter-only checkpoints are loaded on top of their base checkpoint and merged
+    load_weights(model, args.load_path, map_location='cuda:{}'.format(args.gpuid))
     logger.info('load model from {}'.format(args.load_path))
 
     # Print and save model info